@@ -4,13 +4,81 @@ import geopandas as gpd
 import glob
 from shapely.geometry import Point
 import osmnx as ox
+import shapely
+import pyproj
 import math
 from shapely.geometry import Point, shape, LineString
 from scipy.spatial import cKDTree
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra, connected_components
+from shapely.geometry.base import BaseGeometry
+import networkx as nx
 import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+import hashlib
+import os
+import pickle
+import copy
+import yaml
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 shst_link_df_list = []
 
+# shst geometries in the buffer area along the extraction boundaries are duplicated across files
+SHST_DUPLICATE_SUBSET = ['id', 'fromIntersectionId', 'toIntersectionId', 'forwardReferenceId', 'backReferenceId']
+
+# pyproj transformers by (from crs, to crs), see get_transformer
+TRANSFORMER_CACHE = {}
+
+# number of new or shortened links up to which cached bus paths are checked against them one by one,
+# with more the whole route path cache is routed again, see invalid_route_paths
+ROUTE_CACHE_MAX_NEW_LINKS = 512
+
+# column of write_interim_table keeping the row position of the table written, dropped by read_interim_table
+INTERIM_ROW_COLUMN = "_interim_row"
+
+# bytes of the dense dijkstra distance and predecessor rows of a chunk of sources (float64 + int32 per node and
+# source) that shortest_path_links sizes its default chunk_size to, held in every routing worker process
+ROUTE_CHUNK_MEMORY = 256 * 2 ** 20
+
+# narrowest dtypes of the link, node and shape tables, see apply_schema
+# osm node ids do not fit in 32 bits, model ids and flags do
+LINK_SCHEMA = {
+    'u' : 'int64',
+    'v' : 'int64',
+    'A' : 'int32',
+    'B' : 'int32',
+    'model_link_id' : 'int32',
+    'drive_access' : 'int8',
+    'walk_access' : 'int8',
+    'bike_access' : 'int8',
+    'rail_only' : 'int8',
+    'bus_only' : 'int8',
+    'assignable' : 'int8',
+    'roadway' : 'category',
+    'highway' : 'category',
+    'roadClass' : 'category',
+    'county' : 'category',
+}
+
+NODE_SCHEMA = {
+    'osm_node_id' : 'int64',
+    'model_node_id' : 'int32',
+    'drive_access' : 'int8',
+    'walk_access' : 'int8',
+    'bike_access' : 'int8',
+    'rail_only' : 'int8',
+    'county' : 'category',
+}
+
+SHAPE_SCHEMA = {
+    'county' : 'category',
+}
+
+
 def extract_osm_link_from_shst_shape(x, shst_link_df_list):
     """
     if len(x.get("metadata").get("osmMetadata").get("waySections")) > 1:
@@ -47,8 +115,41 @@ def extract_osm_link_from_shst_shape_pdconcat(x):
     link_df["geometryId"] = x.get("metadata").get("geometryId")
     
     shst_link_df = pd.concat([shst_link_df, link_df], sort = False, ignore_index = True)
-""" 
-    
+"""
+
+
+def extract_osm_link_from_shst_extract(shst_gdf):
+    """
+    bulk version of extract_osm_link_from_shst_shape, for the whole shst extraction at once
+
+    walks metadata.osmMetadata.waySections of every shst geometry once,
+    collecting the way sections and their geometryId into flat lists,
+    and builds the osm link dataframe in a single allocation,
+    instead of one small dataframe per shst geometry plus pd.concat
+
+    Parameters
+    ------------
+    shst_gdf: shst extraction, with "metadata" column
+
+    return
+    ------------
+    osm link from shst extraction, one row per osm way section,
+    with columns from waySections (nodeIds, wayId, roadClass, oneWay, roundabout, link, name) and geometryId
+    """
+    way_section_list = []
+    geometry_id_list = []
+
+    for metadata in shst_gdf["metadata"].values:
+        way_sections = metadata.get("osmMetadata").get("waySections")
+        way_section_list.extend(way_sections)
+        geometry_id_list.extend([metadata.get("geometryId")] * len(way_sections))
+
+    link_df = pd.DataFrame.from_records(way_section_list)
+    link_df["geometryId"] = geometry_id_list
+
+    return link_df
+
+
 def osm_link_with_shst_info(link_df, shst_gdf):
     """
     get complete osm links with shst info
@@ -96,7 +197,7 @@ def add_two_way_osm(link_gdf, osmnx_link):
                          inplace = True)
     """
     osmnx_link_gdf.drop_duplicates(subset = ["osmid"], inplace = True)
-    osmnx_link_gdf.drop(["length", "u", "v", "geometry"], axis = 1, inplace = True)
+    osmnx_link_gdf.drop(["length", "u", "v", "geometry"], axis = 1, inplace = True, errors = "ignore")
     
     print("shst extraction has geometry: ", osm_link_gdf.id.nunique())
     print("osm links from shst extraction: ", osm_link_gdf.shape[0])
@@ -196,6 +297,57 @@ def add_two_way_osm(link_gdf, osmnx_link):
     return osm_link_gdf
 
 
+def reduce_segments(df, keys, agg_dict):
+    """
+    reduce the segments sharing the same keys to one row per key, with array operations
+    equivalent to df.groupby(keys).agg(...).reset_index() with
+        "first": lambda x: x.iloc[0]
+        "last": lambda x: x.iloc[-1]
+        "list": lambda x: list(x) if len(list(x)) > 1 else list(x)[0]
+    but without calling a python function per group and column
+
+    rows are sorted once (stable) by their group number, group boundaries are the offsets
+    where the group number changes, and the first/last/list-valued columns are taken at those offsets
+
+    Parameters
+    ----------
+    df: dataframe of segments, in segment order within each key
+    keys: list of key columns, rows with null keys are dropped like groupby does
+    agg_dict: {column : "first" / "last" / "list"}
+
+    return
+    ----------
+    dataframe with the keys (sorted like groupby) followed by the agg_dict columns
+    """
+    group_id = df.groupby(keys, sort = True).ngroup().values
+    order = np.argsort(group_id, kind = "stable")
+    order = order[group_id[order] >= 0]
+    group_id = group_id[order]
+
+    starts = np.flatnonzero(np.r_[True, group_id[1:] != group_id[:-1]]) if len(order) > 0 else np.array([], dtype = int)
+    ends = np.r_[starts[1:], len(order)].astype(int)
+    single = (ends - starts) == 1
+
+    first_row = order[starts]
+    last_row = order[ends - 1]
+
+    out_df = df[keys].iloc[first_row].reset_index(drop = True)
+
+    for c, how in agg_dict.items():
+        if how == "last":
+            out_df[c] = df[c].iloc[last_row].values
+        elif (how == "first") or single.all():
+            out_df[c] = df[c].iloc[first_row].values
+        else:
+            value_list = df[c].values[order].tolist()
+            out_value = np.empty(len(starts), dtype = object)
+            out_value[:] = [value_list[s] if is_single else value_list[s:e]
+                            for s, e, is_single in zip(starts, ends, single)]
+            out_df[c] = out_value
+
+    return out_df
+
+
 def consolidate_osm_way_to_shst_link(osm_link):
     """
     if a shst link has more than one osm ways, aggregate info into one, e.g. series([1,2,3]) to cell value [1,2,3]
@@ -211,22 +363,22 @@ def consolidate_osm_way_to_shst_link(osm_link):
     """
     osm_link_gdf = osm_link.copy()
 
-    agg_dict = {"geometry" : lambda x: x.iloc[0],
-                "u" : lambda x: x.iloc[0],
-                "v" : lambda x: x.iloc[-1]}
+    shst_link_keys = ["shstReferenceId", "id", "shstGeometryId", "fromIntersectionId", "toIntersectionId"]
+
+    agg_dict = {"geometry" : "first",
+                "u" : "first",
+                "v" : "last"}
     
     for c in ['link', 'nodeIds', 'oneWay', 'roadClass', 'roundabout', 'wayId', 'access', 'area', 'bridge',
               'est_width', 'highway', 'junction', 'key', 'landuse', 'lanes', 'maxspeed', 'name', 'oneway', 'ref', 'service', 
               'tunnel', 'width']:
-        agg_dict.update({c : lambda x: list(x) if len(list(x)) > 1 else list(x)[0]})
+        agg_dict.update({c : "list"})
     
     print("-----start aggregating osm segments to one shst link for forward links----------")
     forward_link_gdf = osm_link_gdf[osm_link_gdf.reverse_out == 0].copy()
     
     if len(forward_link_gdf) > 0:
-        forward_link_gdf = forward_link_gdf.groupby(
-                                        ["shstReferenceId", "id", "shstGeometryId", "fromIntersectionId", "toIntersectionId"]
-                                        ).agg(agg_dict).reset_index()
+        forward_link_gdf = reduce_segments(forward_link_gdf, shst_link_keys, agg_dict)
         forward_link_gdf["forward"] = 1
     else:
         forward_link_gdf = None
@@ -236,12 +388,10 @@ def consolidate_osm_way_to_shst_link(osm_link):
     backward_link_gdf = osm_link_gdf[osm_link_gdf.reverse_out==1].copy()
     
     if len(backward_link_gdf) > 0:
-        agg_dict.update({"u" : lambda x: x.iloc[-1],
-                     "v" : lambda x: x.iloc[0]})    
+        agg_dict.update({"u" : "last",
+                     "v" : "first"})    
 
-        backward_link_gdf = backward_link_gdf.groupby(
-                                        ["shstReferenceId", "id", "shstGeometryId", "fromIntersectionId", "toIntersectionId"]
-                                        ).agg(agg_dict).reset_index()
+        backward_link_gdf = reduce_segments(backward_link_gdf, shst_link_keys, agg_dict)
     else:
         backward_link_gdf = None
     
@@ -267,6 +417,28 @@ def consolidate_osm_way_to_shst_link(osm_link):
     return shst_link_gdf
 
 
+def linestring_endpoints(geometry):
+    """
+    get the first and last coordinates of every linestring, from the coordinate buffer of the geometry array
+
+    Parameters
+    ---------
+    geometry: GeoSeries or array of linestrings
+
+    return
+    ---------
+    two (n, 2) arrays, xy of the first and the last point of each linestring
+    """
+    geometry_array = np.asarray(geometry)
+    coords, index = shapely.get_coordinates(geometry_array, return_index = True)
+
+    # coordinates come out in geometry order, so each geometry's coordinates are a contiguous run
+    ends = np.cumsum(np.bincount(index, minlength = len(geometry_array)))
+    starts = np.r_[0, ends[:-1]]
+
+    return coords[starts], coords[ends - 1]
+
+
 def create_node_gdf(link_gdf):
     """
     create shst node gdf from shst geometry
@@ -282,32 +454,28 @@ def create_node_gdf(link_gdf):
     """
     print("-------start creating shst nodes--------")
     # geometry only matches for forward direction
-    forward_link_gdf = link_gdf[link_gdf.forward == 1].copy()
+    forward_link_gdf = link_gdf[link_gdf.forward == 1]
     
     # create point geometry from shst linestring
-    forward_link_gdf["u_point"] = forward_link_gdf.apply(lambda x: Point(list(x.geometry.coords)[0]), axis = 1)
-    forward_link_gdf["v_point"] = forward_link_gdf.apply(lambda x: Point(list(x.geometry.coords)[-1]), axis = 1)
-    
-    # get from points
-    point_gdf = forward_link_gdf[["u", "fromIntersectionId", "u_point"]].copy()
-    
-    point_gdf.rename(columns = {"u" : "osm_node_id",
-                      "fromIntersectionId" : "shst_node_id",
-                      "u_point" : "geometry"},
-                    inplace = True)
-    
-    # append to points
-    point_gdf = pd.concat([point_gdf, forward_link_gdf[["v", "toIntersectionId", "v_point"]].rename(columns = 
-                     {"v" : "osm_node_id",
-                      "toIntersectionId" : "shst_node_id",
-                      "v_point" : "geometry"})],
-                     sort = False,
-                     ignore_index = True)
-    
-    # drop duplicates
-    point_gdf.drop_duplicates(subset = ["osm_node_id", "shst_node_id"], inplace = True)
-    
-    point_gdf = gpd.GeoDataFrame(point_gdf,
+    u_xy, v_xy = linestring_endpoints(forward_link_gdf["geometry"])
+    xy = np.concatenate([u_xy, v_xy])
+    
+    # from points, then to points
+    point_gdf = pd.DataFrame({
+        "osm_node_id" : np.concatenate([forward_link_gdf["u"].values, forward_link_gdf["v"].values]),
+        "shst_node_id" : np.concatenate([forward_link_gdf["fromIntersectionId"].values,
+                                         forward_link_gdf["toIntersectionId"].values]),
+    })
+    
+    # drop duplicates, on one integer key packed from the factorized osm and shst node ids
+    osm_code, _ = pd.factorize(point_gdf["osm_node_id"])
+    shst_code, shst_unique = pd.factorize(point_gdf["shst_node_id"])
+    # (null ids are code -1, shifted to 0 so they are kept once like drop_duplicates does)
+    node_key = (osm_code.astype(np.int64) + 1) * (len(shst_unique) + 1) + (shst_code + 1)
+    is_first = ~pd.Series(node_key).duplicated().values
+    
+    point_gdf = gpd.GeoDataFrame(point_gdf[is_first],
+                                 geometry = gpd.points_from_xy(xy[is_first, 0], xy[is_first, 1]),
                                  crs = {'init': 'epsg:4326'})
     
     return point_gdf
@@ -351,585 +519,2856 @@ def point_df_to_geojson(df: pd.DataFrame, properties: list):
         geojson["features"].append(feature)
     return geojson
 
-def fill_na(df_na):
+def _write_geojson_features(df, properties, f, geometry_type, chunk_size):
     """
-    fill str NaN with ""
-    fill numeric NaN with 0
+    stream features of df to the open file handle f, chunk by chunk
+
+    coordinates come from the geometry array in bulk, properties from the columns,
+    so only one chunk of features is held in memory at a time.
+    the text written is the same as json.dump of the link_df_to_geojson/point_df_to_geojson dict
     """
-    df = df_na.copy()
-    num_col = list(df.select_dtypes([np.number]).columns)
-    print("numeric columns: ", num_col)
-    object_col = list(df.select_dtypes(['object']).columns)
-    print("str columns: ", object_col)
-    
-    for x in list(df.columns):
-        if x in num_col:
-            df[x].fillna(0, inplace = True)
-        elif x in object_col:
-            df[x].fillna("", inplace = True)
-    
-    return df
+    f.write('{"type": "FeatureCollection", "features": [')
 
+    for chunk_start in range(0, len(df), chunk_size):
+        chunk_df = df.iloc[chunk_start : chunk_start + chunk_size]
 
-def identify_dead_end_nodes(links):
+        coords, index = shapely.get_coordinates(np.asarray(chunk_df["geometry"]), return_index = True)
+        coords = coords.tolist()
+        ends = np.cumsum(np.bincount(index, minlength = len(chunk_df))).tolist()
+        starts = [0] + ends[:-1]
+
+        if len(properties) > 0:
+            property_values = zip(*[chunk_df[prop].tolist() for prop in properties])
+        else:
+            property_values = [()] * len(chunk_df)
+
+        feature_list = []
+        for s, e, values in zip(starts, ends, property_values):
+            geometry_coords = coords[s:e] if geometry_type == "LineString" else coords[s]
+            feature_list.append(
+                '{"type": "Feature", "properties": ' +
+                json.dumps(dict(zip(properties, values)), default = _json_default) +
+                ', "geometry": {"type": "' + geometry_type + '", "coordinates": ' +
+                json.dumps(geometry_coords) + '}}'
+            )
+
+        if chunk_start > 0:
+            f.write(", ")
+        f.write(", ".join(feature_list))
+
+    f.write("]}")
+
+
+def _json_default(x):
     """
-    iteratively find the dead end in networks
+    serialize numpy scalars that json does not know about
     """
-    
-    A_B_df = pd.concat([links,
-                       links.rename(columns = {"u":"v", "v":"u"})],
-                      ignore_index = True,
-                      sort = False)
-    
-    A_B_df.drop_duplicates(inplace = True)
-    
-    A_B_df =  A_B_df.groupby(["u"]).count().reset_index()
-    
-    single_node_list = A_B_df[A_B_df.v == 1].u.tolist()
-    
-    return single_node_list
+    if isinstance(x, np.generic):
+        return x.item()
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    raise TypeError("Object of type " + type(x).__name__ + " is not JSON serializable")
 
 
-def read_shst_extract(path, suffix):
+def write_link_geojson(df, properties, f, chunk_size = 10000):
     """
-    read all shst extraction geojson file
+    streaming version of link_df_to_geojson + json.dump, for linestring geometry
+
+    Parameters
+    -----------
+    df: dataframe with linestring "geometry"
+    properties: list of columns to write as feature properties
+    f: open text file handle
+    chunk_size: number of features serialized at a time
     """
-    shst_gdf = pd.DataFrame()
-    
-    shst_file = glob.glob(path + "**/" + suffix, recursive = True)
-    print("----------start reading shst extraction data-------------")
-    for i in shst_file:
-        print("reading shst extraction data : ", i)
-        new = gpd.read_file(i)
-        new['source'] = i
-        shst_gdf = pd.concat([shst_gdf, new],
-                             ignore_index = True,
-                             sort = False)
-    print("----------finished reading shst extraction data-------------")
-    
-    return shst_gdf
+    _write_geojson_features(df, properties, f, "LineString", chunk_size)
 
 
-def highway_attribute_list_to_value(x, highway_to_roadway_dict, roadway_hierarchy_dict):
+def write_point_geojson(df, properties, f, chunk_size = 10000):
     """
-    clean up osm highway, and map to standard roadway
+    streaming version of point_df_to_geojson + json.dump, for point geometry
+
+    Parameters
+    -----------
+    df: dataframe with point "geometry"
+    properties: list of columns to write as feature properties
+    f: open text file handle
+    chunk_size: number of features serialized at a time
     """
-    if type(x.highway) == list:
-        value_list = list(set([highway_to_roadway_dict[c] for c in x.highway]))
-        if len(value_list) == 1:
-            if value_list[0] != "":
-                return value_list[0]
-            else:
-                if type(x.roadClass) == list:
-                    return highway_to_roadway_dict[x.roadClass[0].lower()]
-                else:
-                    return highway_to_roadway_dict[x.roadClass.lower()]
+    _write_geojson_features(df, properties, f, "Point", chunk_size)
 
-        else:
-            ret_val = value_list[0]
-            ret_val_level = roadway_hierarchy_dict[ret_val]
-            for c in value_list:
-                val_level = roadway_hierarchy_dict[c]
-                if val_level < ret_val_level:
-                    ret_val = c
-                    ret_val_level = val_level
-                else:
-                    continue
-            return ret_val
-    else:
-        if x.highway == "":
-            return highway_to_roadway_dict[x.roadClass.lower()]
-        else:
-            return highway_to_roadway_dict[x.highway]
-        
 
-def ox_graph(nodes_df, links_df):
+def write_interim_table(df, path, schema = None, row_group_column = "county"):
     """
-        create an osmnx-flavored network graph
-        osmnx doesn't like values that are arrays, so remove the variables
-        that have arrays.  osmnx also requires that certain variables
-        be filled in, so do that too.
-        Parameters
-        ----------
-        nodes_df : GeoDataFrame
-        link_df : GeoDataFrame
-        Returns
-        -------
-        networkx multidigraph
+    write a link, node or shape table to the parquet interim store, in place of geojson, json, feather or pickle
+
+    geometry is kept as WKB with its crs in GeoParquet "geo" metadata. rows are written one parquet row group
+    per value of row_group_column (e.g. county), so read_interim_table can read some counties only. the row
+    position in df is stored with the rows (INTERIM_ROW_COLUMN), and read_interim_table restores the row order of
+    df: later steps rely on it, e.g. drop_duplicates keeping the first row or ids numbered in row order.
+    columns arrow can not store as they are (e.g. mixed str and list values) are stored as json strings
+
+    Parameters
+    ----------
+    df: DataFrame or GeoDataFrame
+    path: .parquet file
+    schema: LINK_SCHEMA, NODE_SCHEMA or SHAPE_SCHEMA, applied before writing
+    row_group_column: column of the row groups, ignored if not in df
     """
-    try:
-        graph_nodes = nodes_df.drop(
-                ["inboundReferenceId", "outboundReferenceId"], axis=1
-            )
-    except:
-        graph_nodes = nodes_df.copy()
+    if schema is not None:
+        df = apply_schema(df, schema)
 
-    graph_nodes.gdf_name = "network_nodes"
-    graph_nodes['id'] = graph_nodes['shst_node_id']
+    metadata = {}
+    geometry_column = None
+    if isinstance(df, gpd.GeoDataFrame) and ("geometry" in df.columns):
+        geometry_column = "geometry"
+        column_metadata = {"encoding" : "WKB", "geometry_types" : []}
+        if df.crs is not None:
+            column_metadata["crs"] = pyproj.CRS.from_user_input(df.crs).to_json_dict()
+        metadata[b"geo"] = json.dumps({"version" : "0.4.0",
+                                       "primary_column" : geometry_column,
+                                       "columns" : {geometry_column : column_metadata}})
 
-    graph_links = links_df.copy()
-    graph_links['id'] = graph_links['shstReferenceId']
-    graph_links['key'] = graph_links['shstReferenceId']
+    if (row_group_column in df.columns) and (len(df) > 0):
+        # missing values are grouped under ""
+        group_key = df[row_group_column].astype(object).fillna("").astype(str).values
+        order = np.argsort(group_key, kind = "stable")
+        df = df.iloc[order].assign(**{INTERIM_ROW_COLUMN : order.astype(np.int64)})
+        group_key = group_key[order]
+        metadata[b"interim_row_column"] = INTERIM_ROW_COLUMN.encode()
+    else:
+        row_group_column = None
 
-    G = ox.gdfs_to_graph(graph_nodes, graph_links)
+    df = pd.DataFrame(df).reset_index(drop = True)
+    if geometry_column is not None:
+        df[geometry_column] = shapely.to_wkb(np.asarray(df[geometry_column]))
 
-    return G
+    json_column_list = []
+    for column in df.columns:
+        if df[column].dtype == object:
+            try:
+                pa.array(df[column].values, from_pandas = True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                df[column] = [json.dumps(x, default = _json_default) for x in df[column].values]
+                json_column_list.append(column)
+    metadata[b"interim_json_columns"] = json.dumps(json_column_list)
 
+    table = pa.Table.from_pandas(df, preserve_index = False)
 
-def reproject(link, node, epsg):
-    """
-    reporoject link and node geodataframes
-    
-    for nodes, update X and Y columns
-    
-    """
-    
-    link = link.to_crs(epsg = epsg)
-    node = node.to_crs(epsg = epsg)
-    
-    node['X'] = node['geometry'].apply(lambda p: p.x)
-    node['Y'] = node['geometry'].apply(lambda p: p.y)
+    # one row group per value of row_group_column
+    if row_group_column is not None:
+        group_start = np.flatnonzero(np.r_[True, group_key[1:] != group_key[:-1]])
+        group_length = np.diff(np.r_[group_start, len(df)])
+        metadata[b"interim_row_groups"] = json.dumps({"column" : row_group_column,
+                                                      "values" : group_key[group_start].tolist()})
+    else:
+        group_start = [0]
+        group_length = [len(df)]
 
-    return link, node
+    schema_metadata = dict(table.schema.metadata or {})
+    schema_metadata.update(metadata)
+    table = table.replace_schema_metadata(schema_metadata)
+    with pq.ParquetWriter(path, table.schema) as writer:
+        for start, length in zip(group_start, group_length):
+            writer.write_table(table.slice(start, length), row_group_size = max(length, 1))
 
 
-def num_of_drive_loadpoint_per_centroid(existing_drive_cc_df, existing_node_gdf):
-    """
-    decide number of loading point for drive access per centroid
-    
-    logic: for drive, find the closest points to the existing loading point
-    
-    return: 
-    dataframe
-    for each existing drive loading point, number of new loading point needs to be generated. currently set to 1.
-    
+def read_interim_table(path, columns = None, row_group_values = None, memory_map = True):
     """
-    existing_pairs_of_centroid_loadpoint_df = existing_drive_cc_df.groupby(['c', 'non_c']).count().reset_index().drop(['A','B'], axis = 1)
-    
-    existing_num_of_loadpoint_per_c_df = existing_drive_cc_df.groupby(['c', 'non_c']).count().groupby('c').count()[['A']].rename(columns = {'A':'abm_num_load'}).reset_index()
-    
-    num_drive_loadpoint_new_near_old = pd.merge(existing_pairs_of_centroid_loadpoint_df,
-                                                        existing_num_of_loadpoint_per_c_df,
-                                                        how = 'left',
-                                                        on = 'c')
-    
-    num_drive_loadpoint_new_near_old['osm_num_load'] = 1
-    
-    num_drive_loadpoint_new_near_old = pd.merge(num_drive_loadpoint_new_near_old,
-                                                        existing_node_gdf[['N', 'X', 'Y']],
-                                                        how = 'left',
-                                                        left_on = 'non_c',
-                                                        right_on = 'N')
-    return num_drive_loadpoint_new_near_old
+    read a table of write_interim_table
 
+    Parameters
+    ----------
+    path: .parquet file
+    columns: columns to read, default all
+    row_group_values: values of the row group column to read (e.g. a list of counties), default all rows
+    memory_map: memory-map the file rather than read it into a buffer
 
-def num_of_walk_bike_loadpoint_per_centroid(existing_centroid_df):
-    """
-    decide number of loading point for walk and bike access per centroid
-    
-    logic: find 5 closest points to centroid
-    
-    return: 
-    dataframe
-    for each centroid, number of loading point needs to be generated.
-    
+    return
+    ----------
+    GeoDataFrame if the geometry is read, else DataFrame, in the row order of the table written
     """
-    
-    num_loadpoint = existing_centroid_df[['N', 'X', 'Y']].copy()
-    num_loadpoint['osm_num_load'] = np.int(5)
-    num_loadpoint.rename(columns = {'N':'c'}, inplace = True)
-    
-    return num_loadpoint
+    parquet_file = pq.ParquetFile(path, memory_map = memory_map)
+    metadata = parquet_file.schema_arrow.metadata or {}
 
+    row_column = metadata.get(b"interim_row_column", b"").decode() or None
+    if (row_column is not None) and (columns is not None) and (row_column not in columns):
+        columns = list(columns) + [row_column]
 
-def find_new_load_point(abm_load_ref_df, all_node):
+    if row_group_values is not None:
+        if b"interim_row_groups" not in metadata:
+            raise ValueError(path + " has no row groups to filter")
+        row_group_dict = json.loads(metadata[b"interim_row_groups"])
+        row_group_values = set(str(x) for x in row_group_values)
+        row_group_list = [i for i, x in enumerate(row_group_dict["values"]) if x in row_group_values]
+        table = parquet_file.read_row_groups(row_group_list, columns = columns) if len(row_group_list) > 0 \
+            else parquet_file.schema_arrow.empty_table()
+        if (len(row_group_list) == 0) and (columns is not None):
+            table = table.select(columns)
+    else:
+        table = parquet_file.read(columns = columns)
+
+    df = table.to_pandas()
+
+    if (row_column is not None) and (row_column in df.columns):
+        df = df.iloc[np.argsort(df[row_column].values, kind = "stable")]
+        df = df.drop(row_column, axis = 1).reset_index(drop = True)
+
+    for column in json.loads(metadata.get(b"interim_json_columns", b"[]")):
+        if column in df.columns:
+            df[column] = [json.loads(x) if isinstance(x, str) else x for x in df[column].values]
+
+    if (b"geo" in metadata):
+        geo = json.loads(metadata[b"geo"])
+        geometry_column = geo["primary_column"]
+        if geometry_column in df.columns:
+            crs = geo["columns"][geometry_column].get("crs")
+            return gpd.GeoDataFrame(df,
+                                    geometry = shapely.from_wkb(np.asarray(df[geometry_column])),
+                                    crs = None if crs is None else pyproj.CRS.from_json_dict(crs))
+
+    return df
+
+
+def fill_na_values(df_na):
     """
-    find the loading points in osm nodes
-    
-    input: osm node, loading point reference input
-    
-    output:  dataframe of pairs of centroid and loading point, with point geometry of loading point
-    
-    works in epsg = 26915
-    
+    fill value of each column filled by fill_na: 0 for numeric columns, of the column's type (0.0 for floats),
+    "" for str (object) columns
     """
-    
-    all_node_gdf = all_node.copy()
-    
-    all_node_gdf = all_node_gdf.to_crs(epsg = 26915)
-    all_node_gdf["X"] = all_node_gdf["geometry"].apply(lambda g: g.x)
-    all_node_gdf["Y"] = all_node_gdf["geometry"].apply(lambda g: g.y)
-    
-    inventory_node_df = all_node_gdf.copy()
-    inventory_node_ref = inventory_node_df[["X", "Y"]].values
-    tree_default = cKDTree(inventory_node_ref)
-    
-    new_load_point_gdf = gpd.GeoDataFrame()
-    
-    for i in range(len(abm_load_ref_df)):
-  
-        point = abm_load_ref_df.iloc[i][['X', 'Y']].values
-        c_id = abm_load_ref_df.iloc[i]['c']
-        n_neigh = abm_load_ref_df.iloc[i]['osm_num_load']
-        
-        if "c" in all_node_gdf.columns:
-            inventory_node_df = all_node_gdf[all_node_gdf.c == c_id].copy().reset_index()
-            if len(inventory_node_df) == 0:
-                continue
-            else:
-                inventory_node_ref = inventory_node_df[["X", "Y"]].values
-                tree = cKDTree(inventory_node_ref)
-           
-        else:
-            inventory_node_df = all_node_gdf.copy()
-            tree = tree_default
-         
-        
-        dd, ii = tree.query(point, k = n_neigh)
-        if n_neigh == 1:
-            add_gdf = gpd.GeoDataFrame(inventory_node_df[['osm_node_id', "shst_node_id", "model_node_id", 'geometry']].iloc[ii])\
-                            .transpose().reset_index(drop = True)
-        else:
-            add_gdf = gpd.GeoDataFrame(inventory_node_df[['osm_node_id', "shst_node_id", "model_node_id", 'geometry']].iloc[ii])\
-                            .reset_index(drop = True)
-        add_gdf['c'] = int(abm_load_ref_df.iloc[i]['c'])
-        if i == 0:
-            new_load_point_gdf = add_gdf.copy()
-             
-        else:
-            new_load_point_gdf = new_load_point_gdf.append(add_gdf, ignore_index=True, sort=False)
-    
-    return new_load_point_gdf.rename(columns = {'geometry' : 'geometry_ld'})
+    num_col = list(df_na.select_dtypes([np.number]).columns)
+    print("numeric columns: ", num_col)
+    object_col = list(df_na.select_dtypes(['object']).columns)
+    print("str columns: ", object_col)
 
+    return dict([(x, df_na[x].dtype.type(0).item()) for x in num_col] + [(x, "") for x in object_col])
 
-def generate_centroid_connectors(run_type, existing_drive_cc_df, node_gdf, existing_node_df):
+
+def fill_na(df_na, fill_value_dict = None, fill_lists = False):
     """
-    calls function to generate loading point reference table, 
-    and calls function to find loading points
+    fill str NaN with ""
+    fill numeric NaN with 0
+
+    all columns are filled in one fillna, the input is not changed
+
+    Parameters
+    ----------
+    df_na: dataframe
+    fill_value_dict: fill value of each column, default is fill_na_values of df_na
+    fill_lists: if True, also fill the NaN inside list values, e.g. osm way attributes aggregated by
+        consolidate_osm_way_to_shst_link, as if the ways had been filled before they were aggregated
+    """
+    if fill_value_dict is None:
+        fill_value_dict = fill_na_values(df_na)
+
+    fill_value_dict = dict((c, v) for c, v in fill_value_dict.items() if c in df_na.columns)
+    df = df_na.fillna(value = fill_value_dict)
+
+    if fill_lists:
+        list_column_dict = {}
+        for c, value in fill_value_dict.items():
+            is_list = df[c].map(type).values == list
+            if not is_list.any():
+                continue
+            flat_value = df[c][is_list].explode()
+            flat_value = flat_value.where(flat_value.notnull(), value)
+            filled = df[c].copy()
+            filled[is_list] = flat_value.groupby(level = 0, sort = False).agg(list).reindex(filled.index[is_list])
+            list_column_dict[c] = filled
+        df = df.assign(**list_column_dict)
+
+    return df
+
+
+def apply_schema(df, schema, fill_na = False):
+    """
+    cast the columns of a link, node or shape table to the narrow dtypes of LINK_SCHEMA, NODE_SCHEMA or SHAPE_SCHEMA
+
+    schema columns not in df are skipped, and so are columns of list values, integer columns
+    with NaN left, and columns with values that do not cast (e.g. "nan" strings)
+
+    Parameters
+    ----------
+    df: link, node or shape table
+    schema: dict of column to dtype
+    fill_na: if True, fill NaN of the schema columns first, as fill_na does: 0 for numbers, "" for strings
+
+    return
+    ----------
+    df with the schema dtypes, in a new frame
+    """
+    column_dict = {}
+
+    for column, dtype in schema.items():
+        if column not in df.columns:
+            continue
+
+        values = df[column]
+        if values.dtype == dtype:
+            continue
+
+        is_number = pd.api.types.is_numeric_dtype(values)
+        if fill_na:
+            values = values.fillna(0 if is_number else "")
+
+        if dtype == "category":
+            sample = values.dropna()
+            if (len(sample) > 0) and isinstance(sample.iloc[0], (list, tuple, dict, np.ndarray)):
+                continue
+        else:
+            if values.isnull().any():
+                continue
+            # do not let ids wrap around
+            if pd.api.types.is_integer_dtype(dtype) and is_number and (len(values) > 0) and \
+                ((values.min() < np.iinfo(dtype).min) or (values.max() > np.iinfo(dtype).max)):
+                continue
+
+        try:
+            column_dict[column] = values.astype(dtype)
+        except (ValueError, TypeError):
+            continue
+
+    return df.assign(**column_dict)
+
+
+def identify_dead_end_nodes(links):
+    """
+    iteratively find the dead end in networks
+
+    a dead end node has one neighbor, counting both link directions. dead end nodes and their links
+    are removed, which can make new dead ends, until there are none left. each round removes all the
+    dead ends of the network left by the round before, the degree of the neighbors is updated as nodes
+    are removed, so each link is looked at once
+
+    Parameters
+    ----------
+    links: links with u, v node id
+
+    return
+    ----------
+    dataframe of dead end node, with the iteration it is removed at, starting at 1
+    links touching a dead end node, with the iteration they are removed at
+    """
+    u = links["u"].values
+    v = links["v"].values
+
+    node_id, node_index = np.unique(np.concatenate([u, v]), return_inverse = True)
+    num_node = len(node_id)
+    u_index = node_index[:len(u)].astype(np.int64)
+    v_index = node_index[len(u):].astype(np.int64)
+
+    # distinct neighbors of each node, both directions
+    pair_key = np.unique(np.concatenate([u_index * num_node + v_index, v_index * num_node + u_index]))
+    pair_node = pair_key // num_node
+    neighbor = pair_key % num_node
+
+    neighbor_count = np.bincount(pair_node, minlength = num_node)
+    neighbor_start = np.cumsum(neighbor_count) - neighbor_count
+    degree = neighbor_count.copy()
+
+    node_iteration = np.zeros(num_node, dtype = np.int64)
+    dead_end = np.flatnonzero(degree == 1)
+    iteration = 0
+
+    while len(dead_end) > 0:
+        iteration += 1
+        node_iteration[dead_end] = iteration
+
+        # neighbors still in the network lose one degree per dead end removed next to them
+        dead_end_neighbor = neighbor[_expand_ranges(neighbor_start[dead_end], neighbor_count[dead_end])]
+        dead_end_neighbor = dead_end_neighbor[node_iteration[dead_end_neighbor] == 0]
+        np.subtract.at(degree, dead_end_neighbor, 1)
+
+        dead_end = np.unique(dead_end_neighbor[degree[dead_end_neighbor] == 1])
+
+    dead_end_node_df = pd.DataFrame({"node" : node_id, "iteration" : node_iteration})
+    dead_end_node_df = dead_end_node_df[dead_end_node_df.iteration > 0].sort_values(
+        by = ["iteration", "node"], kind = "mergesort").reset_index(drop = True)
+
+    # a link goes with the first of its nodes removed
+    u_iteration = np.where(node_iteration[u_index] > 0, node_iteration[u_index], iteration + 1)
+    v_iteration = np.where(node_iteration[v_index] > 0, node_iteration[v_index], iteration + 1)
+    link_iteration = np.minimum(u_iteration, v_iteration)
+
+    dead_end_link_df = links[link_iteration <= iteration].copy()
+    dead_end_link_df["iteration"] = link_iteration[link_iteration <= iteration]
+
+    return dead_end_node_df, dead_end_link_df
+
+
+def _read_shst_extract_file(file):
+    """
+    read one shst extraction geojson file, tagged with its source
+    """
+    new = gpd.read_file(file)
+    new['source'] = file
+
+    return new
+
+
+def read_shst_extract(path, suffix, processes = 1, max_files_in_flight = None, drop_duplicates = False):
+    """
+    read all shst extraction geojson file
+
+    Parameters
+    ------------
+    path: folder of shst extraction, searched recursively
+    suffix: file name pattern, e.g. "*.out.geojson"
+    processes: number of worker processes reading files, 1 reads in this process
+    max_files_in_flight: max number of files read but not yet consumed, bounds peak memory.
+        default is the number of processes, values below 1 are read as 1
+    drop_duplicates: if True, drop the shst geometries duplicated in the buffer area along boundaries
+        while reading, keeping the first by file order, same as drop_duplicates on SHST_DUPLICATE_SUBSET
+
+    return
+    ------------
+    shst extraction of all files, concatenated once
+    """
+    shst_file = glob.glob(path + "**/" + suffix, recursive = True)
+
+    if max_files_in_flight is None:
+        max_files_in_flight = processes
+    max_files_in_flight = max(1, max_files_in_flight)
+
+    shst_gdf_list = []
+    seen_key = set()
+
+    def _consume(file, new):
+        print("reading shst extraction data : ", file)
+        if drop_duplicates:
+            key = new[SHST_DUPLICATE_SUBSET[0]].str.cat(
+                [new[c] for c in SHST_DUPLICATE_SUBSET[1:]], sep = "|", na_rep = "")
+            is_new = ~(key.isin(seen_key) | key.duplicated())
+            seen_key.update(key[is_new])
+            new = new[is_new.values]
+        shst_gdf_list.append(new)
+
+    print("----------start reading shst extraction data-------------")
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers = processes) as executor:
+            in_flight = deque()
+            for i in shst_file:
+                if len(in_flight) >= max_files_in_flight:
+                    file, future = in_flight.popleft()
+                    _consume(file, future.result())
+                in_flight.append((i, executor.submit(_read_shst_extract_file, i)))
+            while in_flight:
+                file, future = in_flight.popleft()
+                _consume(file, future.result())
+    else:
+        for i in shst_file:
+            _consume(i, _read_shst_extract_file(i))
+
+    if len(shst_gdf_list) > 0:
+        shst_gdf = pd.concat(shst_gdf_list,
+                             ignore_index = True,
+                             sort = False)
+    else:
+        shst_gdf = pd.DataFrame()
+    print("----------finished reading shst extraction data-------------")
+
+    return shst_gdf
+
+
+# osmnx way attributes of the shst partition workers, set by _init_shst_partition_worker
+_worker_osmnx_link = None
+
+
+def _init_shst_partition_worker(osmnx_link):
+    global _worker_osmnx_link
+    _worker_osmnx_link = osmnx_link
+
+
+def shst_extract_to_link(shst_file, osmnx_link):
+    """
+    step 3 transforms of one shst extraction file (one boundary), from shst geometries to shst links with osm info:
+    extract osm ways, join shst and osmnx info, add two way links, consolidate to shst links
+
+    NAs are not filled here: which columns fill_na fills, and with what, depends on the column dtypes, which differ
+    from one boundary to another (e.g. a column all NaN in one county). the fill values of the file are returned,
+    so that the links of all files are filled once, after merge_link_partitions, as in the regional run
+
+    Parameters
+    ------------
+    shst_file: shst extraction geojson file
+    osmnx_link: osmnx links, see add_two_way_osm
+
+    return
+    ------------
+    shst links of the file, shst geometries of the file without duplicates, fill_na_values of the osm ways of the file
+    """
+    shst_gdf = _read_shst_extract_file(shst_file)
+    shst_gdf = shst_gdf.drop_duplicates(subset = SHST_DUPLICATE_SUBSET)
+
+    osm_link_df = extract_osm_link_from_shst_extract(shst_gdf)
+    osm_link_gdf = osm_link_with_shst_info(osm_link_df, shst_gdf)
+    osm_link_gdf = add_two_way_osm(osm_link_gdf, osmnx_link)
+    fill_value_dict = fill_na_values(osm_link_gdf)
+
+    link_gdf = consolidate_osm_way_to_shst_link(osm_link_gdf)
+
+    return link_gdf, shst_gdf.drop("metadata", axis = 1), fill_value_dict
+
+
+def _shst_extract_to_link_worker(shst_file):
+    """
+    shst_extract_to_link with the worker's osmnx links
+    """
+    return shst_extract_to_link(shst_file, _worker_osmnx_link)
+
+
+def merge_fill_na_values(fill_value_dict_list):
+    """
+    fill values of the columns of the files concatenated, from the fill_na_values of each file:
+    a column is numeric (filled with 0) if it is numeric in every file that has it, str (filled with "") if it is
+    str in any file, as the dtype of the concatenated column would be (e.g. 0.0 if it is float in one file)
+    """
+    fill_value_dict = {}
+    for file_fill_value_dict in fill_value_dict_list:
+        for c, value in file_fill_value_dict.items():
+            if (c not in fill_value_dict) or (value == ""):
+                fill_value_dict[c] = value
+            elif fill_value_dict[c] != "":
+                fill_value_dict[c] = np.result_type(type(fill_value_dict[c]), type(value)).type(0).item()
+
+    return fill_value_dict
+
+
+def merge_link_partitions(link_gdf_list, shape_gdf_list):
+    """
+    merge the shst links and geometries of the boundary files, deterministically on shst ids
+
+    shst geometries in the buffer area along the boundaries come out of more than one file; the first by file
+    order is kept, same as read_shst_extract(drop_duplicates = True). links are ordered like
+    consolidate_osm_way_to_shst_link orders the regional links (forward links, then backward links, each sorted by
+    shst ids), so that one link per shstReferenceId is kept as in the regional run
+
+    Parameters
+    ------------
+    link_gdf_list: shst links of each file, in file order
+    shape_gdf_list: shst geometries of each file, in file order
+
+    return
+    ------------
+    shst links, one per shstReferenceId; shst geometries, one per SHST_DUPLICATE_SUBSET
+    """
+    shst_link_keys = ["shstReferenceId", "id", "shstGeometryId", "fromIntersectionId", "toIntersectionId"]
+
+    shape_gdf = pd.concat(shape_gdf_list, ignore_index = True, sort = False)
+    shape_gdf = shape_gdf.drop_duplicates(subset = SHST_DUPLICATE_SUBSET)
+
+    link_gdf = pd.concat(link_gdf_list, ignore_index = True, sort = False)
+    link_gdf["_backward"] = link_gdf["forward"].isnull()
+    link_gdf = link_gdf.drop_duplicates(subset = ["_backward"] + shst_link_keys)
+    link_gdf = link_gdf.sort_values(["_backward"] + shst_link_keys, kind = "stable")
+    link_gdf = link_gdf.drop_duplicates(subset = ["shstReferenceId"])
+    link_gdf = link_gdf.drop("_backward", axis = 1).reset_index(drop = True)
+
+    return gpd.GeoDataFrame(link_gdf, crs = {'init': 'epsg:4326'}), shape_gdf
+
+
+def shst_extract_to_link_by_boundary(path, suffix, osmnx_link, highway_to_roadway_dict, roadway_hierarchy_dict,
+                                     network_type_df, processes = 1):
+    """
+    step 3 transforms run one shst extraction file (one boundary) at a time, in worker processes,
+    and merged with merge_link_partitions. NAs are then filled, roadway classified and network type added
+    on the merged links
+
+    peak memory of the transforms is that of one boundary rather than the region, and with processes > 1
+    the boundaries are processed in parallel
+
+    Parameters
+    ------------
+    path: folder of shst extraction, searched recursively
+    suffix: file name pattern, e.g. "*.out.geojson"
+    osmnx_link: osmnx links, see add_two_way_osm
+    highway_to_roadway_dict, roadway_hierarchy_dict: see highway_attribute_to_roadway
+    network_type_df: network type variables by roadway
+    processes: number of worker processes, 1 runs the boundaries in this process one after the other
+
+    return
+    ------------
+    shst links, one per shstReferenceId; shst geometries, without duplicates
+    """
+    shst_file = glob.glob(path + "**/" + suffix, recursive = True)
+
+    # workers only need the osm way attributes
+    osmnx_link = pd.DataFrame(osmnx_link.drop(["length", "u", "v", "geometry"], axis = 1)
+                              .drop_duplicates(subset = ["osmid"]))
+
+    if processes > 1:
+        with ProcessPoolExecutor(max_workers = processes,
+                                 initializer = _init_shst_partition_worker,
+                                 initargs = (osmnx_link,)) as executor:
+            result_list = list(executor.map(_shst_extract_to_link_worker, shst_file))
+    else:
+        result_list = [shst_extract_to_link(i, osmnx_link) for i in shst_file]
+
+    for file, (link_gdf, _, _) in zip(shst_file, result_list):
+        print(file, " has ", len(link_gdf), " links")
+
+    link_gdf, shape_gdf = merge_link_partitions([r[0] for r in result_list], [r[1] for r in result_list])
+
+    # only the osm way columns, the columns added by consolidate_osm_way_to_shst_link (e.g. forward) keep their NaN
+    link_gdf = fill_na(link_gdf, merge_fill_na_values([r[2] for r in result_list]), fill_lists = True)
+
+    link_gdf["roadway"] = highway_attribute_to_roadway(link_gdf, highway_to_roadway_dict, roadway_hierarchy_dict)
+    link_gdf = pd.merge(link_gdf,
+                        network_type_df,
+                        how = "left",
+                        on = "roadway")
+
+    return link_gdf, shape_gdf
+
+
+def highway_attribute_list_to_value(x, highway_to_roadway_dict, roadway_hierarchy_dict):
+    """
+    clean up osm highway, and map to standard roadway
+    """
+    if type(x.highway) == list:
+        value_list = list(set([highway_to_roadway_dict[c] for c in x.highway]))
+        if len(value_list) == 1:
+            if value_list[0] != "":
+                return value_list[0]
+            else:
+                if type(x.roadClass) == list:
+                    return highway_to_roadway_dict[x.roadClass[0].lower()]
+                else:
+                    return highway_to_roadway_dict[x.roadClass.lower()]
+
+        else:
+            ret_val = value_list[0]
+            ret_val_level = roadway_hierarchy_dict[ret_val]
+            for c in value_list:
+                val_level = roadway_hierarchy_dict[c]
+                if val_level < ret_val_level:
+                    ret_val = c
+                    ret_val_level = val_level
+                else:
+                    continue
+            return ret_val
+    else:
+        if x.highway == "":
+            return highway_to_roadway_dict[x.roadClass.lower()]
+        else:
+            return highway_to_roadway_dict[x.highway]
+        
+
+def highway_attribute_to_roadway(link_df, highway_to_roadway_dict, roadway_hierarchy_dict):
+    """
+    map osm highway to standard roadway for all links at once, same result as
+    link_df.apply(highway_attribute_list_to_value, axis = 1)
+
+    highway values (single or list) are flattened with their link position, coded against the
+    highway_to_roadway_dict keys, and each link takes its one roadway, or the highest ranked of its roadways
+    by roadway_hierarchy_dict. links with no roadway from highway fall back to roadClass.
+    between roadways of equal rank, the first in the highway list is taken
+
+    Parameters
+    ----------
+    link_df: links with highway and roadClass, single value or list
+    highway_to_roadway_dict: osm highway to roadway
+    roadway_hierarchy_dict: roadway to rank, lower ranks first
+
+    return
+    ----------
+    array of roadway, one per link
+    """
+    highway = link_df["highway"].reset_index(drop = True)
+    is_list = highway.map(type).values == list
+
+    # flattened highway values, with the position of their link
+    flat_highway = highway.explode()
+    flat_link = flat_highway.index.values
+
+    highway_category = pd.Index(list(highway_to_roadway_dict.keys()))
+    flat_code = highway_category.get_indexer(flat_highway.values)
+    if (flat_code == -1).any():
+        raise KeyError(flat_highway[flat_code == -1].unique().tolist())
+
+    # roadway and rank table of each highway code
+    roadway_code, roadway_category = pd.factorize(pd.Series(list(highway_to_roadway_dict.values()), dtype = object))
+    roadway_rank = pd.to_numeric(pd.Series(roadway_category).map(roadway_hierarchy_dict), errors = "coerce").values
+    flat_roadway = roadway_code[flat_code]
+
+    # distinct roadways of each link, lowest rank first, then first in the list
+    flat_rank = roadway_rank[flat_roadway]
+    pair_order = np.lexsort((np.arange(len(flat_link)), flat_rank, flat_link))
+    pair_link = flat_link[pair_order]
+    pair_roadway = flat_roadway[pair_order]
+    first_pair = np.r_[True, pair_link[1:] != pair_link[:-1]]
+
+    distinct_pair_df = pd.DataFrame({"link" : flat_link, "roadway" : flat_roadway}).drop_duplicates()
+    num_roadway = np.bincount(distinct_pair_df["link"].values, minlength = len(highway))
+
+    multi_roadway = num_roadway > 1
+    if np.isnan(roadway_rank[distinct_pair_df["roadway"].values[multi_roadway[distinct_pair_df["link"].values]]]).any():
+        raise KeyError("roadway without hierarchy")
+
+    roadway = np.asarray(roadway_category, dtype = object)[pair_roadway[first_pair]]
+
+    # no roadway from highway: roadClass
+    use_road_class = np.where(is_list, (num_roadway == 1) & (roadway == ""), highway.values == "")
+    if use_road_class.any():
+        road_class = link_df["roadClass"].reset_index(drop = True)[use_road_class]
+        road_class = road_class.mask(road_class.map(type) == list, road_class.str[0]).str.lower()
+        if not road_class.isin(highway_category).all():
+            raise KeyError(road_class[~road_class.isin(highway_category)].unique().tolist())
+        roadway[use_road_class] = road_class.map(highway_to_roadway_dict).values
+
+    return roadway
+
+
+def ox_graph(nodes_df, links_df):
+    """
+        create an osmnx-flavored network graph
+        osmnx doesn't like values that are arrays, so remove the variables
+        that have arrays.  osmnx also requires that certain variables
+        be filled in, so do that too.
+        Parameters
+        ----------
+        nodes_df : GeoDataFrame
+        link_df : GeoDataFrame
+        Returns
+        -------
+        networkx multidigraph
+
+        NetworkGraph keeps the same network in typed arrays, at a fraction of the memory
+    """
+    try:
+        graph_nodes = nodes_df.drop(
+                ["inboundReferenceId", "outboundReferenceId"], axis=1
+            )
+    except:
+        graph_nodes = nodes_df.copy()
+
+    graph_nodes.gdf_name = "network_nodes"
+    graph_nodes['id'] = graph_nodes['shst_node_id']
+
+    graph_links = links_df.copy()
+    graph_links['id'] = graph_links['shstReferenceId']
+    graph_links['key'] = graph_links['shstReferenceId']
+
+    G = ox.gdfs_to_graph(graph_nodes, graph_links)
+
+    return G
+
+
+def _compact_attribute_df(df, columns = None):
+    """
+    copy of the attribute columns of df for NetworkGraph
+
+    geometry and list valued columns are left out, strings repeated on most rows become categorical
+    """
+    if columns is None:
+        columns = [c for c in df.columns if c != "geometry"]
+
+    attribute_dict = {}
+    for column in columns:
+        values = df[column]
+        if pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values):
+            sample = values.dropna()
+            if (len(sample) > 0) and isinstance(sample.iloc[0], (list, tuple, dict, np.ndarray, BaseGeometry)):
+                continue
+            if values.nunique() < len(values) / 2:
+                values = values.astype("category")
+        attribute_dict[column] = values.values
+
+    return pd.DataFrame(attribute_dict)
+
+
+def _adjacency(link_node, num_node):
+    """
+    csr style index of links by node: links of node i are link[ptr[i] : ptr[i + 1]]
+    """
+    link = np.argsort(link_node, kind = "stable").astype(np.int32)
+    ptr = np.r_[0, np.cumsum(np.bincount(link_node, minlength = num_node))].astype(np.int64)
+
+    return ptr, link
+
+
+def _csr_routing_matrix(u_index, v_index, w, num_node):
+    """
+    csr matrix of link weight between node indices, parallel links keep the smallest weight
+    """
+    # csgraph drops zero weight entries, keep them as links
+    w = np.maximum(np.nan_to_num(w.astype(float)), 1e-9)
+
+    order = np.lexsort((w, v_index, u_index))
+    u_index, v_index, w = u_index[order], v_index[order], w[order]
+    first = np.r_[True, (u_index[1:] != u_index[:-1]) | (v_index[1:] != v_index[:-1])]
+
+    return csr_matrix((w[first], (u_index[first], v_index[first])), shape = (num_node, num_node))
+
+
+class NetworkGraph(object):
+    """
+    compact directed multigraph of a roadway network, in place of the networkx graph of ox_graph
+
+    nodes are numbered 0..n-1 in osm_node_id order and links 0..m-1 in links_df order.
+    link attributes are typed columns of self.link, row i is link i, from node self.link_u[i]
+    to node self.link_v[i]. out links of node i are self.out_link[self.out_ptr[i] : self.out_ptr[i + 1]],
+    in links likewise with in_ptr and in_link
+
+    Parameters
+    ----------
+    nodes_df: nodes with osm_node_id, and optionally shst_node_id, model_node_id
+    links_df: links with u, v (osm node id)
+    node_columns, link_columns: attribute columns to keep, default all but geometry and list valued columns
+    """
+
+    def __init__(self, nodes_df, links_df, node_columns = None, link_columns = None):
+        node_id = nodes_df["osm_node_id"].values.astype(np.int64)
+        node_order = np.argsort(node_id, kind = "stable")
+        self.node_id = node_id[node_order]
+        if np.any(self.node_id[1:] == self.node_id[:-1]):
+            raise ValueError("osm_node_id is not unique in nodes_df")
+
+        self.node = _compact_attribute_df(nodes_df.iloc[node_order], node_columns)
+        self._node_index_dict = {}
+
+        u_index = self.node_index(links_df["u"].values)
+        v_index = self.node_index(links_df["v"].values)
+        known = (u_index >= 0) & (v_index >= 0)
+        if not known.all():
+            print('  {} links with u or v not in the nodes are left out'.format((~known).sum()))
+
+        self.link = _compact_attribute_df(links_df[known], link_columns)
+        self.link_u = u_index[known].astype(np.int32)
+        self.link_v = v_index[known].astype(np.int32)
+
+        self.out_ptr, self.out_link = _adjacency(self.link_u, self.num_node)
+        self.in_ptr, self.in_link = _adjacency(self.link_v, self.num_node)
+
+    @property
+    def num_node(self):
+        return len(self.node_id)
+
+    @property
+    def num_link(self):
+        return len(self.link_u)
+
+    @property
+    def out_degree(self):
+        return np.diff(self.out_ptr)
+
+    @property
+    def in_degree(self):
+        return np.diff(self.in_ptr)
+
+    def node_index(self, ids, by = "osm_node_id"):
+        """
+        node index of an array of osm_node_id, shst_node_id or model_node_id, -1 if not in the graph
+        """
+        if by == "osm_node_id":
+            ids = np.asarray(ids, dtype = np.int64)
+            index = np.searchsorted(self.node_id, ids).clip(0, max(self.num_node - 1, 0))
+            return np.where((self.num_node > 0) & (self.node_id[index] == ids), index, -1)
+
+        if by not in self._node_index_dict:
+            self._node_index_dict[by] = pd.Index(np.asarray(self.node[by]))
+
+        return self._node_index_dict[by].get_indexer(np.asarray(ids))
+
+    def out_links(self, node):
+        """
+        link indices leaving node index
+        """
+        return self.out_link[self.out_ptr[node] : self.out_ptr[node + 1]]
+
+    def in_links(self, node):
+        """
+        link indices entering node index
+        """
+        return self.in_link[self.in_ptr[node] : self.in_ptr[node + 1]]
+
+    def routing_graph(self, weight = "length"):
+        """
+        (csr_matrix, node id array) routing graph on a link column, as build_csr_graph, for shortest_path_links
+        """
+        return _csr_routing_matrix(self.link_u, self.link_v, self.link[weight].values, self.num_node), self.node_id
+
+    def component_labels(self, connection = "weak"):
+        """
+        connected component label of each node index, connection "weak" or "strong"
+        """
+        adjacency = csr_matrix((np.ones(self.num_link), (self.link_u, self.link_v)),
+                               shape = (self.num_node, self.num_node))
+        _, labels = connected_components(adjacency, directed = True, connection = connection)
+
+        return labels
+
+    def to_networkx(self, node_columns = None, link_columns = None):
+        """
+        networkx MultiDiGraph keyed by osm_node_id, link keys shstReferenceId as in ox_graph
+
+        Parameters
+        ----------
+        node_columns, link_columns: attributes to copy to the networkx graph, default all
+
+        return
+        ----------
+        networkx multidigraph
+        """
+        node_attribute_df = self.node if node_columns is None else self.node[node_columns]
+        link_attribute_df = self.link if link_columns is None else self.link[link_columns]
+
+        if "shstReferenceId" in self.link.columns:
+            link_key = np.asarray(self.link["shstReferenceId"])
+        else:
+            link_key = np.arange(self.num_link)
+
+        G = nx.MultiDiGraph()
+        G.add_nodes_from(zip(self.node_id.tolist(), node_attribute_df.to_dict("records")))
+        G.add_edges_from(zip(self.node_id[self.link_u].tolist(),
+                             self.node_id[self.link_v].tolist(),
+                             link_key.tolist(),
+                             link_attribute_df.to_dict("records")))
+
+        return G
+
+
+def build_csr_graph(link_df, weight = "length"):
+    """
+    build a compact routing graph from link u, v and weight arrays, in place of the osmnx graph
+
+    nodes are numbered 0..n-1 in sorted osm node id order, parallel links keep the smallest weight,
+    like nx.shortest_path does on a MultiDiGraph
+
+    Parameters
+    ----------
+    link_df: links with u, v (osm node id) and weight column
+    weight: link weight column
+
+    return
+    ----------
+    (scipy.sparse csr_matrix of link weight, array of osm node id by node index)
+    """
+    u = link_df["u"].values.astype(np.int64)
+    v = link_df["v"].values.astype(np.int64)
+
+    node_id = np.unique(np.concatenate([u, v]))
+    u_index = np.searchsorted(node_id, u)
+    v_index = np.searchsorted(node_id, v)
+
+    graph = _csr_routing_matrix(u_index, v_index, link_df[weight].values, len(node_id))
+
+    return graph, node_id
+
+
+def shortest_path_links(graph, from_node, to_node, chunk_size = None, limit = np.inf):
+    """
+    shortest paths between arrays of (from_node, to_node) osm node ids on a graph from build_csr_graph
+
+    runs one single-source dijkstra per distinct from node, chunk_size sources at a time,
+    and reconstructs each path from the predecessors
+
+    Parameters
+    ----------
+    graph: (csr_matrix, node id array) from build_csr_graph
+    from_node, to_node: arrays of osm node id, one entry per pair
+    chunk_size: number of sources searched together, each chunk holds dense (chunk_size x number of nodes)
+        distance and predecessor arrays, 12 bytes per entry. None sizes it to ROUTE_CHUNK_MEMORY, at most 64
+    limit: max path length searched, pairs further apart are not found
+
+    return
+    ----------
+    found: bool array, one per pair, False if a node is not in the graph or there is no path
+    pair_index, u, v: arrays with one entry per link of every found path, in path order
+    """
+    csr, node_id = graph
+    from_node = np.asarray(from_node, dtype = np.int64)
+    to_node = np.asarray(to_node, dtype = np.int64)
+
+    from_index = np.searchsorted(node_id, from_node).clip(0, len(node_id) - 1)
+    to_index = np.searchsorted(node_id, to_node).clip(0, len(node_id) - 1)
+    found = (node_id[from_index] == from_node) & (node_id[to_index] == to_node)
+
+    if chunk_size is None:
+        chunk_size = min(64, ROUTE_CHUNK_MEMORY // (12 * max(1, len(node_id))))
+    chunk_size = max(1, int(chunk_size))
+
+    pair_index_list = []
+    path_list = []
+
+    # pairs sorted by source once, each chunk of sources is then a contiguous slice
+    pair_order = np.flatnonzero(found)
+    pair_order = pair_order[np.argsort(from_index[pair_order], kind = "stable")]
+    pair_source = from_index[pair_order]
+
+    source_list = np.unique(pair_source)
+    for chunk_start in range(0, len(source_list), chunk_size):
+        sources = source_list[chunk_start : chunk_start + chunk_size]
+        dist, pred = dijkstra(csr, directed = True, indices = sources, return_predecessors = True, limit = limit)
+
+        chunk_pair = pair_order[np.searchsorted(pair_source, sources[0], side = "left") :
+                                np.searchsorted(pair_source, sources[-1], side = "right")]
+        source_row = np.searchsorted(sources, from_index[chunk_pair])
+        reached = np.isfinite(dist[source_row, to_index[chunk_pair]])
+        found[chunk_pair[~reached]] = False
+
+        for p, row in zip(chunk_pair[reached], source_row[reached]):
+            pred_row = pred[row]
+            path = [to_index[p]]
+            while path[-1] != from_index[p]:
+                path.append(pred_row[path[-1]])
+            pair_index_list.append(np.full(len(path) - 1, p))
+            path_list.append(np.array(path[::-1]))
+
+    if len(path_list) > 0:
+        pair_index = np.concatenate(pair_index_list)
+        u = np.concatenate([path[:-1] for path in path_list])
+        v = np.concatenate([path[1:] for path in path_list])
+    else:
+        pair_index = u = v = np.array([], dtype = np.int64)
+
+    # pairs were routed by source chunk, return them in pair order
+    order = np.argsort(pair_index, kind = "stable")
+
+    return found, pair_index[order], node_id[u[order]], node_id[v[order]]
+
+
+def _expand_ranges(start, count):
+    """
+    positions start[i], ..., start[i] + count[i] - 1 of all ranges, concatenated
+    """
+    return np.repeat(start - (np.cumsum(count) - count), count) + np.arange(count.sum())
+
+
+def graph_link_table(graph):
+    """
+    links of a graph from build_csr_graph
+
+    return
+    ----------
+    u, v (osm node id) and weight arrays, one entry per link
+    """
+    csr, node_id = graph
+    u_index = np.repeat(np.arange(len(node_id)), np.diff(csr.indptr))
+    return node_id[u_index], node_id[csr.indices], csr.data
+
+
+def path_length(graph, pair_index, u, v, num_pair):
+    """
+    length of paths on a graph from build_csr_graph, from their links as returned by shortest_path_links
+    """
+    csr, node_id = graph
+    if len(u) == 0:
+        return np.zeros(num_pair)
+    weight = np.asarray(csr[np.searchsorted(node_id, u), np.searchsorted(node_id, v)]).ravel()
+    return np.bincount(pair_index, weights = weight, minlength = num_pair)
+
+
+def _empty_path_table():
+    return {"from" : np.array([], dtype = np.int64),
+            "to" : np.array([], dtype = np.int64),
+            "found" : np.array([], dtype = bool),
+            "length" : np.array([], dtype = float),
+            "link_count" : np.array([], dtype = np.int64),
+            "u" : np.array([], dtype = np.int64),
+            "v" : np.array([], dtype = np.int64)}
+
+
+def _select_paths(path_table, keep):
+    """
+    the pairs of a path table where keep is True, with their links
+    """
+    link_start = np.cumsum(path_table["link_count"]) - path_table["link_count"]
+    link_position = _expand_ranges(link_start[keep], path_table["link_count"][keep])
+    selected = {key : path_table[key][keep] for key in ["from", "to", "found", "length", "link_count"]}
+    selected.update(u = path_table["u"][link_position], v = path_table["v"][link_position])
+    return selected
+
+
+def invalid_route_paths(path_table, cache_graph_link, graph, limit, chunk_size = 64):
+    """
+    pairs of a route path cache whose path may differ on a new graph
+
+    a path is invalid if one of its links is removed or longer. a new or shorter link (a, b) of weight w invalidates
+    the pairs (s, t) with dist(s, a) + w + dist(b, t) shorter than their cached path, or within limit for pairs that
+    had no path; the distances are searched on the new graph, from and to the new links only
+
+    Parameters
+    ----------
+    path_table: cached paths, see read_route_path_cache
+    cache_graph_link: u, v, weight arrays of the graph the paths were routed on, see graph_link_table
+    graph: (csr_matrix, node id array) from build_csr_graph
+    limit: max path length of the routing
+    chunk_size: number of new links searched together
+
+    return
+    ----------
+    bool array, True for the pairs to route again
+    """
+    csr, node_id = graph
+    old_link_df = pd.DataFrame(dict(zip(["u", "v", "old_weight"], cache_graph_link)))
+    new_link_df = pd.DataFrame(dict(zip(["u", "v", "weight"], graph_link_table(graph))))
+    link_df = pd.merge(old_link_df, new_link_df, how = "outer", on = ["u", "v"])
+    worse_link_df = link_df[link_df["weight"].isnull() | (link_df["weight"] > link_df["old_weight"])]
+    better_link_df = link_df[link_df["old_weight"].isnull() | (link_df["weight"] < link_df["old_weight"])]
+
+    num_pair = len(path_table["from"])
+    if len(better_link_df) > ROUTE_CACHE_MAX_NEW_LINKS:
+        return np.ones(num_pair, dtype = bool)
+
+    # paths over a removed or longer link
+    path_pair = np.repeat(np.arange(num_pair), path_table["link_count"])
+    worse_key = pd.MultiIndex.from_frame(worse_link_df[["u", "v"]].astype(np.int64))
+    uses_worse = pd.MultiIndex.from_arrays([path_table["u"], path_table["v"]]).isin(worse_key)
+    invalid = np.zeros(num_pair, dtype = bool)
+    invalid[path_pair[uses_worse]] = True
+
+    # pairs on one node are found if the node is in the graph
+    same_node = path_table["from"] == path_table["to"]
+    invalid |= same_node & (path_table["found"] != np.isin(path_table["from"], node_id))
+
+    # pairs a new or shorter link could shorten
+    from_index = np.searchsorted(node_id, path_table["from"]).clip(0, len(node_id) - 1)
+    to_index = np.searchsorted(node_id, path_table["to"]).clip(0, len(node_id) - 1)
+    in_graph = (node_id[from_index] == path_table["from"]) & (node_id[to_index] == path_table["to"]) & ~same_node
+    bound = np.where(path_table["found"], path_table["length"] - 1e-9, limit)
+
+    a_index = np.searchsorted(node_id, better_link_df["u"].values.astype(np.int64))
+    b_index = np.searchsorted(node_id, better_link_df["v"].values.astype(np.int64))
+    w = better_link_df["weight"].values
+    csr_reverse = csr.transpose().tocsr()
+    for chunk_start in range(0, len(w), chunk_size):
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+        to_a = dijkstra(csr_reverse, directed = True, indices = a_index[chunk], limit = limit)
+        from_b = dijkstra(csr, directed = True, indices = b_index[chunk], limit = limit)
+        for k in range(len(w[chunk])):
+            via = to_a[k, from_index] + w[chunk][k] + from_b[k, to_index]
+            invalid |= in_graph & (via <= bound)
+
+    return invalid
+
+
+def read_route_path_cache(cache_dir, graph, limit = np.inf):
+    """
+    read the stop pair paths routed on an earlier version of the network, kept if still valid on this graph,
+    see invalid_route_paths
+
+    return
+    ----------
+    dict of arrays: from, to, found, length, link_count one per pair; u, v the links of all pairs, in pair order
+    """
+    cache_file = os.path.join(cache_dir, "route_path.npz")
+    if not os.path.exists(cache_file):
+        return _empty_path_table()
+
+    with np.load(cache_file) as cache:
+        cache = {key : cache[key] for key in cache.files}
+    path_table = dict((key, cache[key]) for key in _empty_path_table())
+    if float(cache["limit"]) != float(limit):
+        return _empty_path_table()
+
+    invalid = invalid_route_paths(path_table,
+                                  (cache["link_u"], cache["link_v"], cache["link_weight"]),
+                                  graph,
+                                  limit)
+    print("  {} cached stop pairs, {} invalidated by network changes".format(len(invalid), invalid.sum()))
+
+    return _select_paths(path_table, ~invalid)
+
+
+def write_route_path_cache(cache_dir, path_table, graph, limit = np.inf):
+    """
+    write the stop pair paths of read_route_path_cache, with the links of the graph they were routed on
+    """
+    os.makedirs(cache_dir, exist_ok = True)
+    cache_file = os.path.join(cache_dir, "route_path.npz")
+
+    link_u, link_v, link_weight = graph_link_table(graph)
+
+    # write then rename, so an interrupted run does not leave a broken cache
+    temp_file = cache_file + ".tmp.npz"
+    np.savez(temp_file, link_u = link_u, link_v = link_v, link_weight = link_weight, limit = np.float64(limit),
+             **path_table)
+    os.replace(temp_file, cache_file)
+
+
+# graph of a routing worker process, loaded once by _init_routing_worker
+_worker_graph = None
+
+
+def _save_routing_graph(graph, folder):
+    """
+    write the csr arrays of a graph to .npy files, for the routing workers to memory-map
+    """
+    csr, node_id = graph
+    for name, array in [("data", csr.data), ("indices", csr.indices), ("indptr", csr.indptr), ("node_id", node_id)]:
+        np.save(os.path.join(folder, name + ".npy"), array)
+
+
+def _init_routing_worker(folder):
+    """
+    memory-map the graph written by _save_routing_graph, read-only, so all workers share the same pages
+    """
+    global _worker_graph
+    array = {name : np.load(os.path.join(folder, name + ".npy"), mmap_mode = "r")
+             for name in ["data", "indices", "indptr", "node_id"]}
+    csr = csr_matrix((array["data"], array["indices"], array["indptr"]),
+                     shape = (len(array["node_id"]), len(array["node_id"])),
+                     copy = False)
+    _worker_graph = (csr, array["node_id"])
+
+
+def _shortest_path_links_worker(from_node, to_node, chunk_size, limit):
+    """
+    shortest_path_links on the worker's shared graph
+    """
+    return shortest_path_links(_worker_graph, from_node, to_node, chunk_size = chunk_size, limit = limit)
+
+
+def route_stop_pairs(graph, from_node, to_node, limit = np.inf, processes = 1, pairs_per_task = 2000,
+                     chunk_size = None):
+    """
+    route (from_node, to_node) stop pairs on a graph from build_csr_graph
+
+    with processes > 1, the graph is written once to memory-mapped files shared read-only by a pool of
+    worker processes, and the pairs are spread over the pool about pairs_per_task at a time. pairs are grouped by
+    from node and a task holds whole from nodes, so each source is searched by one worker only.
+    every worker holds the dijkstra arrays of one chunk of sources, so the routing memory is about
+    processes x chunk_size x number of nodes x 12 bytes on top of the shared graph
+
+    Parameters
+    ----------
+    graph: (csr_matrix, node id array) from build_csr_graph
+    from_node, to_node: arrays of osm node id, one entry per pair
+    limit: max path length between two stops
+    processes: number of worker processes, 1 routes in this process
+    pairs_per_task: number of pairs sent to a worker at a time
+    chunk_size: see shortest_path_links, None sizes it from the number of nodes
+
+    return
+    ----------
+    dict of arrays: from, to, found, length, link_count one per pair; u, v the links of all pairs, in pair order
+    """
+    from_node = np.asarray(from_node, dtype = np.int64)
+    to_node = np.asarray(to_node, dtype = np.int64)
+
+    # stops snapped to the same node need no routing, they are found if the node is in the network
+    found = np.isin(from_node, graph[1])
+    to_route = np.flatnonzero(from_node != to_node)
+
+    if (processes > 1) & (len(to_route) > pairs_per_task):
+        # group the pairs by from node, and cut the tasks at from node boundaries
+        by_origin = np.argsort(from_node[to_route], kind = "stable")
+        origin = from_node[to_route[by_origin]]
+        origin_start = np.flatnonzero(np.r_[True, origin[1:] != origin[:-1]])
+        task_start = origin_start[np.searchsorted(origin_start, np.arange(0, len(to_route), pairs_per_task))
+                                  .clip(0, len(origin_start) - 1)]
+        task_start = np.unique(task_start)
+        task_end = np.append(task_start[1:], len(to_route))
+        task_pair = [to_route[by_origin[s : e]] for s, e in zip(task_start, task_end)]
+
+        with tempfile.TemporaryDirectory() as folder:
+            _save_routing_graph(graph, folder)
+            with ProcessPoolExecutor(max_workers = processes,
+                                     initializer = _init_routing_worker,
+                                     initargs = (folder,)) as executor:
+                result_list = list(executor.map(_shortest_path_links_worker,
+                                                [from_node[pair] for pair in task_pair],
+                                                [to_node[pair] for pair in task_pair],
+                                                [chunk_size] * len(task_pair),
+                                                [limit] * len(task_pair)))
+
+        # back to pair order, route_pair indexes to_route
+        route_found = np.zeros(len(to_route), dtype = bool)
+        route_found[by_origin] = np.concatenate([result[0] for result in result_list])
+        route_pair = by_origin[np.concatenate([result[1] + s for result, s in zip(result_list, task_start)])]
+        order = np.argsort(route_pair, kind = "stable")
+        route_pair = route_pair[order]
+        route_u = np.concatenate([result[2] for result in result_list])[order]
+        route_v = np.concatenate([result[3] for result in result_list])[order]
+    else:
+        route_found, route_pair, route_u, route_v = shortest_path_links(graph,
+                                                                        from_node[to_route],
+                                                                        to_node[to_route],
+                                                                        chunk_size = chunk_size,
+                                                                        limit = limit)
+
+    found[to_route] = route_found
+    link_count = np.zeros(len(from_node), dtype = np.int64)
+    link_count[to_route] = np.bincount(route_pair, minlength = len(to_route))
+
+    length = np.zeros(len(from_node))
+    length[to_route] = path_length(graph, route_pair, route_u, route_v, len(to_route))
+
+    return {"from" : from_node,
+            "to" : to_node,
+            "found" : found,
+            "length" : length,
+            "link_count" : link_count,
+            "u" : route_u.astype(np.int64),
+            "v" : route_v.astype(np.int64)}
+
+
+def route_bus_link(drive_link_df, graph, stop_times, routes, trip, stop, limit = np.inf, processes = 1,
+                   pairs_per_task = 2000, chunk_size = None, cache_dir = None):
+    """
+    route bus trips between consecutive stops on the drive network, in place of route_bus_link_osmnx
+
+    trips with the same sequence of stop nodes are routed once, and each distinct stop node pair once.
+    with cache_dir, routed pairs are kept on disk with the links of the network they were routed on, so a re-run
+    only routes the pairs that are new, or whose path may change with the edited links (see invalid_route_paths)
+
+    Parameters
+    ----------
+    drive_link_df: drive links
+    graph: build_csr_graph(drive_link_df)
+    stop_times, routes: gtfs
+    trip: representative trips
+    stop: stops snapped to drive nodes (osm_node_id)
+    limit: max path length between two stops
+    processes, pairs_per_task, chunk_size: see route_stop_pairs
+    cache_dir: folder of the route path cache, None for no cache
+
+    return
+    ----------
+    dataframe of drive links bus trips traverses
+    list of trips that could not be routed, the links of their stop pairs before the first failed one are kept
+    """
+    print('routing bus on roadway network...')
+
+    trip_df = pd.merge(trip, routes, how = 'left', on = 'route_id')
+    bus_trip_id = trip_df[trip_df['route_type'] == 3].trip_id.unique()
+
+    trip_stop_df = pd.merge(stop_times[stop_times['trip_id'].isin(bus_trip_id)],
+                            stop[['stop_id', 'osm_node_id']],
+                            how = 'left',
+                            on = 'stop_id')
+
+    # stops of each trip in sequence, trips in the same order as bus_trip_id, stops without node as -1
+    trip_stop_df['trip_order'] = pd.Categorical(trip_stop_df['trip_id'], categories = bus_trip_id).codes
+    trip_stop_df = trip_stop_df.sort_values(by = ['trip_order', 'stop_sequence'], kind = 'mergesort')
+    trip_stop_df['stop_node'] = trip_stop_df['osm_node_id'].fillna(-1).astype(np.int64)
+
+    # trips with the same stop node sequence share a pattern, patterns numbered in trip order
+    trip_node_sequence = trip_stop_df.groupby('trip_order', sort = True)['stop_node'].apply(tuple)
+    trip_pattern, _ = pd.factorize(trip_node_sequence.values)
+    pattern_first_trip = trip_node_sequence.index.values[np.unique(trip_pattern, return_index = True)[1]]
+    print('  {} trips, {} stop patterns'.format(len(trip_pattern), len(pattern_first_trip)))
+
+    pattern_stop_df = trip_stop_df[trip_stop_df['trip_order'].isin(pattern_first_trip)]
+    stop_pattern = np.searchsorted(pattern_first_trip, pattern_stop_df['trip_order'].values)
+    stop_node = pattern_stop_df['stop_node'].values
+
+    # consecutive stop pairs of each pattern
+    is_pair = stop_pattern[1:] == stop_pattern[:-1]
+    pair_pattern = stop_pattern[1:][is_pair]
+    pair_from = stop_node[:-1][is_pair]
+    pair_to = stop_node[1:][is_pair]
+    has_node = (pair_from != -1) & (pair_to != -1)
+
+    # each distinct (from, to) is looked up in the cache, or routed
+    pair_key_df = pd.DataFrame({'from' : pair_from, 'to' : pair_to})
+    pair_code, pair_unique = pd.factorize(pd.MultiIndex.from_frame(pair_key_df))
+
+    if cache_dir is not None:
+        path_table = read_route_path_cache(cache_dir, graph, limit)
+        unique_index = pd.MultiIndex.from_arrays([path_table['from'], path_table['to']]).get_indexer(pair_unique)
+    else:
+        path_table = _empty_path_table()
+        unique_index = np.full(len(pair_unique), -1)
+
+    missing = np.flatnonzero(unique_index == -1)
+    print('  {} stop pairs, {} to route'.format(len(pair_unique), len(missing)))
+
+    if len(missing) > 0:
+        new_path = route_stop_pairs(graph,
+                                    pair_unique.get_level_values(0).values[missing],
+                                    pair_unique.get_level_values(1).values[missing],
+                                    limit = limit,
+                                    processes = processes,
+                                    pairs_per_task = pairs_per_task,
+                                    chunk_size = chunk_size)
+        unique_index[missing] = len(path_table['from']) + np.arange(len(missing))
+        path_table = {key : np.concatenate([path_table[key], new_path[key]]) for key in path_table}
+
+    if cache_dir is not None:
+        write_route_path_cache(cache_dir, path_table, graph, limit)
+
+    table_link_start = np.cumsum(path_table['link_count']) - path_table['link_count']
+    pair_found = path_table['found'][unique_index][pair_code] & has_node
+
+    # a pattern is broken from its first failed pair on
+    pair_position = np.arange(len(pair_pattern))
+    first_failed = pd.Series(np.where(pair_found, len(pair_position), pair_position)).groupby(pair_pattern).transform('min').values
+    keep_pair = pair_position < first_failed
+
+    # links of each pattern, patterns one after another
+    pair_table_index = unique_index[pair_code][keep_pair]
+    pair_link_count = path_table['link_count'][pair_table_index]
+    link_position = _expand_ranges(table_link_start[pair_table_index], pair_link_count)
+    pattern_link_count = np.bincount(pair_pattern[keep_pair], weights = pair_link_count,
+                                     minlength = len(pattern_first_trip)).astype(np.int64)
+    pattern_link_start = np.cumsum(pattern_link_count) - pattern_link_count
+
+    # expand the patterns to their trips
+    trip_link_count = pattern_link_count[trip_pattern]
+    trip_link_position = link_position[_expand_ranges(pattern_link_start[trip_pattern], trip_link_count)]
+    broken_pattern = np.unique(pair_pattern[~pair_found])
+    broken_trip_order = trip_node_sequence.index.values[np.isin(trip_pattern, broken_pattern)]
+
+    broken_shape_trip_list = bus_trip_id[broken_trip_order].tolist()
+    for trip_id in broken_shape_trip_list:
+        print('  warning: cannot route bus: ' + str(trip_id))
+
+    trip_link_shape_df = pd.DataFrame({'u' : path_table['u'][trip_link_position],
+                                       'v' : path_table['v'][trip_link_position],
+                                       'trip_id' : np.repeat(bus_trip_id[trip_node_sequence.index.values],
+                                                             trip_link_count)})
+
+    trip_link_shape_df = pd.merge(trip_link_shape_df, trip_df[['trip_id', 'shape_id']], how = 'left', on = 'trip_id')
+
+    trip_link_shape_df = pd.merge(trip_link_shape_df,
+                                  drive_link_df[["u", "v", "wayId", "shstReferenceId", "shstGeometryId", "A", "B"]].\
+                                      drop_duplicates(subset = ["u", "v"]),
+                                  how = "left",
+                                  on = ["u", "v"])
+
+    return trip_link_shape_df, broken_shape_trip_list
+
+
+def reproject(link, node, epsg):
+    """
+    reporoject link and node geodataframes
+    
+    for nodes, update X and Y columns
+    
+    """
+    
+    link = link.to_crs(epsg = epsg)
+    node = node.to_crs(epsg = epsg)
+    
+    node['X'] = node['geometry'].x
+    node['Y'] = node['geometry'].y
+
+    return link, node
+
+
+def num_of_drive_loadpoint_per_centroid(existing_drive_cc_df, existing_node_gdf):
+    """
+    decide number of loading point for drive access per centroid
+    
+    logic: for drive, find the closest points to the existing loading point
+    
+    return: 
+    dataframe
+    for each existing drive loading point, number of new loading point needs to be generated. currently set to 1.
+    
+    """
+    existing_pairs_of_centroid_loadpoint_df = existing_drive_cc_df.groupby(['c', 'non_c']).count().reset_index().drop(['A','B'], axis = 1)
+    
+    existing_num_of_loadpoint_per_c_df = existing_drive_cc_df.groupby(['c', 'non_c']).count().groupby('c').count()[['A']].rename(columns = {'A':'abm_num_load'}).reset_index()
+    
+    num_drive_loadpoint_new_near_old = pd.merge(existing_pairs_of_centroid_loadpoint_df,
+                                                        existing_num_of_loadpoint_per_c_df,
+                                                        how = 'left',
+                                                        on = 'c')
+    
+    num_drive_loadpoint_new_near_old['osm_num_load'] = 1
+    
+    num_drive_loadpoint_new_near_old = pd.merge(num_drive_loadpoint_new_near_old,
+                                                        existing_node_gdf[['N', 'X', 'Y']],
+                                                        how = 'left',
+                                                        left_on = 'non_c',
+                                                        right_on = 'N')
+    return num_drive_loadpoint_new_near_old
+
+
+def num_of_walk_bike_loadpoint_per_centroid(existing_centroid_df):
+    """
+    decide number of loading point for walk and bike access per centroid
+    
+    logic: find 5 closest points to centroid
+    
+    return: 
+    dataframe
+    for each centroid, number of loading point needs to be generated.
+    
+    """
+    
+    num_loadpoint = existing_centroid_df[['N', 'X', 'Y']].copy()
+    num_loadpoint['osm_num_load'] = np.int(5)
+    num_loadpoint.rename(columns = {'N':'c'}, inplace = True)
+    
+    return num_loadpoint
+
+
+def find_new_load_point(abm_load_ref_df, all_node):
+    """
+    find the loading points in osm nodes
+    
+    input: osm node, loading point reference input
+    
+    output:  dataframe of pairs of centroid and loading point, with point geometry of loading point
+    
+    works in epsg = 26915
+
+    queries are batched: without a "c" column in the osm nodes, all queries with the same number of
+    loading points go to one global tree in one call; with a "c" column, the tree of each centroid's
+    nodes is built at most once and queried once per number of loading points.
+    if a centroid has fewer candidate nodes than loading points asked for, all of its nodes are returned.
+    
+    """
+    
+    all_node_gdf = all_node.to_crs(epsg = 26915)
+    node_xy = np.column_stack([all_node_gdf["geometry"].x.values, all_node_gdf["geometry"].y.values])
+    
+    ref_xy = abm_load_ref_df[['X', 'Y']].values.astype(float)
+    ref_c = abm_load_ref_df['c'].values
+    ref_k = abm_load_ref_df['osm_num_load'].values.astype(int)
+    
+    # (query row, neighbor rank, node position) of each loading point found
+    ref_row_list = []
+    rank_list = []
+    node_row_list = []
+    
+    def _query(tree, node_row, query_row, k):
+        dd, ii = tree.query(ref_xy[query_row], k = k)
+        ii = ii.reshape(len(query_row), k)
+        found = ii < len(node_row)
+        ref_row_list.append(np.repeat(query_row, k)[found.ravel()])
+        rank_list.append(np.tile(np.arange(k), len(query_row))[found.ravel()])
+        node_row_list.append(node_row[ii[found]])
+    
+    if "c" in all_node_gdf.columns:
+        node_row_by_c = all_node_gdf.groupby("c").indices
+        tree_by_c = {}
+        query_row_by_c_k = pd.DataFrame({"c" : ref_c, "k" : ref_k}).groupby(["c", "k"]).indices
+        for (c_id, k), query_row in query_row_by_c_k.items():
+            node_row = node_row_by_c.get(c_id)
+            if node_row is None:
+                continue
+            if c_id not in tree_by_c:
+                tree_by_c[c_id] = cKDTree(node_xy[node_row])
+            _query(tree_by_c[c_id], node_row, query_row, k)
+    else:
+        tree_default = cKDTree(node_xy)
+        node_row = np.arange(len(node_xy))
+        for k in np.unique(ref_k):
+            _query(tree_default, node_row, np.flatnonzero(ref_k == k), k)
+    
+    if len(ref_row_list) > 0:
+        ref_row = np.concatenate(ref_row_list)
+        rank = np.concatenate(rank_list)
+        node_row = np.concatenate(node_row_list)
+    else:
+        ref_row = rank = node_row = np.array([], dtype = int)
+    
+    # same order as looping over the reference rows, nearest loading point first
+    order = np.lexsort((rank, ref_row))
+    
+    new_load_point_df = pd.DataFrame(
+        all_node_gdf[['osm_node_id', "shst_node_id", "model_node_id", 'geometry']].iloc[node_row[order]]
+    ).reset_index(drop = True)
+    new_load_point_df['c'] = ref_c[ref_row[order]].astype(int)
+    
+    return new_load_point_df.rename(columns = {'geometry' : 'geometry_ld'})
+
+
+def build_node_tree(node_gdf, mode = None, epsg = 26915):
+    """
+    build the KD-tree of roadway nodes used to snap gtfs stops, once, for reuse across agencies
+
+    Parameters
+    ------------
+    node_gdf: roadway nodes
+    mode: None to use all nodes, or "drive" / "walk" / "bike" to use the nodes with [mode]_access == 1
+    epsg: projected crs (in meters) the tree is built in
+
+    return
+    ------------
+    (cKDTree, node ids in tree order, epsg), to pass to snap_stop_to_node as node_tree
+    """
+    if mode is not None:
+        node_gdf = node_gdf[node_gdf[mode + "_access"] == 1]
+
+    node_proj_gdf = node_gdf.to_crs(epsg = epsg)
+    tree = cKDTree(np.column_stack([node_proj_gdf["geometry"].x.values, node_proj_gdf["geometry"].y.values]))
+
+    node_id_df = pd.DataFrame(node_gdf[['osm_node_id', 'shst_node_id', 'model_node_id']]).reset_index(drop = True)
+
+    return tree, node_id_df, epsg
+
+
+def snap_stop_to_node(stops, node_gdf = None, node_tree = None, max_distance = None):
+    """
+    map gtfs stops to roadway nodes, all stops in one vectorized tree query
+
+    Parameters:
+    ------------
+    stops: gtfs stops with stop_lon, stop_lat, can be the stops of all agencies
+    node_gdf: roadway nodes to snap to, used to build the tree if node_tree is not given
+    node_tree: tree from build_node_tree, e.g. one for drive nodes and one for walk nodes, reused across calls
+    max_distance: stops further than this (meters) from any node get no node, None for no cutoff
+
+    return
+    ------------
+    stops with node id (osm_node_id, shst_node_id, model_node_id) and snap_distance (meters)
+    """
+    print('snapping gtfs stops to roadway node osmid...')
+
+    if node_tree is None:
+        node_tree = build_node_tree(node_gdf)
+    tree, node_id_df, epsg = node_tree
+
+    stop_df = stops.copy()
+    stop_point = gpd.GeoSeries(gpd.points_from_xy(stop_df['stop_lon'], stop_df['stop_lat']),
+                               crs = {'init' : 'epsg:4326'}).to_crs(epsg = epsg)
+
+    dd, ii = tree.query(np.column_stack([stop_point.x.values, stop_point.y.values]),
+                        k = 1,
+                        distance_upper_bound = np.inf if max_distance is None else max_distance)
+
+    # a stop beyond max_distance comes back with index len(node_id_df)
+    found = ii < len(node_id_df)
+    ii = np.where(found, ii, 0)
+
+    for c in ['osm_node_id', 'shst_node_id', 'model_node_id']:
+        node_id = pd.Series(node_id_df[c].values[ii], index = stop_df.index)
+        stop_df[c] = node_id if found.all() else node_id.where(found)
+    stop_df['snap_distance'] = dd
+
+    return stop_df
+
+
+def _crs_key(crs):
+    """
+    hashable key of a crs given as dict, string, epsg code or pyproj.CRS
+    """
+    if isinstance(crs, dict):
+        return tuple(sorted(crs.items()))
+    if hasattr(crs, "to_wkt"):
+        return crs.to_wkt()
+
+    return crs
+
+
+def get_transformer(from_crs, to_crs):
+    """
+    pyproj transformer between two crs, built once per (from_crs, to_crs) pair and cached
+
+    Parameters
+    ----------
+    from_crs, to_crs: dict, string, epsg code or pyproj.CRS
+
+    return
+    ----------
+    pyproj.Transformer, x as longitude / easting
+    """
+    key = (_crs_key(from_crs), _crs_key(to_crs))
+
+    if key not in TRANSFORMER_CACHE:
+        TRANSFORMER_CACHE[key] = pyproj.Transformer.from_crs(pyproj.CRS.from_user_input(from_crs),
+                                                             pyproj.CRS.from_user_input(to_crs),
+                                                             always_xy = True)
+
+    return TRANSFORMER_CACHE[key]
+
+
+def transform_geometry(geometry, from_crs, to_crs):
+    """
+    project an array of shapely geometries, all coordinates in one transform
+
+    Parameters
+    ----------
+    geometry: array or GeoSeries of shapely geometries
+    from_crs, to_crs: dict, string, epsg code or pyproj.CRS
+
+    return
+    ----------
+    array of projected geometries
+    """
+    transformer = get_transformer(from_crs, to_crs)
+
+    def _transform(coords):
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([x, y])
+
+    return shapely.transform(np.asarray(geometry), _transform)
+
+
+def _transform_xy(x, y, from_epsg, to_epsg):
+    """
+    project coordinate arrays between two epsg codes, x as longitude / easting
+    """
+    transformer = get_transformer("epsg:{}".format(from_epsg), "epsg:{}".format(to_epsg))
+
+    return transformer.transform(np.asarray(x, dtype = float), np.asarray(y, dtype = float))
+
+
+def _cc_id(num):
+    """
+    ids "cc1", "cc2", ... of num centroid connectors
+    """
+    return np.char.add("cc", np.arange(1, 1 + num).astype(str)).astype(object)
+
+
+def generate_centroid_connectors(run_type, existing_drive_cc_df, node_gdf, existing_node_df):
+    """
+    calls function to generate loading point reference table, 
+    and calls function to find loading points
+    
+    build linestring based on pairs of centroid and loading point
+
+    connector and centroid geometries are built from coordinate arrays, projected together in one transform
+    
+    return centroid connectors and centroids
+    """
+    
+    if run_type == 'drive':
+        abm_load_ref_df = num_of_drive_loadpoint_per_centroid(existing_drive_cc_df, existing_node_df)
+    if (run_type == 'walk')|(run_type == 'bike'):
+        abm_load_ref_df = num_of_walk_bike_loadpoint_per_centroid(existing_node_df)
+
+    new_load_point_gdf = find_new_load_point(abm_load_ref_df, node_gdf)
+    
+    new_load_point_gdf = pd.merge(new_load_point_gdf,
+                                 existing_node_df[['N', 'X', 'Y']],
+                                 how = 'left', 
+                                 left_on = 'c',
+                                 right_on = 'N')
+
+    ld_xy = shapely.get_coordinates(np.asarray(new_load_point_gdf['geometry_ld']))
+    c_xy = new_load_point_gdf[['X', 'Y']].values.astype(float)
+
+    new_load_point_gdf['geometry_c'] = shapely.points(c_xy)
+    new_load_point_gdf.drop(['N', 'X', 'Y'], axis = 1, inplace = True)
+
+    # loading points and centroids to lat/long at once
+    num_cc = len(new_load_point_gdf)
+    lon, lat = _transform_xy(np.r_[ld_xy[:, 0], c_xy[:, 0]], np.r_[ld_xy[:, 1], c_xy[:, 1]], 26915, 4326)
+    ld_lonlat = np.column_stack([lon[:num_cc], lat[:num_cc]])
+    c_lonlat = np.column_stack([lon[num_cc:], lat[num_cc:]])
+    
+    #centroid coordinates
+    first_c = ~new_load_point_gdf['c'].duplicated().values
+    new_centroid_gdf = gpd.GeoDataFrame({'model_node_id' : new_load_point_gdf['c'].values[first_c]},
+                                        index = new_load_point_gdf.index[first_c],
+                                        geometry = shapely.points(c_lonlat[first_c]),
+                                        crs = {'init' : 'epsg:4326'})
+    
+    #inbound cc
+    new_cc_gdf = new_load_point_gdf
+    new_cc_gdf['geometry'] = shapely.linestrings(np.stack([ld_lonlat, c_lonlat], axis = 1))
+
+    new_cc_gdf["fromIntersectionId"] = new_cc_gdf['shst_node_id']
+    new_cc_gdf["shstGeometryId"] = _cc_id(num_cc)
+    new_cc_gdf["id"] = new_cc_gdf["shstGeometryId"]
+    
+    new_cc_gdf = new_cc_gdf.rename(columns = {'model_node_id' : 'A', 
+                                              'c' : 'B',
+                                             "osm_node_id" : "u"})
+    
+    #remove duplicates
+    new_cc_gdf.drop_duplicates(['A', 'B'], inplace = True)
+    
+    new_cc_gdf = gpd.GeoDataFrame(new_cc_gdf, geometry = 'geometry', crs = {'init' : 'epsg:4326'})
+    
+    return new_cc_gdf, new_centroid_gdf
+
+
+def consolidate_cc(new_drive_cc, new_walk_cc = pd.DataFrame(), new_bike_cc = pd.DataFrame()):
+    """
+    combine the drive, walk and bike connectors into unique connector links in both directions and their shapes
+
+    only the columns needed are taken from the inputs, and the reverse direction links share the shape
+    of the forward direction: geometry is kept once, in the shape table
+
+    Parameters
+    ----------
+    new_drive_cc: drive connectors, with A, B, geometry, fromIntersectionId, u
+    new_walk_cc, new_bike_cc: walk and bike connectors, same columns, default none
+
+    return
+    ----------
+    connector links, in both directions
+    connector shapes
+    """
+    cc_geometry_columns_list = ["A", "B", "geometry", "fromIntersectionId", "u"]
+
+    new_cc_list = [new_drive_cc[cc_geometry_columns_list].assign(drive_access = int(1),
+                                                                  walk_access = int(0),
+                                                                  bike_access = int(0))]
+    if len(new_walk_cc) > 0:
+        new_cc_list.append(new_walk_cc[cc_geometry_columns_list].assign(walk_access = int(1)))
+    if len(new_bike_cc) > 0:
+        new_cc_list.append(new_bike_cc[cc_geometry_columns_list].assign(bike_access = int(1)))
+    
+    new_cc_gdf = pd.concat(new_cc_list,
+                          sort = False,
+                          ignore_index = True)
+    
+    new_cc_gdf["u"] = new_cc_gdf["u"].astype(np.int64)
+    new_cc_gdf["A"] = new_cc_gdf["A"].astype(np.int64)
+    
+    new_cc_geometry_gdf = new_cc_gdf[cc_geometry_columns_list].drop_duplicates(subset = ["A", "B"])
+    
+    new_cc_geometry_gdf = new_cc_geometry_gdf.assign(shstGeometryId = _cc_id(len(new_cc_geometry_gdf)))
+    new_cc_geometry_gdf["id"] = new_cc_geometry_gdf["shstGeometryId"]
+    
+    unique_cc_gdf = new_cc_gdf.groupby(["A", "B"]).agg({"drive_access" : "max",
+                                                    "walk_access" : "max",
+                                                    "bike_access" : "max"}).reset_index()
     
-    build linestring based on pairs of centroid and loading point
+    unique_cc_gdf = pd.merge(unique_cc_gdf,
+                            pd.DataFrame(new_cc_geometry_gdf),
+                            how = "left",
+                            on = ["A", "B"])
     
-    return centroid connectors and centroids
+    # add the other direction, without geometry
+    cc_link_gdf = unique_cc_gdf.drop(columns = ["geometry"])
+    cc_link_df = pd.concat([cc_link_gdf,
+                           cc_link_gdf.rename(columns = {
+                                            "A" : "B",
+                                            "B" : "A",
+                                            "u" : "v",
+                                            "fromIntersectionId" : "toIntersectionId"})],
+                      ignore_index = True,
+                      sort = False)
+    
+    cc_link_columns_list = ["A", "B", "drive_access", "walk_access", "bike_access", 
+                            "shstGeometryId", "id", "u", "v", "fromIntersectionId", "toIntersectionId"]
+    cc_link_df = cc_link_df[cc_link_columns_list]
+    
+    # one shape per connector id, drawn in the forward direction
+    cc_shape_gdf = unique_cc_gdf[["id", "geometry", "fromIntersectionId"]].assign(
+        toIntersectionId = np.full(len(unique_cc_gdf), np.nan, dtype = object))
+            
+    return cc_link_df, cc_shape_gdf
+
+
+def _utm_crs(lng):
+    """
+    proj string of the UTM zone of a longitude
+    """
+    utm_zone = int(math.floor((lng + 180) / 6.0) + 1)
+
+    return f"+proj=utm +zone={utm_zone} +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
+
+
+def project_geometry(geometry, crs=None, to_crs=None, to_latlong=False):
+    """
+    Project a shapely geometry from its current CRS to another.
+    If to_crs is None, project to the UTM CRS for the UTM zone in which the
+    geometry's centroid lies. Otherwise project to the CRS defined by to_crs.
+    Parameters
+    ----------
+    geometry : shapely.geometry.Polygon or shapely.geometry.MultiPolygon
+        the geometry to project
+    crs : dict or string or pyproj.CRS
+        the starting CRS of the passed-in geometry. if None, it will be set to
+        settings.default_crs
+    to_crs : dict or string or pyproj.CRS
+        if None, project to UTM zone in which geometry's centroid lies,
+        otherwise project to this CRS
+    to_latlong : bool
+        if True, project to settings.default_crs and ignore to_crs
+    Returns
+    -------
+    geometry_proj, crs : tuple
+        the projected geometry and its new CRS
+    """
+    if crs is None:
+        crs = {"init" : "epsg:4326"}
+
+    if to_latlong:
+        to_crs = {"init" : "epsg:4326"}
+    elif to_crs is None:
+        to_crs = _utm_crs(geometry.centroid.x)
+
+    geometry_proj = transform_geometry([geometry], crs, to_crs)[0]
+    return geometry_proj, to_crs
+
+
+def project_gdf(gdf, to_crs=None, to_latlong=False):
+    """
+    Project a GeoDataFrame from its current CRS to another.
+    If to_crs is None, project to the UTM CRS for the UTM zone in which the
+    GeoDataFrame's centroid lies. Otherwise project to the CRS defined by
+    to_crs. The simple UTM zone calculation in this function works well for
+    most latitudes, but may not work for some extreme northern locations like
+    Svalbard or far northern Norway.
+    Parameters
+    ----------
+    gdf : geopandas.GeoDataFrame
+        the GeoDataFrame to be projected
+    to_crs : dict or string or pyproj.CRS
+        if None, project to UTM zone in which gdf's centroid lies, otherwise
+        project to this CRS
+    to_latlong : bool
+        if True, project to settings.default_crs and ignore to_crs
+    Returns
+    -------
+    gdf_proj : geopandas.GeoDataFrame
+        the projected GeoDataFrame
+    """
+    if gdf.crs is None or len(gdf) < 1:
+        raise ValueError("GeoDataFrame must have a valid CRS and cannot be empty")
+
+    # if to_latlong is True, project the gdf to latlong
+    if to_latlong:
+        to_crs = {"init" : "epsg:4326"}
+
+    # otherwise, automatically project the gdf to UTM
+    elif to_crs is None:
+        #if CRS.from_user_input(gdf.crs).is_projected:
+         #   raise ValueError("Geometry must be unprojected to calculate UTM zone")
+
+        # calculate longitude of centroid of union of all geometries in gdf
+        avg_lng = gdf["geometry"].unary_union.centroid.x
+
+        # calculate UTM zone from avg longitude to define CRS to project to
+        to_crs = _utm_crs(avg_lng)
+
+    # project the geometry column with the cached transformer
+    gdf_proj = pd.DataFrame(gdf)
+    gdf_proj["geometry"] = transform_geometry(gdf["geometry"], gdf.crs, to_crs)
+    gdf_proj = gpd.GeoDataFrame(gdf_proj, geometry = "geometry", crs = to_crs)
+
+    return gdf_proj
+
+
+def buffer_in_meters(gdf, dist):
+    """
+    buffer all geometries of a GeoDataFrame by a distance in meters
+
+    each geometry is buffered in the UTM zone of its centroid, as buffer1 does one polygon at a time,
+    but the geometries of each zone are projected, buffered and projected back together
+
+    Parameters
+    ----------
+    gdf: GeoDataFrame with a crs
+    dist: buffer distance in meters
+
+    return
+    ----------
+    GeoSeries of buffered geometries, in the crs of gdf
+    """
+    geometry = np.asarray(gdf["geometry"])
+
+    lng, _ = get_transformer(gdf.crs, {"init" : "epsg:4326"}).transform(*shapely.get_coordinates(
+        shapely.centroid(geometry)).T)
+    utm_zone = np.floor((lng + 180) / 6.0).astype(int) + 1
+
+    buffer_geometry = np.empty(len(geometry), dtype = object)
+    for zone in np.unique(utm_zone):
+        zone_row = np.flatnonzero(utm_zone == zone)
+        to_crs = _utm_crs(zone * 6.0 - 183)
+        zone_geometry = shapely.buffer(transform_geometry(geometry[zone_row], gdf.crs, to_crs), dist, quad_segs = 16)
+        buffer_geometry[zone_row] = transform_geometry(zone_geometry, to_crs, gdf.crs)
+
+    return gpd.GeoSeries(buffer_geometry, index = gdf.index, crs = gdf.crs)
+
+
+def buffer1(polygon):
+    buffer_dist = 10
+    poly_proj, crs_utm = project_geometry(polygon)
+    poly_proj_buff = poly_proj.buffer(buffer_dist)
+    poly_buff, _ = project_geometry(poly_proj_buff, crs=crs_utm, to_latlong=True)
+    
+    return poly_buff
+
+def buffer2(polygon):
+    return polygon.minimum_rotated_rectangle
+
+def getAngle(a, b, c):
+    ang = math.degrees(math.atan2(c[1]-b[1], c[0]-b[0]) - math.atan2(a[1]-b[1], a[0]-b[0]))
+    return ang + 360 if ang < 0 else ang
+
+def isDuplicate(a, b, zoneUnique):
+    length = len(zoneUnique)
+    #print("    unique zone unique length {}".format(length))
+    for i in range(length):
+        #print("           compare {} with zone unique {}".format(a, zoneUnique[i]))
+        ang = getAngle(a, b, zoneUnique[i])
+        
+        if (ang < 45) | (ang > 315):
+            return None
+            
+    zoneUnique += [a]
+    
+
+def get_non_near_connectors(all_cc, zone_ids = None, good_node_ids = None, max_connectors = 4, min_angle = 45):
+    """
+    thin the centroid connectors of each zone to at most max_connectors, angularly separated
+
+    connectors of a zone are taken in order, and kept if the angle at the centroid between their loading
+    point and the loading point of every connector kept before is at least min_angle.
+    zones with max_connectors or fewer keep all their connectors.
+    the bearings of all connectors are computed at once, zones are grouped by sorting, and all zones
+    pick their next connector together, so there are at most max_connectors rounds
+
+    Parameters
+    ----------
+    all_cc: connectors with A (loading point node), B (zone centroid node), id, geometry from A to B
+    zone_ids: zone centroid node ids to thin, default all
+    good_node_ids: loading point node ids flagged as good_point
+    max_connectors: max number of connectors kept per zone
+    min_angle: min angle in degrees between two connectors of a zone
+
+    return
+    ----------
+    dataframe of connectors kept, with their loading point, centroid point and good_point flag
+    """
+    all_cc_link_gdf = all_cc[["A", "B", "id", "geometry"]]
+
+    if zone_ids is not None:
+        all_cc_link_gdf = all_cc_link_gdf[all_cc_link_gdf.B.isin(zone_ids)]
+
+    # first two points of each connector: loading point, centroid
+    coords, coord_index = shapely.get_coordinates(np.asarray(all_cc_link_gdf["geometry"]), return_index = True)
+    first_coord = np.searchsorted(coord_index, np.arange(len(all_cc_link_gdf)))
+    ld_point = coords[first_coord]
+    c_point = coords[first_coord + 1]
+
+    # connectors grouped by zone, zones in order of first appearance, connectors in order within zones
+    zone_code, zone_unique = pd.factorize(all_cc_link_gdf["B"])
+    order = np.argsort(zone_code, kind = "stable")
+    zone_size = np.bincount(zone_code, minlength = len(zone_unique))
+    zone_first = order[np.cumsum(zone_size) - zone_size]
+
+    # bearing of each loading point from the centroid of its zone
+    zone_c_point = c_point[zone_first]
+    bearing = np.arctan2(ld_point[:, 1] - zone_c_point[zone_code, 1], ld_point[:, 0] - zone_c_point[zone_code, 0])
+
+    # candidates: connectors of zones to thin not too close to a connector kept yet
+    candidate = zone_size[zone_code] > max_connectors
+    picked = np.zeros(len(zone_code), dtype = bool)
+
+    for _ in range(max_connectors):
+        candidate_order = order[candidate[order]]
+        if len(candidate_order) == 0:
+            break
+
+        candidate_zone = zone_code[candidate_order]
+        pick = candidate_order[np.r_[True, candidate_zone[1:] != candidate_zone[:-1]]]
+        picked[pick] = True
+        candidate[pick] = False
+
+        pick_bearing = np.full(len(zone_unique), np.nan)
+        pick_bearing[zone_code[pick]] = bearing[pick]
+        angle = np.degrees(pick_bearing[zone_code] - bearing)
+        angle = np.where(angle < 0, angle + 360, angle)
+        candidate &= ~((angle < min_angle) | (angle > 360 - min_angle))
+
+    # connectors sharing the loading point of a kept connector are kept too
+    picked_point = pd.MultiIndex.from_arrays([zone_code[picked], ld_point[picked, 0], ld_point[picked, 1]])
+    keep = (zone_size[zone_code] <= max_connectors) | \
+        pd.MultiIndex.from_arrays([zone_code, ld_point[:, 0], ld_point[:, 1]]).isin(picked_point)
+
+    keep_order = order[keep[order]]
+    keep_cc_gdf = all_cc_link_gdf.iloc[keep_order].reset_index(drop = True)
+
+    keep_cc_gdf["ld_point"] = list(map(tuple, ld_point[keep_order]))
+    keep_cc_gdf["c_point"] = list(map(tuple, c_point[keep_order]))
+    keep_cc_gdf["ld_point_tuple"] = keep_cc_gdf["ld_point"]
+    keep_cc_gdf["good_point"] = np.where(keep_cc_gdf.A.isin([] if good_node_ids is None else good_node_ids),
+                                         1,
+                                         0)
+
+    return keep_cc_gdf
+
+
+def _yaml_loader():
+    """
+    the C yaml loader (libyaml) if pyyaml was built with it, else the python one
+    """
+    return getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def _card_changes(card):
+    """
+    the changes of a project card, a card without "changes" is one change
+    """
+    return card["changes"] if "changes" in card else [card]
+
+
+def _routing_to_array(card):
+    """
+    "existing" and "set" node lists of the routing property changes of a card, as int64 arrays, in place
+    """
+    for change in _card_changes(card):
+        for card_property in change.get("properties") or []:
+            if card_property.get("property") != "routing":
+                continue
+            for key in ["existing", "set"]:
+                if card_property.get(key) is not None:
+                    card_property[key] = np.asarray(card_property[key], dtype = np.int64)
+    return card
+
+
+def routing_to_list(card):
+    """
+    copy of a card from read_project_cards with its routing node arrays back to lists of int,
+    e.g. for network_wrangler ProjectCard
+
+    Parameters
+    ----------
+    card: project card dictionary
+    """
+    card = dict(card)
+    if "changes" in card:
+        card["changes"] = [dict(change) for change in card["changes"]]
+
+    for change in _card_changes(card):
+        if "properties" not in change:
+            continue
+        change["properties"] = [dict(p) for p in change["properties"] or []]
+        for card_property in change["properties"]:
+            for key in ["existing", "set"]:
+                if isinstance(card_property.get(key), np.ndarray):
+                    card_property[key] = card_property[key].tolist()
+    return card
+
+
+def _read_project_card_file(path):
+    """
+    parse one project card yaml file, with routing node arrays
+    """
+    with open(path, "rb") as f:
+        card = yaml.load(f, Loader = _yaml_loader())
+    card["file"] = path
+
+    return _routing_to_array(card)
+
+
+def _file_sha1(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def read_project_cards(card_dir, suffixes = ("*.yml", "*.yaml"), processes = 1, cache_file = None):
+    """
+    read all project cards of a folder, parsed with the C yaml loader on a process pool
+
+    parsed cards are kept in a binary (pickle) cache keyed by file path. a cached card is used while the file's size
+    and modification time are unchanged, or if its content hash is unchanged, so only new or edited cards are parsed
+
+    Parameters
+    ----------
+    card_dir: folder of project cards
+    suffixes: file name patterns of yaml cards, the other files of the folder (e.g. *.wrangler cards) are skipped
+        and listed
+    processes: number of worker processes parsing cards, 1 parses in this process. starting the pool costs more
+        than it saves for a few hundred cards
+    cache_file: pickle file of the parsed cards, default no cache
+
+    return
+    ----------
+    list of card dictionaries, in file name order, with "file" and the routing "existing" and "set" node lists
+    as int64 arrays (see routing_to_list)
+    """
+    card_file = sorted(set(path for suffix in suffixes for path in glob.glob(os.path.join(card_dir, suffix))))
+
+    skipped_file = sorted(set(path for path in glob.glob(os.path.join(card_dir, "*")) if os.path.isfile(path)) -
+                          set(card_file))
+    if len(skipped_file) > 0:
+        print("skipped ", len(skipped_file), " files not matching ", ", ".join(suffixes), ": ",
+              ", ".join(os.path.basename(path) for path in skipped_file))
+
+    cache = {}
+    if (cache_file is not None) and os.path.exists(cache_file):
+        with open(cache_file, "rb") as f:
+            cache = pickle.load(f)
+
+    card_dict = {}
+    to_parse = []
+    for path in card_file:
+        stat = os.stat(path)
+        cached = cache.get(path)
+        if (cached is not None) and ((cached["size"], cached["mtime"]) != (stat.st_size, stat.st_mtime_ns)):
+            # touched, but maybe not edited
+            sha1 = _file_sha1(path)
+            if cached["sha1"] == sha1:
+                cached.update(size = stat.st_size, mtime = stat.st_mtime_ns)
+            else:
+                cached = None
+        if cached is not None:
+            card_dict[path] = cached["card"]
+        else:
+            to_parse.append(path)
+
+    if (processes > 1) and (len(to_parse) > 1):
+        with ProcessPoolExecutor(max_workers = processes) as executor:
+            parsed = list(executor.map(_read_project_card_file, to_parse,
+                                       chunksize = max(len(to_parse) // (4 * processes), 1)))
+    else:
+        parsed = [_read_project_card_file(path) for path in to_parse]
+
+    for path, card in zip(to_parse, parsed):
+        stat = os.stat(path)
+        cache[path] = {"size" : stat.st_size, "mtime" : stat.st_mtime_ns, "sha1" : _file_sha1(path), "card" : card}
+        card_dict[path] = card
+
+    print("read ", len(card_file), " project cards, ", len(to_parse), " parsed, ", len(card_file) - len(to_parse), " from cache")
+
+    if cache_file is not None:
+        cache = dict((path, cache[path]) for path in card_file)
+        with open(cache_file + ".tmp", "wb") as f:
+            pickle.dump(cache, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_file + ".tmp", cache_file)
+
+    return [card_dict[path] for path in card_file]
+
+
+def pack_ab(A, B):
+    """
+    pack (A, B) node id pairs into one int64 key each, A in the high 32 bits and B in the low 32 bits,
+    same keys as pack_ab of src/scripts/validate_transit_line_node_sequence.py
+
+    used for the roadway link keys of validate_card_routing and the (shape, node) keys of build_transit_shape_index
+    """
+    return (np.asarray(A, dtype = np.int64) << 32) | np.asarray(B, dtype = np.int64)
+
+
+def is_in_sorted(sorted_key, key):
+    """
+    True where key is in sorted_key, a sorted array of packed keys, e.g. np.unique(pack_ab(A, B)) of the roadway links
+    """
+    if len(sorted_key) == 0:
+        return np.zeros(len(key), dtype = bool)
+    position = np.searchsorted(sorted_key, key).clip(0, len(sorted_key) - 1)
+    return sorted_key[position] == key
+
+
+def find_subsequence(nodes, pattern):
+    """
+    start positions of the contiguous pattern in a node sequence
+
+    candidates are the positions of the first pattern node, narrowed down one pattern node at a time
+
+    Parameters
+    ----------
+    nodes: int64 array, e.g. a shape's model node ids
+    pattern: int64 array of node ids
+
+    return
+    ----------
+    int64 array of start positions, empty if not found
+    """
+    m = len(pattern)
+    if (m == 0) or (m > len(nodes)):
+        return np.zeros(0, dtype = np.int64)
+    candidate = np.flatnonzero(nodes[:len(nodes) - m + 1] == pattern[0])
+    for k in range(1, m):
+        if len(candidate) == 0:
+            break
+        candidate = candidate[nodes[candidate + k] == pattern[k]]
+    return candidate.astype(np.int64)
+
+
+def card_selected_shapes(facility, trips_df = None):
+    """
+    shape_ids selected by a transit card facility
+
+    the shape_id of the facility if given, else the shapes of the trips matching all its other keys, e.g. route_id
+    and direction_id. time of day selections (start_time, end_time) are not applied, a key that is not a trips_df
+    column selects no shape. a "route" list of such selections selects the shapes of any of them
+
+    Parameters
+    ----------
+    facility: facility dictionary of a transit card change
+    trips_df: gtfs trips, merged with routes for route_short_name or route_long_name selections,
+    needed for facilities without shape_id
+    """
+    if facility.get("shape_id") is not None:
+        shape_id = facility["shape_id"]
+        return [str(s) for s in (shape_id if isinstance(shape_id, list) else [shape_id])]
+    if trips_df is None:
+        return []
+    if "route" in facility:
+        return sorted(set(shape_id for route in facility["route"] for shape_id in card_selected_shapes(route, trips_df)))
+
+    selected = np.ones(len(trips_df), dtype = bool)
+    for key in facility:
+        if key in ["start_time", "end_time"]:
+            continue
+        if key not in trips_df.columns:
+            return []
+        value = facility[key] if isinstance(facility[key], list) else [facility[key]]
+        selected &= trips_df[key].astype(str).isin([str(v) for v in value]).values
+    return sorted(trips_df.loc[selected, "shape_id"].astype(str).unique())
+
+
+def validate_card_routing(cards, link_df, shapes_df, trips_df = None, max_report_links = 5):
+    """
+    check the routing changes of transit project cards against the roadway network and the base transit shapes
+
+    every routing change is flattened into the consecutive (A, B) pairs of its "set" nodes, plus the pairs joining
+    "set" to the shape before and after the replaced "existing" segment, and all pairs of all cards are checked
+    against the roadway link index at once. each "existing" sequence must be a contiguous part of at least one
+    shape selected by the card, non-stop (negative) nodes compared by absolute value
+
+    Parameters
+    ----------
+    cards: project card dictionaries, see read_project_cards
+    link_df: roadway links with model node ids "A" and "B"
+    shapes_df: gtfs shapes with "shape_id", "shape_pt_sequence" and "shape_model_node_id"
+    trips_df: gtfs trips, for cards without shape_id, see card_selected_shapes
+    max_report_links: number of missing links printed per card
+
+    return
+    ----------
+    report_df: one row per card with routing changes, with the number of changes, of changes whose "existing" is
+    not found in a selected shape, of links checked and of links not on the roadway network
+    missing_link_df: card "file", "change", "shape_id", "A", "B" of every link not on the roadway network
+    """
+    link_key = np.unique(pack_ab(link_df["A"].values, link_df["B"].values))
+    shape_index = build_transit_shape_index(shapes_df)
+
+    change_records = []
+    pair_file = []
+    pair_change = []
+    pair_shape = []
+    pair_a = []
+    pair_b = []
+
+    for card in cards:
+        for change_number, change in enumerate(_card_changes(card)):
+            for card_property in change.get("properties") or []:
+                if card_property.get("property") != "routing":
+                    continue
+                # no "existing", or existing: null, replaces the whole shape
+                existing = card_property.get("existing")
+                existing = np.abs(np.asarray([] if existing is None else existing, dtype = np.int64))
+                new = card_property.get("set")
+                new = np.abs(np.asarray([] if new is None else new, dtype = np.int64))
+
+                shape_id_list = card_selected_shapes(change.get("facility") or {}, trips_df)
+                num_matched = 0
+                for shape_id in shape_id_list:
+                    try:
+                        shape_node, _ = shape_sequence(shape_index, shape_id)
+                    except KeyError:
+                        continue
+                    if len(existing) == 0:
+                        # the whole shape is replaced
+                        path = new
+                        num_matched += 1
+                    else:
+                        start = find_subsequence(shape_node, existing)
+                        if len(start) == 0:
+                            continue
+                        num_matched += 1
+                        start = start[0]
+                        path = np.concatenate([shape_node[max(start - 1, 0):start], new,
+                                               shape_node[start + len(existing):start + len(existing) + 1]])
+                    pair_a.append(path[:-1])
+                    pair_b.append(path[1:])
+                    pair_file += [card.get("file")] * (len(path) - 1)
+                    pair_change += [change_number] * (len(path) - 1)
+                    pair_shape += [shape_id] * (len(path) - 1)
+
+                if num_matched == 0:
+                    # no shape to splice into, check the new nodes by themselves
+                    pair_a.append(new[:-1])
+                    pair_b.append(new[1:])
+                    pair_file += [card.get("file")] * max(len(new) - 1, 0)
+                    pair_change += [change_number] * max(len(new) - 1, 0)
+                    pair_shape += [None] * max(len(new) - 1, 0)
+
+                change_records.append({"file" : card.get("file"), "project" : card.get("project"),
+                                       "change" : change_number, "num_shapes" : len(shape_id_list),
+                                       "existing_found" : num_matched > 0})
+
+    change_df = pd.DataFrame(change_records, columns = ["file", "project", "change", "num_shapes", "existing_found"])
+
+    pair_df = pd.DataFrame({"file" : pair_file, "change" : pair_change, "shape_id" : pair_shape,
+                            "A" : np.concatenate(pair_a) if pair_a else np.zeros(0, dtype = np.int64),
+                            "B" : np.concatenate(pair_b) if pair_b else np.zeros(0, dtype = np.int64)})
+    pair_df["on_network"] = is_in_sorted(link_key, pack_ab(pair_df["A"].values, pair_df["B"].values))
+
+    missing_link_df = pair_df.loc[~pair_df["on_network"], ["file", "change", "shape_id", "A", "B"]]
+    missing_link_df = missing_link_df.drop_duplicates(["file", "change", "A", "B"]).reset_index(drop = True)
+
+    report_df = change_df.groupby("file", sort = False).agg(
+        project = ("project", "first"),
+        num_routing_changes = ("change", "size"),
+        num_existing_not_found = ("existing_found", lambda x: int((~x).sum())))
+    report_df["num_links_checked"] = pair_df.groupby("file").size().reindex(report_df.index).fillna(0).astype(int)
+    report_df["num_links_missing"] = missing_link_df.groupby("file").size().reindex(report_df.index).fillna(0).astype(int)
+    report_df = report_df.reset_index()
+
+    print("checked ", len(pair_df), " routing links of ", len(change_df), " routing changes in ", len(report_df), " cards")
+    for row in report_df.itertuples():
+        status = "OK" if (row.num_existing_not_found == 0) and (row.num_links_missing == 0) else "FAIL"
+        print(status, os.path.basename(str(row.file)), ":", row.num_routing_changes, "routing changes,",
+              row.num_existing_not_found, "existing not found in shape,",
+              row.num_links_missing, "of", row.num_links_checked, "links not on the roadway network")
+        if row.num_existing_not_found > 0:
+            print("    existing not found, changes:",
+                  change_df.loc[(change_df["file"] == row.file) & ~change_df["existing_found"], "change"].tolist())
+        if row.num_links_missing > 0:
+            missing = missing_link_df[missing_link_df["file"] == row.file].head(max_report_links)
+            print("    missing links:", ", ".join("{}-{}".format(a, b) for a, b in zip(missing["A"], missing["B"])))
+
+    return report_df, missing_link_df
+
+
+def is_routing_card(card):
     """
-    
-    if run_type == 'drive':
-        abm_load_ref_df = num_of_drive_loadpoint_per_centroid(existing_drive_cc_df, existing_node_df)
-    if (run_type == 'walk')|(run_type == 'bike'):
-        abm_load_ref_df = num_of_walk_bike_loadpoint_per_centroid(existing_node_df)
+    True for a project card whose changes are all transit routing changes, see apply_transit_routing_batch
+    """
+    changes = _card_changes(card)
+    return (len(changes) > 0) and all(
+        (change.get("category") == "Transit Service Property Change") and
+        (len(change.get("properties") or []) > 0) and
+        all(p.get("property") == "routing" for p in change["properties"])
+        for change in changes)
 
-    new_load_point_gdf = find_new_load_point(abm_load_ref_df, node_gdf)
-    
-    new_load_point_gdf = pd.merge(new_load_point_gdf,
-                                 existing_node_df[['N', 'X', 'Y']],
-                                 how = 'left', 
-                                 left_on = 'c',
-                                 right_on = 'N')
-    
-    new_load_point_gdf['geometry_c'] = [Point(xy) for xy in zip(new_load_point_gdf['X'], new_load_point_gdf['Y'])]
-    new_load_point_gdf.drop(['N', 'X', 'Y'], axis = 1, inplace = True)
-    
-    #centroid coordinates
-    new_centroid_gdf = new_load_point_gdf.copy()[['c', 'geometry_c']]
-    new_centroid_gdf.rename(columns = {'c' : 'model_node_id', 'geometry_c' : 'geometry'}, inplace = True)
-    new_centroid_gdf.drop_duplicates(['model_node_id'], inplace = True)
 
-    new_centroid_gdf = gpd.GeoDataFrame(new_centroid_gdf)
-    
-    #inbound cc
-    new_cc_gdf = new_load_point_gdf.copy()
-    new_cc_gdf['geometry'] = [LineString(xy) for xy in zip(new_cc_gdf['geometry_ld'], new_cc_gdf['geometry_c'])]
+def build_transit_shape_index(shapes_df, shape_node_column = "shape_model_node_id"):
+    """
+    node sequences of the transit shapes, with a positional index of every (shape, node) pair
 
-    new_cc_gdf["fromIntersectionId"] = new_cc_gdf['shst_node_id']
-    new_cc_gdf["shstGeometryId"] = range(1, 1+len(new_cc_gdf))
-    new_cc_gdf["shstGeometryId"] = new_cc_gdf["shstGeometryId"].apply(lambda x: "cc" + str(x))
-    new_cc_gdf["id"] = new_cc_gdf["shstGeometryId"]
-    
-    new_cc_gdf = new_cc_gdf.rename(columns = {'model_node_id' : 'A', 
-                                              'c' : 'B',
-                                             "osm_node_id" : "u"})
-    
-    #remove duplicates
-    new_cc_gdf.drop_duplicates(['A', 'B'], inplace = True)
-    
-    new_cc_gdf.crs = {'init' : 'epsg:26915'}
-    new_cc_gdf = new_cc_gdf.to_crs(epsg = 4326)
-    new_centroid_gdf.crs = {'init' : 'epsg:26915'}
-    new_centroid_gdf = new_centroid_gdf.to_crs(epsg = 4326)
-    
-    return new_cc_gdf, new_centroid_gdf
+    shapes are indexed by shape_id alone, not by route_id and direction_id: the trips of a card change, and so their
+    shapes, are selected with the network's select_transit_features, see apply_transit_routing_batch
 
+    Parameters
+    ----------
+    shapes_df: gtfs shapes with "shape_id", "shape_pt_sequence" and the shape node column
+    shape_node_column: model node id column of the shapes
 
-def consolidate_cc(link, drive_centroid, node, new_drive_cc, new_walk_cc = pd.DataFrame(), new_bike_cc = pd.DataFrame()):
-    
-    link_gdf = link.copy()
-    node_gdf = node.copy()
-    drive_centroid_gdf = drive_centroid.copy()
-    new_drive_cc_gdf = new_drive_cc.copy()
-    
-    if len(new_walk_cc) > 0:
-        new_walk_cc_gdf = new_walk_cc.copy()
-        new_walk_cc_gdf["walk_access"] = int(1)
-    else:
-        new_walk_cc_gdf = pd.DataFrame()
-    if len(new_bike_cc) > 0:
-        new_bike_cc_gdf = new_bike_cc.copy()
-        new_bike_cc_gdf["bike_access"] = int(1)
-    else:
-        new_bike_cc_gdf = pd.DataFrame()
-    
-    new_drive_cc_gdf["drive_access"] = int(1)
-    new_drive_cc_gdf["walk_access"] = int(0)
-    new_drive_cc_gdf["bike_access"] = int(0)
-    
-    new_cc_gdf = pd.concat([new_drive_cc_gdf,
-                           new_walk_cc_gdf,
-                           new_bike_cc_gdf],
-                          sort = False,
-                          ignore_index = True)
-    
-    new_cc_gdf["u"] = new_cc_gdf["u"].astype(np.int64)
-    new_cc_gdf["A"] = new_cc_gdf["A"].astype(np.int64)
-    
-    new_cc_geometry_gdf = new_cc_gdf[["A", "B", "geometry", "fromIntersectionId", "u"]]\
-                                .drop_duplicates(subset = ["A", "B"]).copy()
-    
-    new_cc_geometry_gdf["shstGeometryId"] = range(1, 1 + len(new_cc_geometry_gdf))
-    new_cc_geometry_gdf["shstGeometryId"] = new_cc_geometry_gdf["shstGeometryId"].apply(lambda x: "cc" + str(x))
-    new_cc_geometry_gdf["id"] = new_cc_geometry_gdf["shstGeometryId"]
-    
-    unique_cc_gdf = new_cc_gdf.groupby(["A", "B"]).agg({"drive_access" : "max",
-                                                    "walk_access" : "max",
-                                                    "bike_access" : "max"}).reset_index()
-    
-    unique_cc_gdf = pd.merge(unique_cc_gdf,
-                            new_cc_geometry_gdf,
-                            how = "left",
-                            on = ["A", "B"])
-    
-    # add the other direction
-    cc_gdf = pd.concat([unique_cc_gdf,
-                       unique_cc_gdf.rename(columns = {
-                                            "A" : "B",
-                                            "B" : "A",
-                                            "u" : "v",
-                                            "fromIntersectionId" : "toIntersectionId"})],
-                      ignore_index = True,
-                      sort = False)
-    
-    cc_link_columns_list = ["A", "B", "drive_access", "walk_access", "bike_access", 
-                            "shstGeometryId", "id", "u", "v", "fromIntersectionId", "toIntersectionId"]
-    cc_link_df = cc_gdf[cc_link_columns_list].copy()
-    
-    cc_shape_columns_list = ["id", "geometry", "fromIntersectionId", "toIntersectionId"]
-    cc_shape_gdf = cc_gdf[cc_shape_columns_list].drop_duplicates(subset = ["id"]).copy()
-            
-    return cc_link_df, cc_shape_gdf
+    return
+    ----------
+    dictionary with
+    - "shape_id": sorted shape ids (str), a shape's position in it is its shape code
+    - "node", "row": model node ids of all shapes and their row positions in shapes_df, shape after shape,
+      in shape_pt_sequence order; "start" and "end" delimit each shape
+    - "key", "key_position": sorted packed (shape code, node) keys and the position of the node in its shape,
+      see locate_routing
+    """
+    shape_id_str = shapes_df["shape_id"].astype(str).values
+    row = np.lexsort((pd.to_numeric(shapes_df["shape_pt_sequence"]).values, shape_id_str))
+    node = pd.to_numeric(shapes_df[shape_node_column]).values.astype(np.int64)[row]
 
+    shape_id, start = np.unique(shape_id_str[row], return_index = True)
+    end = np.append(start[1:], len(row))
+    shape_code = np.repeat(np.arange(len(shape_id), dtype = np.int64), end - start)
+    position = np.arange(len(row)) - np.repeat(start, end - start)
 
-def project_geometry(geometry, crs=None, to_crs=None, to_latlong=False):
+    # stable sort, so the positions of a repeated node stay in ascending order
+    key = pack_ab(shape_code, node)
+    key_order = np.argsort(key, kind = "mergesort")
+
+    return {"shape_id" : shape_id, "node" : node, "row" : row, "start" : start, "end" : end,
+            "key" : key[key_order], "key_position" : position[key_order]}
+
+
+def shape_sequence(shape_index, shape_id):
     """
-    Project a shapely geometry from its current CRS to another.
-    If to_crs is None, project to the UTM CRS for the UTM zone in which the
-    geometry's centroid lies. Otherwise project to the CRS defined by to_crs.
+    model node ids and shapes_df row positions of one shape of a shape index, see build_transit_shape_index
+    """
+    code = np.searchsorted(shape_index["shape_id"], str(shape_id))
+    if (code == len(shape_index["shape_id"])) or (shape_index["shape_id"][code] != str(shape_id)):
+        raise KeyError(shape_id)
+    i, j = shape_index["start"][code], shape_index["end"][code]
+    return shape_index["node"][i:j], shape_index["row"][i:j]
+
+
+def locate_routing(shape_index, shape_id, first_node, last_node):
+    """
+    replaced segment of routing changes in their shapes, as network_wrangler locates it: from the first occurrence of
+    the first "existing" node to the last occurrence of the last "existing" node
+
     Parameters
     ----------
-    geometry : shapely.geometry.Polygon or shapely.geometry.MultiPolygon
-        the geometry to project
-    crs : dict or string or pyproj.CRS
-        the starting CRS of the passed-in geometry. if None, it will be set to
-        settings.default_crs
-    to_crs : dict or string or pyproj.CRS
-        if None, project to UTM zone in which geometry's centroid lies,
-        otherwise project to this CRS
-    to_latlong : bool
-        if True, project to settings.default_crs and ignore to_crs
-    Returns
-    -------
-    geometry_proj, crs : tuple
-        the projected geometry and its new CRS
+    shape_index: see build_transit_shape_index
+    shape_id: shape id of each routing change
+    first_node, last_node: first and last "existing" node of each routing change (absolute value)
+
+    return
+    ----------
+    start, end: positions of the segment in the shapes, inclusive, -1 where the node or shape is not found
     """
-    if crs is None:
-        crs = {"init" : "epsg:4326"}
+    index_shape_id = shape_index["shape_id"]
+    shape_id = np.asarray(shape_id, dtype = str)
+    code = np.searchsorted(index_shape_id, shape_id).clip(0, max(len(index_shape_id) - 1, 0))
+    known = (len(index_shape_id) > 0) & (index_shape_id[code] == shape_id)
 
-    gdf = gpd.GeoDataFrame(geometry=[geometry], crs=crs)
-    gdf_proj = project_gdf(gdf, to_crs=to_crs, to_latlong=to_latlong)
-    geometry_proj = gdf_proj["geometry"].iloc[0]
-    return geometry_proj, gdf_proj.crs
+    key, key_position = shape_index["key"], shape_index["key_position"]
+    first_key = pack_ab(code, first_node)
+    last_key = pack_ab(code, last_node)
 
+    first = np.searchsorted(key, first_key, side = "left")
+    last = np.searchsorted(key, last_key, side = "right") - 1
+    first_found = known & (first < len(key)) & (key[first.clip(0, max(len(key) - 1, 0))] == first_key)
+    last_found = known & (last >= 0) & (key[last.clip(0, max(len(key) - 1, 0))] == last_key)
 
-def project_gdf(gdf, to_crs=None, to_latlong=False):
+    start = np.where(first_found, key_position[first.clip(0, max(len(key) - 1, 0))], -1)
+    end = np.where(last_found, key_position[last.clip(0, max(len(key) - 1, 0))], -1)
+    return start, end
+
+
+def _splice_routing(node, row, edit_list, position = None):
     """
-    Project a GeoDataFrame from its current CRS to another.
-    If to_crs is None, project to the UTM CRS for the UTM zone in which the
-    GeoDataFrame's centroid lies. Otherwise project to the CRS defined by
-    to_crs. The simple UTM zone calculation in this function works well for
-    most latitudes, but may not work for some extreme northern locations like
-    Svalbard or far northern Norway.
+    splice routing changes into a node sequence
+
+    node, row: node ids and source row positions (-1 for new nodes) of the sequence
+    edit_list: routing changes, dictionaries with the "existing_shapes" and "set_shapes" node arrays
+    position: (start, end) of each change in the sequence, if the changes are disjoint and can be spliced in one pass;
+    otherwise they are located and spliced one after the other, as network_wrangler does
+
+    return the new node and row arrays, or None where a change's "existing" is not found
+    """
+    if position is not None:
+        order = np.argsort([start for start, end in position], kind = "mergesort")
+        node_piece, row_piece = [], []
+        cursor = 0
+        for k in order:
+            start, end = position[k]
+            new = edit_list[k]["set_shapes"]
+            node_piece += [node[cursor:start], new]
+            row_piece += [row[cursor:start], np.full(len(new), -1, dtype = np.int64)]
+            cursor = end + 1
+        node_piece.append(node[cursor:])
+        row_piece.append(row[cursor:])
+        return np.concatenate(node_piece), np.concatenate(row_piece)
+
+    for edit in edit_list:
+        new = edit["set_shapes"]
+        existing = edit["existing_shapes"]
+        if existing is None:
+            node, row = new, np.full(len(new), -1, dtype = np.int64)
+            continue
+        first = np.flatnonzero(node == existing[0])
+        last = np.flatnonzero(node == existing[-1])
+        if (len(first) == 0) or (len(last) == 0):
+            return None
+        start, end = first[0], last[-1]
+        node = np.concatenate([node[:start], new, node[end + 1:]])
+        row = np.concatenate([row[:start], np.full(len(new), -1, dtype = np.int64), row[end + 1:]])
+    return node, row
+
+
+def _new_shape_id(shape_id, id_scalar, used):
+    """
+    id of a copy of a shape, for the selected trips of a shape shared with other trips
+    """
+    try:
+        new_id = str(int(shape_id) + id_scalar)
+        while new_id in used:
+            new_id = str(int(new_id) + id_scalar)
+    except ValueError:
+        n = 1
+        while "{}_{}".format(shape_id, n) in used:
+            n += 1
+        new_id = "{}_{}".format(shape_id, n)
+    return new_id
+
+
+def _as_column_type(values, column):
+    """
+    node ids as str if the column holds str, as in network_wrangler feeds
+    """
+    return list(values) if pd.api.types.is_numeric_dtype(column) else [str(v) for v in values]
+
+
+def apply_transit_routing_batch(transit_net, cards, road_net = None):
+    """
+    apply the routing changes of transit project cards to a network_wrangler transit network, in one pass per shape
+
+    trips are selected change by change with the network's own select_transit_features, and a shape shared with
+    trips that are not selected is copied to a new shape_id for the selected ones, as apply_project does. the routing
+    changes are collected per shape and per trip, then each edited shape is spliced once: the replaced segments, from
+    the first occurrence of the first "existing" node to the last occurrence of the last one, are looked up in a
+    positional index of the base shapes (see build_transit_shape_index and locate_routing). disjoint segments are
+    spliced in one pass; changes whose segments overlap are reported, and spliced one after the other in card order,
+    as are changes that only apply to the result of an earlier change. stop_times are spliced once per stop pattern of the
+    trips the same way, with "set" stops not yet in stops.txt added to it
+
     Parameters
     ----------
-    gdf : geopandas.GeoDataFrame
-        the GeoDataFrame to be projected
-    to_crs : dict or string or pyproj.CRS
-        if None, project to UTM zone in which gdf's centroid lies, otherwise
-        project to this CRS
-    to_latlong : bool
-        if True, project to settings.default_crs and ignore to_crs
-    Returns
-    -------
-    gdf_proj : geopandas.GeoDataFrame
-        the projected GeoDataFrame
+    transit_net: network_wrangler TransitNetwork, its feed shapes, trips, stops and stop_times are updated in place
+    cards: project card dictionaries, see read_project_cards and is_routing_card, in the order to apply them
+    road_net: network_wrangler RoadwayNetwork, for the coordinates of new shape points and stops, default none
+
+    return
+    ----------
+    overlap_df: "shape_id", "file", "change", "other_file", "other_change" of every pair of changes whose replaced
+    segments overlap on the same shape
     """
-    if gdf.crs is None or len(gdf) < 1:
-        raise ValueError("GeoDataFrame must have a valid CRS and cannot be empty")
+    feed = transit_net.feed
+    stops_fk = getattr(transit_net, "stops_foreign_key", "model_node_id")
+    id_scalar = getattr(transit_net, "ID_SCALAR", 100000000)
 
-    # if to_latlong is True, project the gdf to latlong
-    if to_latlong:
-        gdf_proj = gdf.to_crs({"init" : "epsg:4326"})
-        #utils.log(f"Projected GeoDataFrame to {settings.default_crs}")
+    shape_index = build_transit_shape_index(feed.shapes)
+    print("indexed ", len(shape_index["shape_id"]), " shapes, ", len(shape_index["node"]), " shape points")
 
-    # else if to_crs was passed-in, project gdf to this CRS
-    elif to_crs is not None:
-        gdf_proj = gdf.to_crs(to_crs)
-        #utils.log(f"Projected GeoDataFrame to {to_crs}")
+    # collect the changes per shape and per trip, trips are reassigned to shape copies as they are selected
+    feed.trips["shape_id"] = feed.trips["shape_id"].astype(str)
+    shape_trips = feed.trips.groupby("shape_id")["trip_id"].apply(set).to_dict()
+    shape_root = dict((shape_id, shape_id) for shape_id in shape_trips)
+    shape_edits = {}
+    trip_edits = {}
+    edit_list = []
+    used_shape_id = set(shape_trips) | set(shape_index["shape_id"])
 
-    # otherwise, automatically project the gdf to UTM
-    else:
-        #if CRS.from_user_input(gdf.crs).is_projected:
-         #   raise ValueError("Geometry must be unprojected to calculate UTM zone")
+    for card in cards:
+        for change_number, change in enumerate(_card_changes(card)):
+            trip_ids = set(transit_net.select_transit_features(change["facility"]))
+            for card_property in change["properties"]:
+                new = np.asarray(card_property["set"], dtype = np.int64)
+                existing = card_property.get("existing")
+                existing = None if existing is None else np.asarray(existing, dtype = np.int64)
+                edit = {"file" : card.get("file"), "change" : change_number,
+                        "set_shapes" : np.abs(new),
+                        "existing_shapes" : None if existing is None else np.abs(existing),
+                        "set_stops" : pd.unique(new[new > 0]),
+                        "existing_stops" : None if existing is None else existing[existing > 0],
+                        "stops_change" : bool((new > 0).any())}
+                edit_list.append(edit)
 
-        # calculate longitude of centroid of union of all geometries in gdf
-        avg_lng = gdf["geometry"].unary_union.centroid.x
+                selected = feed.trips[feed.trips["trip_id"].isin(trip_ids)]
+                for shape_id in sorted(selected["shape_id"].unique()):
+                    moved = shape_trips[shape_id] & trip_ids
+                    if len(moved) < len(shape_trips[shape_id]):
+                        # trips that are not selected keep the shape, the selected ones get a copy
+                        new_id = _new_shape_id(shape_id, id_scalar, used_shape_id)
+                        used_shape_id.add(new_id)
+                        shape_trips[shape_id] = shape_trips[shape_id] - moved
+                        shape_trips[new_id] = moved
+                        shape_root[new_id] = shape_root[shape_id]
+                        shape_edits[new_id] = list(shape_edits.get(shape_id, []))
+                        feed.trips.loc[feed.trips["trip_id"].isin(moved), "shape_id"] = new_id
+                        shape_id = new_id
+                    shape_edits.setdefault(shape_id, []).append(len(edit_list) - 1)
 
-        # calculate UTM zone from avg longitude to define CRS to project to
-        utm_zone = int(math.floor((avg_lng + 180) / 6.0) + 1)
-        utm_crs = f"+proj=utm +zone={utm_zone} +ellps=WGS84 +datum=WGS84 +units=m +no_defs"
+                if edit["stops_change"]:
+                    for trip_id in trip_ids:
+                        trip_edits.setdefault(trip_id, []).append(len(edit_list) - 1)
 
-        # project the GeoDataFrame to the UTM CRS
-        gdf_proj = gdf.to_crs(utm_crs)
-        #utils.log(f"Projected GeoDataFrame to {gdf_proj.crs}")
+    overlap_df = _apply_shape_edits(feed, shape_index, shape_root, shape_edits, edit_list, road_net)
+    _apply_stop_time_edits(feed, trip_edits, edit_list, stops_fk, id_scalar, road_net)
 
-    return gdf_proj
+    print("applied ", len(edit_list), " routing changes of ", len(cards), " cards to ", len(shape_edits),
+          " shapes and ", len(trip_edits), " trips, ", len(overlap_df), " overlapping changes")
+    return overlap_df
 
-def buffer1(polygon):
-    buffer_dist = 10
-    poly_proj, crs_utm = project_geometry(polygon)
-    poly_proj_buff = poly_proj.buffer(buffer_dist)
-    poly_buff, _ = project_geometry(poly_proj_buff, crs=crs_utm, to_latlong=True)
-    
-    return poly_buff
 
-def buffer2(polygon):
-    return polygon.minimum_rotated_rectangle
+def _apply_shape_edits(feed, shape_index, shape_root, shape_edits, edit_list, road_net):
+    """
+    splice the routing changes of each edited shape once and replace its shape points in feed.shapes,
+    see apply_transit_routing_batch
+    """
+    shapes_df = feed.shapes
 
-def getAngle(a, b, c):
-    ang = math.degrees(math.atan2(c[1]-b[1], c[0]-b[0]) - math.atan2(a[1]-b[1], a[0]-b[0]))
-    return ang + 360 if ang < 0 else ang
+    # locate every (shape, change) segment in the base shapes at once
+    pair_shape = [shape_id for shape_id, edits in shape_edits.items() for k in edits]
+    pair_edit = [k for edits in shape_edits.values() for k in edits]
+    first_node = [edit_list[k]["existing_shapes"][0] if edit_list[k]["existing_shapes"] is not None else -1
+                  for k in pair_edit]
+    last_node = [edit_list[k]["existing_shapes"][-1] if edit_list[k]["existing_shapes"] is not None else -1
+                 for k in pair_edit]
+    start, end = locate_routing(shape_index, [shape_root[s] for s in pair_shape],
+                                np.asarray(first_node, dtype = np.int64), np.asarray(last_node, dtype = np.int64))
 
-def isDuplicate(a, b, zoneUnique):
-    length = len(zoneUnique)
-    #print("    unique zone unique length {}".format(length))
-    for i in range(length):
-        #print("           compare {} with zone unique {}".format(a, zoneUnique[i]))
-        ang = getAngle(a, b, zoneUnique[i])
-        
-        if (ang < 45) | (ang > 315):
-            return None
-            
-    zoneUnique += [a]
-    
+    overlap_records = []
+    node_list, row_list, shape_list = [], [], []
+    i = 0
+    for shape_id, edits in shape_edits.items():
+        position = list(zip(start[i:i + len(edits)], end[i:i + len(edits)]))
+        i += len(edits)
+        node, row = shape_sequence(shape_index, shape_root[shape_id])
 
-def get_non_near_connectors(all_cc):
-    
-    all_cc_link_gdf = all_cc.copy()
-    
-    all_cc_link_gdf = all_cc_link_gdf[all_cc_link_gdf.B.isin(taz_N_list + maz_N_list)].copy()
-    
-    all_cc_link_gdf = all_cc_link_gdf[["A", "B", "id", "geometry"]]
-    
-    all_cc_link_gdf["ld_point"] = all_cc_link_gdf["geometry"].apply(lambda x: list(x.coords)[0])
-    all_cc_link_gdf["c_point"] = all_cc_link_gdf["geometry"].apply(lambda x: list(x.coords)[1])
-    
-    all_cc_link_gdf["ld_point_tuple"] = all_cc_link_gdf["ld_point"].apply(lambda x: tuple(x))
-    
-    all_cc_link_gdf["good_point"] = np.where(all_cc_link_gdf.A.isin(node_two_geometry_id_list),
-                                            1,
-                                            0)
-    
-    keep_cc_gdf = pd.DataFrame()
-    
-    for c in all_cc_link_gdf.B.unique():
-        
-        zone_cc_gdf = all_cc_link_gdf[all_cc_link_gdf.B == c].copy()
-        
-        centroid = zone_cc_gdf.c_point.iloc[0]
-        
-        # if the zone has less than 4 cc, keep all
-        if len(zone_cc_gdf) <= 4:
-            keep_cc_gdf = keep_cc_gdf.append(zone_cc_gdf, sort = False, ignore_index = True)
-    
-        # if the zone has more than 4 cc
-        else:
-            
-            zoneUnique = []
-                
-            zoneCandidate = zone_cc_gdf["ld_point"].to_list()
-            #print("zone candidate {}".format(zoneCandidate))
-            for point in zoneCandidate:
-                #print("evaluate: {}".format(point))
-                if len(zoneUnique) == 0:
-                    zoneUnique += [point]
-                else:
-                    isDuplicate(point, centroid, zoneUnique)
-                #print("zone unique {}".format(zoneUnique))
-                if len(zoneUnique) == 4:
-                    break
-                
-            zone_cc_gdf = zone_cc_gdf[zone_cc_gdf.ld_point_tuple.isin([tuple(z) for z in zoneUnique])]
-                
-            keep_cc_gdf = keep_cc_gdf.append(zone_cc_gdf, sort = False, ignore_index = True)
-            """
-            ## if more than 4 good cc, apply non-near method
-            if zone_cc_gdf.good_point.sum() > 4:
-                
-                zone_cc_gdf = zone_cc_gdf[zone_cc_gdf.good_point == 1].copy()
-                
-                zoneUnique = []
-                
-                zoneCandidate = zone_cc_gdf["B_point"].to_list()
-                #print("zone candidate {}".format(zoneCandidate))
-                for point in zoneCandidate:
-                    #print("evaluate: {}".format(point))
-                    if len(zoneUnique) == 0:
-                        zoneUnique += [point]
-                    else:
-                        isDuplicate(point, centroid, zoneUnique)
-                    #print("zone unique {}".format(zoneUnique))
-                    if len(zoneUnique) == 4:
-                        break
-                
-                zone_cc_gdf = zone_cc_gdf[zone_cc_gdf.B_point_tuple.isin([tuple(z) for z in zoneUnique])]
-                
-                keep_cc_gdf = keep_cc_gdf.append(zone_cc_gdf, sort = False, ignore_index = True)
-    
-            ## if less than 4 good cc, keep good cc, apply non-near to pick additional connectors
-            else:
-                non_near_zone_cc_gdf = zone_cc_gdf[zone_cc_gdf.good_point == 1].copy()
-                
-                ## keep good cc, get non near based on good cc
-                
-                zoneUnique = non_near_zone_cc_gdf["B_point"].to_list()
-                
-                zoneCandidate = zone_cc_gdf[zone_cc_gdf.good_point == 0]["B_point"].to_list()
-                
-                for point in zoneCandidate:
-                    #print("evaluate: {}".format(point))
-                    isDuplicate(point, centroid, zoneUnique)
-                    #print("zone unique {}".format(zoneUnique))
-                    if len(zoneUnique) == 4:
-                        break
-                        
-                zone_cc_gdf = zone_cc_gdf[zone_cc_gdf.B_point_tuple.isin([tuple(z) for z in zoneUnique])]
-                
-                keep_cc_gdf = keep_cc_gdf.append(zone_cc_gdf, ignore_index = True)
-            """    
-    return keep_cc_gdf
\ No newline at end of file
+        # one pass if every segment is found in the base shape, the segments are disjoint, and no new node is the
+        # first or last node of another change, which would move where that change applies
+        one_pass = all((edit_list[k]["existing_shapes"] is not None) and (s >= 0) and (e >= s)
+                       for k, (s, e) in zip(edits, position))
+        for a in range(len(edits)):
+            for b in range(a + 1, len(edits)):
+                (s_a, e_a), (s_b, e_b) = position[a], position[b]
+                if (min(s_a, s_b) >= 0) and (max(s_a, s_b) <= min(e_a, e_b)):
+                    overlap_records.append({"shape_id" : shape_id,
+                                            "file" : edit_list[edits[a]]["file"], "change" : edit_list[edits[a]]["change"],
+                                            "other_file" : edit_list[edits[b]]["file"],
+                                            "other_change" : edit_list[edits[b]]["change"]})
+                    one_pass = False
+        if one_pass and (len(edits) > 1):
+            end_node = np.concatenate([edit_list[k]["existing_shapes"][[0, -1]] for k in edits])
+            new_node = np.concatenate([edit_list[k]["set_shapes"] for k in edits])
+            one_pass = not np.isin(end_node, new_node).any()
+
+        spliced = _splice_routing(node, row, [edit_list[k] for k in edits], position if one_pass else None)
+        if spliced is None:
+            raise ValueError("existing routing of {} not found in shape {}".format(
+                [(edit_list[k]["file"], edit_list[k]["change"]) for k in edits], shape_id))
+        node_list.append(spliced[0])
+        row_list.append(spliced[1])
+        shape_list.append(np.full(len(spliced[0]), shape_id, dtype = object))
+
+    if len(node_list) == 0:
+        return pd.DataFrame(columns = ["shape_id", "file", "change", "other_file", "other_change"])
+
+    node = np.concatenate(node_list)
+    row = np.concatenate(row_list)
+    new_shape_df = shapes_df.iloc[row.clip(0, None)].reset_index(drop = True)
+    new_shape_df["shape_id"] = np.concatenate(shape_list)
+
+    new_point = row < 0
+    for column in new_shape_df.columns:
+        if column not in ["shape_id", "shape_model_node_id", "shape_pt_sequence"]:
+            new_shape_df.loc[new_point, column] = None
+    new_shape_df.loc[new_point, "shape_model_node_id"] = _as_column_type(node[new_point], shapes_df["shape_model_node_id"])
+    if road_net is not None:
+        node_xy = road_net.nodes_df.drop_duplicates("model_node_id").set_index("model_node_id")
+        new_node = pd.Series(node[new_point])
+        new_shape_df.loc[new_point, "shape_pt_lat"] = new_node.map(node_xy["Y"]).values
+        new_shape_df.loc[new_point, "shape_pt_lon"] = new_node.map(node_xy["X"]).values
+        if ("osm_node_id" in node_xy.columns) and ("shape_osm_node_id" in new_shape_df.columns):
+            new_shape_df.loc[new_point, "shape_osm_node_id"] = new_node.map(node_xy["osm_node_id"]).values
+    new_shape_df["shape_pt_sequence"] = new_shape_df.groupby("shape_id", sort = False).cumcount()
+
+    feed.shapes = pd.concat([shapes_df[~shapes_df["shape_id"].astype(str).isin(shape_edits.keys())], new_shape_df],
+                            ignore_index = True, sort = False)
+
+    return pd.DataFrame(overlap_records, columns = ["shape_id", "file", "change", "other_file", "other_change"])
+
+
+def _apply_stop_time_edits(feed, trip_edits, edit_list, stops_fk, id_scalar, road_net):
+    """
+    splice the stop changes of the trips once per stop pattern and replace their stop_times,
+    see apply_transit_routing_batch
+    """
+    stop_edit_list = [edit for edit in edit_list if edit["stops_change"]]
+    if len(stop_edit_list) == 0:
+        return
+    stops_df = feed.stops
+    stop_times_df = feed.stop_times
+
+    # stops for "set" nodes that have none, also for changes that select no trip
+    stop_node = pd.to_numeric(stops_df[stops_fk]).values.astype(np.int64)
+    set_node = pd.unique(np.concatenate([edit["set_stops"] for edit in stop_edit_list]))
+    add_node = set_node[~np.isin(set_node, stop_node)]
+    if len(add_node) > 0:
+        new_stop_df = pd.DataFrame({"stop_id" : [str(n + id_scalar) for n in add_node],
+                                    stops_fk : _as_column_type(add_node, stops_df[stops_fk])})
+        if road_net is not None:
+            node_xy = road_net.nodes_df.drop_duplicates("model_node_id").set_index("model_node_id")
+            new_stop_df["stop_lat"] = pd.Series(add_node).map(node_xy["Y"]).values
+            new_stop_df["stop_lon"] = pd.Series(add_node).map(node_xy["X"]).values
+        stops_df = pd.concat([stops_df, new_stop_df], ignore_index = True, sort = False)
+        stop_node = np.append(stop_node, add_node)
+        feed.stops = stops_df
+    node_stop_id = pd.Series(stops_df["stop_id"].values, index = stop_node)
+    node_stop_id = node_stop_id[~node_stop_id.index.duplicated()]
+    stop_id_node = pd.Series(stop_node, index = stops_df["stop_id"].values)
+    stop_id_node = stop_id_node[~stop_id_node.index.duplicated()]
+
+    # stop node sequence of each edited trip, in stop_sequence order: the rows of a trip need not be in order
+    edited = np.flatnonzero(stop_times_df["trip_id"].isin(trip_edits.keys()).values)
+    _, edited_trip_code = np.unique(stop_times_df["trip_id"].values[edited], return_inverse = True)
+    edited_sequence = pd.to_numeric(pd.Series(stop_times_df["stop_sequence"].values[edited])).values
+    edited = edited[np.lexsort((edited_sequence, edited_trip_code))]
+    edited_trip = stop_times_df["trip_id"].values[edited]
+    edited_node = stop_times_df["stop_id"].map(stop_id_node).values[edited]
+    trip_id, trip_start = np.unique(edited_trip, return_index = True)
+    trip_end = np.append(trip_start[1:], len(edited))
+    if len(trip_id) == 0:
+        return
+
+    pattern_cache = {}
+    row_list, trip_list, node_list = [], [], []
+    for t, i, j in zip(trip_id, trip_start, trip_end):
+        node = edited_node[i:j]
+        pattern = (node.tobytes(), tuple(trip_edits[t]))
+        if pattern not in pattern_cache:
+            offset = np.arange(j - i)
+            for k in trip_edits[t]:
+                new = edit_list[k]["set_stops"]
+                existing = edit_list[k]["existing_stops"]
+                if existing is None:
+                    node, offset = new, np.full(len(new), -1)
+                    continue
+                first = np.flatnonzero(node == existing[0]) if len(existing) else []
+                last = np.flatnonzero(node == existing[-1]) if len(existing) else []
+                if (len(first) == 0) or (len(last) == 0):
+                    raise ValueError("existing stops of {} change {} not found in trip {}".format(
+                        edit_list[k]["file"], edit_list[k]["change"], t))
+                node = np.concatenate([node[:first[0]], new, node[last[-1] + 1:]])
+                offset = np.concatenate([offset[:first[0]], np.full(len(new), -1), offset[last[-1] + 1:]])
+            pattern_cache[pattern] = (node, offset)
+        node, offset = pattern_cache[pattern]
+        row_list.append(np.where(offset >= 0, edited[i:j][offset.clip(0, None)], -1) if len(offset) else offset)
+        trip_list.append(np.full(len(node), t, dtype = object))
+        node_list.append(node)
+
+    row = np.concatenate(row_list).astype(np.int64)
+    node = np.concatenate(node_list).astype(np.int64)
+    new_stop_time_df = stop_times_df.iloc[row.clip(0, None)].reset_index(drop = True)
+    new_stop_time_df["trip_id"] = np.concatenate(trip_list)
+    new_row = row < 0
+    new_stop_time_df.loc[new_row, "stop_id"] = node_stop_id.reindex(node[new_row]).values
+    for column in new_stop_time_df.columns:
+        if column not in ["trip_id", "stop_id", "stop_sequence"]:
+            new_stop_time_df.loc[new_row, column] = None
+    new_stop_time_df["stop_sequence"] = new_stop_time_df.groupby("trip_id", sort = False).cumcount()
+
+    feed.stop_times = pd.concat([stop_times_df[~stop_times_df["trip_id"].isin(trip_edits.keys())], new_stop_time_df],
+                                ignore_index = True, sort = False)
+    print("updated stop_times of ", len(trip_id), " trips, ", len(pattern_cache), " stop patterns, ",
+          len(add_node), " new stops")
+
+
+def subset_transit_net(transit_net, trip_ids):
+    """
+    copy of a network_wrangler transit network with only the given trips, their shapes and stop_times, e.g. to check
+    apply_transit_routing_batch against apply_project on a small feed. the tables of the copy are new frames, applying
+    cards to it leaves the network unchanged
+
+    Parameters
+    ----------
+    transit_net: network_wrangler TransitNetwork
+    trip_ids: trip_id of the trips to keep
+    """
+    feed = transit_net.feed
+    trips_df = feed.trips[feed.trips["trip_id"].isin(trip_ids)].copy()
+
+    small_net = copy.copy(transit_net)
+    small_net.feed = copy.copy(feed)
+    small_net.feed.trips = trips_df
+    small_net.feed.shapes = feed.shapes[feed.shapes["shape_id"].astype(str).isin(trips_df["shape_id"].astype(str))].copy()
+    small_net.feed.stop_times = feed.stop_times[feed.stop_times["trip_id"].isin(trips_df["trip_id"])].copy()
+    small_net.feed.routes = feed.routes[feed.routes["route_id"].isin(trips_df["route_id"])].copy()
+    small_net.feed.stops = feed.stops.copy()
+    if getattr(feed, "frequencies", None) is not None:
+        small_net.feed.frequencies = feed.frequencies[feed.frequencies["trip_id"].isin(trips_df["trip_id"])].copy()
+
+    return small_net
+
+
+def compare_transit_feeds(feed, other_feed, shape_node_column = "shape_model_node_id"):
+    """
+    compare the routing of two transit feeds, e.g. after apply_transit_routing_batch and after apply_project:
+    the shape of each trip, the node sequence of each shape, the stop sequence of each trip and the stop ids.
+    shape points and stop_times are compared in shape_pt_sequence and stop_sequence order, not in row order
+
+    return
+    ----------
+    list of the tables that differ, of "trips", "shapes", "stop_times", "stops"; empty if the feeds are the same
+    """
+    def _sequences(df, key, order, value):
+        df = df[[key, order, value]].copy()
+        df[key] = df[key].astype(str)
+        df[order] = pd.to_numeric(df[order])
+        df[value] = df[value].astype(str)
+        df = df.sort_values([key, order], kind = "mergesort")
+        return df.groupby(key, sort = True)[value].agg(tuple)
+
+    def _tables(f):
+        trip_shape = f.trips.assign(trip_id = f.trips["trip_id"].astype(str), shape_id = f.trips["shape_id"].astype(str))
+        return {"trips" : trip_shape.set_index("trip_id")["shape_id"].sort_index(),
+                "shapes" : _sequences(f.shapes, "shape_id", "shape_pt_sequence", shape_node_column),
+                "stop_times" : _sequences(f.stop_times, "trip_id", "stop_sequence", "stop_id"),
+                "stops" : pd.Series(np.sort(f.stops["stop_id"].astype(str).unique()))}
+
+    table_dict, other_table_dict = _tables(feed), _tables(other_feed)
+    diff_list = []
+    for table in ["trips", "shapes", "stop_times", "stops"]:
+        if not table_dict[table].equals(other_table_dict[table]):
+            diff_list.append(table)
+            print(table, "differ: ", len(table_dict[table]), " and ", len(other_table_dict[table]), " rows")
+    return diff_list
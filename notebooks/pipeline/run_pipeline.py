@@ -0,0 +1,581 @@
+"""
+Headless, incremental runner of the network rebuild pipeline (steps 0 to 8).
+
+Each step declares the files it reads and writes in PIPELINE_STEPS, and the steps form a DAG through
+them: a step runs after every step that writes one of its inputs. A step is fingerprinted by the
+content of its code (notebook code cells, plus methods.py), its parameters and its input files, and
+is skipped when the fingerprint matches its last successful run and its outputs are still there.
+A step that reruns but writes identical outputs does not trigger its downstream steps.
+Independent branches (e.g. the roadway steps and the GTFS shape preparation) run in parallel.
+
+SharedStreets extraction and matching (steps 1, 4 and 6) run in the shst docker, outside this runner. These are
+"external" steps: the runner only checks their outputs exist and reports when their inputs changed.
+
+Usage, from this folder:
+    python run_pipeline.py                   # bring every step up to date
+    python run_pipeline.py --steps step5     # step 5 and whatever it needs
+    python run_pipeline.py --dry-run         # print what would run
+    python run_pipeline.py --force --steps step8 --jobs 2
+    python run_pipeline.py --osm-snapshot 2024-05-01   # after an OSM refresh
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+PIPELINE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# live data sources downloaded by the steps, no file tells their version: a snapshot name (e.g. a date) is given
+# on the command line when the source is refreshed, and kept in the state file until the next refresh
+SNAPSHOTS = {"osm" : "OpenStreetMap, downloaded with osmnx",
+             "shst" : "SharedStreets tiles, downloaded by the shst extraction"}
+
+# step state (fingerprints) and executed notebooks, relative to this folder like the notebooks' own paths
+STATE_FILE = "../../data/interim/pipeline_state.json"
+RUN_DIR = "../../data/interim/pipeline_runs/"
+
+# code shared by the notebooks, part of every notebook step's fingerprint
+SHARED_CODE = ["methods.py"]
+
+# kind: "notebook" is executed with nbconvert, "external" is run by hand (see the Readme)
+# inputs and outputs are paths or glob patterns relative to this folder
+# params: anything else the step's result depends on, part of its fingerprint
+# snapshots: live data sources the step downloads (see SNAPSHOTS), their snapshot is part of its fingerprint
+# step 9 (step9_create_taps.ipynb) is not in the runner: it reads and writes under hardcoded machine specific folders
+PIPELINE_STEPS = [
+    {
+        "name" : "step0",
+        "kind" : "notebook",
+        "path" : "step0_prepare_for_shst_extraction.ipynb",
+        "inputs" : ["../../data/external/county_boundaries/county_5m - Copy.*"],
+        "outputs" : ["../../data/external/county_boundaries/boundary_*.geojson"],
+    },
+    {
+        "name" : "step1",
+        "kind" : "external",
+        "path" : "step1_shst_extraction.sh",
+        "inputs" : ["../../data/external/county_boundaries/boundary_*.geojson"],
+        "snapshots" : ["shst"],
+        "outputs" : ["../../data/external/sharedstreets_extract/mtc_*.out.geojson"],
+    },
+    {
+        "name" : "step2",
+        "kind" : "notebook",
+        "path" : "step2_osmnx_extraction.ipynb",
+        "inputs" : ["../../data/external/county_boundaries/county_5m - Copy.*"],
+        "snapshots" : ["osm"],
+        "outputs" : ["../../data/external/osmnx_extract/link.geojson",
+                     "../../data/external/osmnx_extract/node.geojson"],
+    },
+    {
+        "name" : "step3",
+        "kind" : "notebook",
+        "path" : "step3_join_shst_extraction_with_osm.ipynb",
+        "inputs" : ["../../data/external/osmnx_extract/link.geojson",
+                    "../../data/external/osmnx_extract/node.geojson",
+                    "../../data/external/sharedstreets_extract/mtc_*.out.geojson",
+                    "../../data/interim/highway_to_roadway.csv",
+                    "../../data/interim/network_type_indicator.csv"],
+        "outputs" : ["../../data/interim/step3_join_shst_extraction_with_osm/shape.parquet",
+                     "../../data/interim/step3_join_shst_extraction_with_osm/link.parquet",
+                     "../../data/interim/step3_join_shst_extraction_with_osm/node.parquet"],
+    },
+    {
+        "name" : "step4_prepare",
+        "kind" : "notebook",
+        "path" : "step4_prepare_third_party_for_shst.ipynb",
+        # the tomtom network is read from an absolute path, as in the notebook
+        "inputs" : ["Z:/Data/Users/Sijia/MTC/tomtom/Network_region.gdb/*",
+                    "../../data/external/TM2_nonMarin/mtc_final_network_base.*",
+                    "../../data/external/TM2_Marin/mtc_final_network_base.*",
+                    "../../data/external/stclines/stclines.*",
+                    "../../data/external/sfcta/SanFrancisco_links.*",
+                    "../../data/external/mtc/pems_period.csv",
+                    "../../data/external/county_boundaries/boundary_*.geojson"],
+        "outputs" : ["../../data/external/tomtom/tomtom*.in.geojson",
+                     "../../data/external/TM2_nonMarin/tm2nonMarin_*.in.geojson",
+                     "../../data/external/TM2_Marin/tm2Marin_*.in.geojson",
+                     "../../data/external/sfclines/sfcta.in.geojson",
+                     "../../data/external/sfcta/sfcta_in.geojson",
+                     "../../data/external/mtc/pems.in.geojson",
+                     "../../data/interim/step4_prepare_third_party/tomtom.parquet",
+                     "../../data/interim/step4_prepare_third_party/tm2_nonMarin.parquet",
+                     "../../data/interim/step4_prepare_third_party/tm2_Marin.parquet",
+                     "../../data/interim/step4_prepare_third_party/sfcta_stick.parquet"],
+    },
+    {
+        "name" : "step4_shst_match",
+        "kind" : "external",
+        "path" : "step4_conflate_with_third_party.sh",
+        "inputs" : ["../../data/external/tomtom/tomtom*.in.geojson",
+                    "../../data/external/TM2_nonMarin/tm2nonMarin_*.in.geojson",
+                    "../../data/external/TM2_Marin/tm2Marin_*.in.geojson",
+                    "../../data/external/sfclines/sfcta.in.geojson",
+                    "../../data/external/sfcta/sfcta_in.geojson",
+                    "../../data/external/mtc/pems.in.geojson"],
+        # the tomtom matches are read from an absolute path, as in the step 4 notebook
+        "outputs" : ["D:/MTC/data/interim/tomtom/*/*_tomtom.out.matched.geojson",
+                     "../../data/interim/tm2_nonMarin/*/*_tm2nonMarin.out.matched.geojson",
+                     "../../data/interim/tm2_Marin/*/*_tm2Marin.out.matched.geojson",
+                     "../../data/interim/stclines/*/sfcta.out.matched.geojson",
+                     "../../data/interim/sfcta/*/sfcta.out.matched.geojson",
+                     "../../data/interim/mtc/pems_conflation_result.geojson"],
+    },
+    {
+        "name" : "step4",
+        "kind" : "notebook",
+        "path" : "step4_conflate_with_third_party.ipynb",
+        "inputs" : ["../../data/interim/step3_join_shst_extraction_with_osm/shape.parquet",
+                    "../../data/interim/step3_join_shst_extraction_with_osm/link.parquet",
+                    "../../data/interim/step4_prepare_third_party/tomtom.parquet",
+                    "../../data/interim/step4_prepare_third_party/tm2_nonMarin.parquet",
+                    "../../data/interim/step4_prepare_third_party/tm2_Marin.parquet",
+                    "../../data/interim/step4_prepare_third_party/sfcta_stick.parquet",
+                    "../../data/external/sfcta/SanFrancisco_links.*",
+                    "D:/MTC/data/interim/tomtom/*/*_tomtom.out.matched.geojson",
+                    "../../data/interim/tm2_nonMarin/*/*_tm2nonMarin.out.matched.geojson",
+                    "../../data/interim/tm2_Marin/*/*_tm2Marin.out.matched.geojson",
+                    "../../data/interim/stclines/*/sfcta.out.matched.geojson",
+                    "../../data/interim/sfcta/*/sfcta.out.matched.geojson",
+                    "../../data/interim/mtc/pems_conflation_result.geojson"],
+        "outputs" : ["../../data/interim/step4_conflate_with_tomtom/link.parquet",
+                     "../../data/interim/conflation_result.csv"],
+    },
+    {
+        "name" : "step5",
+        "kind" : "notebook",
+        "path" : "step5_tidy_roadway.ipynb",
+        "inputs" : ["../../data/interim/step3_join_shst_extraction_with_osm/shape.parquet",
+                    "../../data/interim/step3_join_shst_extraction_with_osm/node.parquet",
+                    "../../data/interim/step4_conflate_with_tomtom/link.parquet",
+                    "../../data/external/county_boundaries/cb_2018_us_county_500k/cb_2018_us_county_500k.*",
+                    "../../data/interim/highway_to_roadway.csv"],
+        "outputs" : ["../../data/interim/step5_tidy_roadway/shape.parquet",
+                     "../../data/interim/step5_tidy_roadway/node.parquet",
+                     "../../data/interim/step5_tidy_roadway/link.parquet"],
+    },
+    {
+        "name" : "step6_gtfs_shape",
+        "kind" : "notebook",
+        "path" : "step6_gtfs_shape_to_geojson_for_shst_js.ipynb",
+        "inputs" : ["../../data/external/gtfs/2015/*/shapes.txt"],
+        "outputs" : ["../../data/external/gtfs/*.transit.geojson"],
+    },
+    {
+        "name" : "step6_shst_match",
+        "kind" : "external",
+        "path" : None,
+        "inputs" : ["../../data/external/gtfs/*.transit.geojson"],
+        "outputs" : ["../../data/interim/step6_gtfs/shst_match/*.out.matched.geojson"],
+    },
+    {
+        "name" : "step6",
+        "kind" : "notebook",
+        "path" : "step6_gtfs_transit_network_builder_v3.ipynb",
+        # calendar.txt is rewritten in place by the notebook, calendar_orig.txt is the original
+        "inputs" : ["../../data/interim/step5_tidy_roadway/shape.parquet",
+                    "../../data/interim/step5_tidy_roadway/node.parquet",
+                    "../../data/interim/step5_tidy_roadway/link.parquet",
+                    "../../data/interim/step6_gtfs/shst_match/*.out.matched.geojson",
+                    "../../data/external/gtfs/2015/*/routes.txt",
+                    "../../data/external/gtfs/2015/*/trips.txt",
+                    "../../data/external/gtfs/2015/*/stops.txt",
+                    "../../data/external/gtfs/2015/*/shapes.txt",
+                    "../../data/external/gtfs/2015/*/stop_times.txt",
+                    "../../data/external/gtfs/2015/*/agency.txt",
+                    "../../data/external/gtfs/2015/*/fare_*.txt",
+                    "../../data/external/county_boundaries/cb_2018_us_county_500k/cb_2018_us_county_500k.*",
+                    "../../data/interim/gtfs_to_tm2_mode_crosswalk.csv"],
+        "outputs" : ["../../data/interim/step6_gtfs/version_12/shape.parquet",
+                     "../../data/interim/step6_gtfs/version_12/node.parquet",
+                     "../../data/interim/step6_gtfs/version_12/link.parquet",
+                     "../../data/processed/version_12/transit.LIN"],
+    },
+    {
+        "name" : "step7",
+        "kind" : "notebook",
+        "path" : "step7_centroid_connector_builder.ipynb",
+        "inputs" : ["../../data/interim/step6_gtfs/version_12/shape.parquet",
+                    "../../data/interim/step6_gtfs/version_12/node.parquet",
+                    "../../data/interim/step6_gtfs/version_12/link.parquet"],
+        "outputs" : ["../../data/interim/step7_centroid_connector/cc_link.parquet",
+                     "../../data/interim/step7_centroid_connector/cc_shape.parquet",
+                     "../../data/interim/step7_centroid_connector/centroid_node.parquet"],
+    },
+    {
+        "name" : "step8",
+        "kind" : "notebook",
+        "path" : "step8_standard_format.ipynb",
+        "inputs" : ["../../data/interim/step6_gtfs/version_12/shape.parquet",
+                    "../../data/interim/step6_gtfs/version_12/node.parquet",
+                    "../../data/interim/step6_gtfs/version_12/link.parquet"],
+        "outputs" : ["../../data/interim/step8_standard_format/shape.geojson",
+                     "../../data/interim/step8_standard_format/node.geojson",
+                     "../../data/interim/step8_standard_format/link.feather"],
+    },
+]
+
+
+def _abspath(path):
+    return os.path.normpath(os.path.join(PIPELINE_DIR, path))
+
+
+def expand_pattern(pattern):
+    """
+    files matching a path or glob pattern, sorted
+
+    Parameters
+    ----------
+    pattern: path or glob pattern relative to this folder
+    """
+    return sorted(p for p in glob.glob(_abspath(pattern)) if os.path.isfile(p))
+
+
+def file_hash(path, hash_cache):
+    """
+    sha1 of a file's content
+
+    the hash is reused while the file's size and modification time are unchanged, so that
+    unchanged multi-GB inputs are not read again on every run
+
+    Parameters
+    ----------
+    path: absolute path
+    hash_cache: dictionary of path to [size, mtime, sha1], kept in the state file
+    """
+    stat = os.stat(path)
+    cached = hash_cache.get(path)
+    if (cached is not None) and (cached[0] == stat.st_size) and (cached[1] == stat.st_mtime_ns):
+        return cached[2]
+
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    hash_cache[path] = [stat.st_size, stat.st_mtime_ns, sha1.hexdigest()]
+    return sha1.hexdigest()
+
+
+def code_hash(step):
+    """
+    sha1 of a step's code
+
+    for notebooks only the code cells count, so a notebook saved with new outputs is not a change
+
+    Parameters
+    ----------
+    step: one of PIPELINE_STEPS
+    """
+    sha1 = hashlib.sha1()
+    if step["path"] is None:
+        return sha1.hexdigest()
+
+    if step["kind"] == "notebook":
+        with open(_abspath(step["path"]), encoding = "utf-8") as f:
+            notebook = json.load(f)
+        for cell in notebook["cells"]:
+            if cell["cell_type"] == "code":
+                sha1.update("".join(cell["source"]).encode("utf-8"))
+                sha1.update(b"\0")
+        for path in SHARED_CODE:
+            with open(_abspath(path), "rb") as f:
+                sha1.update(f.read())
+    elif os.path.exists(_abspath(step["path"])):
+        with open(_abspath(step["path"]), "rb") as f:
+            sha1.update(f.read())
+
+    return sha1.hexdigest()
+
+
+def step_fingerprint(step, hash_cache, snapshot_dict = None):
+    """
+    fingerprint of a step's code, parameters, data snapshots and input files
+
+    Parameters
+    ----------
+    step: one of PIPELINE_STEPS
+    hash_cache: see file_hash
+    snapshot_dict: dictionary of data source (see SNAPSHOTS) to its current snapshot name
+
+    return
+    ----------
+    sha1 hex digest, list of input patterns matching no file
+    """
+    sha1 = hashlib.sha1()
+    sha1.update(code_hash(step).encode())
+    sha1.update(json.dumps(step.get("params", {}), sort_keys = True).encode())
+    snapshot_dict = snapshot_dict or {}
+    sha1.update(json.dumps(dict((source, snapshot_dict.get(source)) for source in step.get("snapshots", [])),
+                           sort_keys = True).encode())
+
+    missing_list = []
+    for pattern in step["inputs"]:
+        path_list = expand_pattern(pattern)
+        if len(path_list) == 0:
+            missing_list.append(pattern)
+        sha1.update(pattern.encode())
+        for path in path_list:
+            sha1.update(os.path.relpath(path, PIPELINE_DIR).encode())
+            sha1.update(file_hash(path, hash_cache).encode())
+
+    return sha1.hexdigest(), missing_list
+
+
+def build_dag(steps):
+    """
+    upstream steps of each step, from the steps' declared inputs and outputs
+
+    Parameters
+    ----------
+    steps: list of step dictionaries, e.g. PIPELINE_STEPS
+
+    return
+    ----------
+    dictionary of step name to list of upstream step names, step names in topological order
+    """
+    producer_dict = {}
+    for step in steps:
+        for pattern in step["outputs"]:
+            if pattern in producer_dict:
+                raise ValueError(pattern + " is written by both " + producer_dict[pattern] + " and " + step["name"])
+            producer_dict[pattern] = step["name"]
+
+    upstream_dict = {}
+    for step in steps:
+        upstream_dict[step["name"]] = sorted(set(producer_dict[p] for p in step["inputs"]
+                                                 if (p in producer_dict) and (producer_dict[p] != step["name"])))
+
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError("pipeline steps have a cycle through " + name)
+        visiting.add(name)
+        for upstream in upstream_dict[name]:
+            visit(upstream)
+        visiting.discard(name)
+        order.append(name)
+
+    for step in steps:
+        visit(step["name"])
+
+    return upstream_dict, order
+
+
+def select_steps(targets, upstream_dict, order):
+    """
+    the target steps and everything upstream of them, in topological order
+    """
+    if not targets:
+        return list(order)
+
+    selected = set()
+    stack = list(targets)
+    while stack:
+        name = stack.pop()
+        if name not in upstream_dict:
+            raise ValueError("unknown step " + name)
+        if name not in selected:
+            selected.add(name)
+            stack.extend(upstream_dict[name])
+
+    return [name for name in order if name in selected]
+
+
+def outputs_exist(step):
+    return all(len(expand_pattern(pattern)) > 0 for pattern in step["outputs"])
+
+
+def read_state(path = STATE_FILE):
+    if os.path.exists(_abspath(path)):
+        with open(_abspath(path)) as f:
+            state = json.load(f)
+        state.setdefault("snapshots", {})
+        return state
+    return {"steps" : {}, "file_hashes" : {}, "snapshots" : {}}
+
+
+def write_state(state, path = STATE_FILE):
+    os.makedirs(os.path.dirname(_abspath(path)), exist_ok = True)
+    with open(_abspath(path) + ".tmp", "w") as f:
+        json.dump(state, f, indent = 1, sort_keys = True)
+    os.replace(_abspath(path) + ".tmp", _abspath(path))
+
+
+def execute_notebook(step, run_dir = RUN_DIR, timeout = -1):
+    """
+    run a notebook headless with nbconvert, from this folder
+
+    the executed copy and the log are written to run_dir; the notebook in the repository is not modified
+
+    return
+    ----------
+    True if the notebook ran through without error
+    """
+    os.makedirs(_abspath(run_dir), exist_ok = True)
+    log_file = os.path.join(_abspath(run_dir), step["name"] + ".log")
+    command = [sys.executable, "-m", "jupyter", "nbconvert", "--to", "notebook", "--execute",
+               "--ExecutePreprocessor.timeout=" + str(timeout),
+               "--output-dir", _abspath(run_dir),
+               "--output", step["name"] + ".ipynb",
+               _abspath(step["path"])]
+    with open(log_file, "w") as log:
+        result = subprocess.run(command, cwd = PIPELINE_DIR, stdout = log, stderr = subprocess.STDOUT)
+    return result.returncode == 0
+
+
+def run_pipeline(targets = None, force = False, dry_run = False, jobs = 2, steps = PIPELINE_STEPS,
+                 state_file = STATE_FILE, execute = execute_notebook, snapshots = None):
+    """
+    bring the target steps up to date, running independent steps in parallel
+
+    a step is fingerprinted once all its upstream steps are finished, so that it sees their new outputs
+
+    Parameters
+    ----------
+    targets: list of step names, default all steps
+    force: rerun the target steps even if their fingerprints match
+    dry_run: only print what would run
+    jobs: number of steps to run at the same time
+    steps: list of step dictionaries
+    state_file: json file of the fingerprints of successful runs
+    execute: function running a notebook step, returning True on success
+    snapshots: dictionary of data source to its new snapshot name, e.g. {"osm" : "2024-05-01"} after an OSM
+        refresh; sources not given keep the snapshot of the previous runs
+
+    return
+    ----------
+    dictionary of step name to status: "skipped", "ran", "failed", "blocked", "stale" or "missing"
+    """
+    step_dict = {step["name"] : step for step in steps}
+    upstream_dict, order = build_dag(steps)
+    selected = select_steps(targets, upstream_dict, order)
+    forced = set(targets if targets else selected) if force else set()
+
+    state = read_state(state_file)
+    hash_cache = state["file_hashes"]
+    for source, snapshot in (snapshots or {}).items():
+        if source not in SNAPSHOTS:
+            raise ValueError("unknown data source " + source)
+        if (snapshot is not None) and (snapshot != state["snapshots"].get(source)):
+            print(source + " snapshot: " + str(state["snapshots"].get(source)) + " -> " + snapshot)
+            state["snapshots"][source] = snapshot
+    status_dict = {}
+
+    def now():
+        return time.strftime("%Y-%m-%d %H:%M:%S")
+
+    def check_external(name, fingerprint):
+        """
+        an external step is "stale" if its inputs changed but its outputs did not, i.e. it was not rerun by hand
+        """
+        step = step_dict[name]
+        if not outputs_exist(step):
+            print(name + ": outputs missing, run it by hand (see Readme)")
+            return "missing"
+        output_fingerprint, _ = step_fingerprint(dict(step, inputs = step["outputs"], path = None), hash_cache)
+        previous = state["steps"].get(name, {})
+        if (previous.get("fingerprint") not in (None, fingerprint)) and (previous.get("outputs") == output_fingerprint):
+            print(name + ": inputs changed since its outputs were made, rerun it by hand (see Readme)")
+            return "stale"
+        state["steps"][name] = {"fingerprint" : fingerprint, "outputs" : output_fingerprint, "time" : now()}
+        return "skipped"
+
+    def prepare(name):
+        """
+        fingerprint a step whose upstream steps are finished, and decide whether to run it
+        """
+        step = step_dict[name]
+        if any(status_dict.get(u) in ("failed", "blocked", "missing") for u in upstream_dict[name]):
+            return "blocked", None
+        # in a dry run the upstream steps did not really run, assume their outputs change
+        if dry_run and any(status_dict.get(u) == "would run" for u in upstream_dict[name]):
+            return ("stale" if step["kind"] == "external" else "run"), None
+
+        fingerprint, missing_list = step_fingerprint(step, hash_cache, state["snapshots"])
+        if step["kind"] == "external":
+            return check_external(name, fingerprint), fingerprint
+
+        up_to_date = (state["steps"].get(name, {}).get("fingerprint") == fingerprint) and outputs_exist(step)
+        if up_to_date and (name not in forced):
+            return "skipped", fingerprint
+        if len(missing_list) > 0:
+            print(name + ": missing inputs " + ", ".join(missing_list))
+            return "blocked", fingerprint
+        return "run", fingerprint
+
+    pending = list(selected)
+    # future to (step name, fingerprint, start time)
+    running = {}
+    with ThreadPoolExecutor(max_workers = jobs) as executor:
+        while pending or running:
+            running_names = set(name for name, _, _ in running.values())
+            # start every step whose upstream steps are finished
+            for name in list(pending):
+                if any((u in pending) or (u in running_names) for u in upstream_dict[name]):
+                    continue
+                pending.remove(name)
+                action, fingerprint = prepare(name)
+                if action != "run":
+                    status_dict[name] = action
+                    print(name + ": " + action)
+                elif dry_run:
+                    status_dict[name] = "would run"
+                    print(name + ": would run")
+                else:
+                    print(name + ": running " + step_dict[name]["path"])
+                    running[executor.submit(execute, step_dict[name])] = (name, fingerprint, time.time())
+                    running_names.add(name)
+
+            if not running:
+                continue
+
+            done, _ = wait(list(running), return_when = FIRST_COMPLETED)
+            for future in done:
+                name, fingerprint, start = running.pop(future)
+                if future.result() and outputs_exist(step_dict[name]):
+                    status_dict[name] = "ran"
+                    state["steps"][name] = {"fingerprint" : fingerprint, "time" : now()}
+                    write_state(state, state_file)
+                else:
+                    status_dict[name] = "failed"
+                print(name + ": " + status_dict[name] + " in " + str(round(time.time() - start)) + " seconds")
+
+    if not dry_run:
+        write_state(state, state_file)
+
+    return status_dict
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Run the network rebuild pipeline, skipping up-to-date steps.")
+    parser.add_argument("--steps", nargs = "*", default = None,
+                        help = "steps to bring up to date, with their upstream steps (default: all). "
+                        "One of: " + ", ".join(step["name"] for step in PIPELINE_STEPS))
+    parser.add_argument("--force", action = "store_true", help = "rerun the given steps even if up to date")
+    parser.add_argument("--dry-run", action = "store_true", help = "print what would run")
+    parser.add_argument("--jobs", type = int, default = 2, help = "number of steps to run at the same time")
+    parser.add_argument("--osm-snapshot", default = None,
+                        help = "name (e.g. date) of the OSM data after a refresh, reruns the OSM extraction steps")
+    parser.add_argument("--shst-snapshot", default = None,
+                        help = "name (e.g. date) of the SharedStreets tiles after a refresh, reruns the shst extraction")
+    args = parser.parse_args()
+
+    status_dict = run_pipeline(targets = args.steps, force = args.force, dry_run = args.dry_run, jobs = args.jobs,
+                               snapshots = {"osm" : args.osm_snapshot, "shst" : args.shst_snapshot})
+
+    if any(status in ("failed", "blocked", "missing") for status in status_dict.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import re
+from array import array
+
+import numpy as np
+import pandas as pd
+
+# a KEY=VALUE token, or a bare value; quoted values may contain commas
+TOKEN_RE = re.compile(r'\s*(?:([A-Za-z_][\w \[\]]*?)\s*=)?\s*("[^"]*"|[^,]*)\s*(?:,|$)')
+# the part of a line before its comment: a ";" outside quotes
+COMMENT_RE = re.compile(r'((?:[^";]|"[^"]*")*);')
+
+
+def _split_tokens(fline):
+    """
+    Split one line of a Cube transit line file into (key, value) tokens.
+    Comments (after a ";" outside quotes) are dropped, key is None for a bare value such as a node number.
+    """
+    if ";" in fline:
+        if '"' not in fline:
+            fline = fline.split(";", 1)[0]
+        else:
+            match = COMMENT_RE.match(fline)
+            if match:
+                fline = match.group(1)
+    fline = fline.strip()
+    if not fline:
+        return []
+
+    if "=" not in fline and '"' not in fline:
+        # fast path for the node list lines, e.g. " -3006601,"
+        return [(None, value.strip()) for value in fline.split(",") if value.strip()]
+
+    tokens = []
+    for key, value in TOKEN_RE.findall(fline):
+        if key or value:
+            tokens.append((key.strip().upper() if key else None, value.strip()))
+    return tokens
+
+
+def iter_transit_lines(f):
+    """
+    Stream the transit lines of a Cube transit line file, one line at a time.
+
+    A line starts at `LINE NAME=`. Its attributes are the `KEY=VALUE` tokens before the node list,
+    e.g. MODE, OPERATOR, HEADWAY[1]. The node list starts at `N=` and may span any number of file lines,
+    with several nodes per file line. Negative nodes are non-stop nodes. Node attribute tokens within the
+    node list (e.g. `NNTIME=`, `ACCESS=`) are skipped, and a later `N=` continues the node list.
+
+    Parameter:
+        f: an open Cube transit line file, or any iterable of its lines.
+
+    Yield:
+        (attributes, nodes) for each transit line:
+        - attributes: dictionary of attribute name to value, quotes removed; the line name is "NAME"
+        - nodes: array("q") of node numbers as in the file, negative for non-stop nodes
+    """
+    attributes = None
+    nodes = None
+    in_nodes = False
+
+    for fline in f:
+        # fast path for the usual node list line with one node, e.g. " -3006601,"
+        if in_nodes:
+            value = fline.strip().rstrip(",")
+            if value.lstrip("-").isdigit():
+                nodes.append(int(value))
+                continue
+
+        for key, value in _split_tokens(fline):
+            if key == "LINE NAME":
+                if attributes is not None:
+                    yield attributes, nodes
+                attributes = {"NAME": value.strip('"')}
+                nodes = array("q")
+                in_nodes = False
+            elif attributes is None:
+                continue
+            elif key == "N":
+                in_nodes = True
+                if value:
+                    nodes.append(int(value))
+            elif key is None:
+                if in_nodes:
+                    nodes.append(int(value))
+            elif not in_nodes:
+                attributes[key] = value.strip('"')
+
+    if attributes is not None:
+        yield attributes, nodes
+
+
+def read_transit_lines(transit_lines):
+    """
+    Read a Cube transit line file into a line table and columnar node arrays.
+
+    Parameter:
+        transit_lines: path to a Cube transit line file.
+
+    Return:
+        line_df: a pandas dataframe with one row per transit line, in file order:
+        - line_index: position of the line in the file
+        - line_name: name of the transit line
+        - one column per line attribute (e.g. MODE, OPERATOR), as str, missing if not set for the line
+        node_df: a pandas dataframe with one row per node of every line, in line then sequence order:
+        - line_index: line of the node, see line_df
+        - seq: position of the node in its line, from 0
+        - node: node ID number (absolute value)
+        - is_stop: False for non-stop nodes (negative in the file)
+    """
+    attribute_list = []
+    node_array = array("q")
+    line_length = array("q")
+
+    with open(transit_lines, "r") as f:
+        for attributes, nodes in iter_transit_lines(f):
+            attribute_list.append(attributes)
+            node_array.extend(nodes)
+            line_length.append(len(nodes))
+
+    line_df = pd.DataFrame.from_records(attribute_list)
+    line_df = line_df.rename(columns={"NAME": "line_name"})
+    line_df.insert(0, "line_index", np.arange(len(line_df), dtype=np.int32))
+
+    raw_node = np.frombuffer(node_array, dtype=np.int64) if len(node_array) else np.zeros(0, dtype=np.int64)
+    line_length = np.frombuffer(line_length, dtype=np.int64) if len(line_length) else np.zeros(0, dtype=np.int64)
+    line_start = np.cumsum(line_length) - line_length
+
+    line_index = np.repeat(np.arange(len(line_length), dtype=np.int32), line_length)
+    node_df = pd.DataFrame(
+        {
+            "line_index": line_index,
+            "seq": (np.arange(len(raw_node)) - np.repeat(line_start, line_length)).astype(np.int32),
+            "node": np.abs(raw_node).astype(np.int32),
+            "is_stop": raw_node > 0,
+        }
+    )
+
+    return line_df, node_df
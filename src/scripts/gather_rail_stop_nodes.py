@@ -1,58 +1,34 @@
 import pandas as pd
 
-# initialize an empty list, will be added with dictionaries in the format:
-# {"operator": operator, "route_id": route_id, "stop_node": node}
-station_nodes = []
+from cube_transit_lines import read_transit_lines
+
+# operator ID number of the rail operators to collect stop nodes for
+RAIL_OPERATORS = {26: "BART", 17: "Caltrain"}
 
 # parse through transit line file
 # for each route that is either BART or Caltrain, collect its stop nodes
-with open("data/transitLines.lin", "r") as f:
-    line = f.readline()
-
-    # initialize status variables
-    operator = ""
-    route_id = 0
-    station_info_start = False
-    is_bart_or_caltrain = False
-
-    while line:
-
-        if line.startswith("LINE NAME"):
-            route_name = line.split("=")[1].strip().replace(",", "")
-            route_id = int(route_name.split("_")[1])
-
-        if line.startswith(" OPERATOR"):
-            operator_id = int(line.split("=")[1].strip().replace(",", ""))
-            if operator_id == 26:
-                operator = "BART"
-                is_bart_or_caltrain = True
-            elif operator_id == 17:
-                operator = "Caltrain"
-                is_bart_or_caltrain = True
+line_df, node_df = read_transit_lines("data/transitLines.lin")
 
-        if line == "\n":  # end of the stop node info
-            station_info_start = False
-            is_bart_or_caltrain = False
-
-        if station_info_start and is_bart_or_caltrain:
-            node = int(line.strip().replace(",", ""))
-            if node > 0:  # means it's a stop, not just an intermediate node
-                station_nodes.append(
-                    {"operator": operator, "route_id": route_id, "stop_node": node}
-                )
-
-        if line.startswith(" N="):
-            station_info_start = True
-
-        # move to next line
-        line = f.readline()
+line_df["operator"] = pd.to_numeric(line_df["OPERATOR"]).map(RAIL_OPERATORS)
+line_df["route_id"] = line_df["line_name"].str.split("_").str[1].astype(int)
+rail_line_df = line_df[line_df["operator"].notnull()]
 
+# stop nodes only, not intermediate nodes
+station_df = pd.merge(
+    node_df[node_df["is_stop"] & node_df["line_index"].isin(rail_line_df["line_index"])],
+    rail_line_df[["line_index", "operator", "route_id"]],
+    on="line_index",
+)
+station_df = (
+    station_df[["operator", "route_id", "node"]]
+    .rename(columns={"node": "stop_node"})
+    .drop_duplicates()
+)
 
-# convert to dataframe and export results
-station_df = pd.DataFrame.from_dict(station_nodes).drop_duplicates()
+# export results
 bart_station_df = station_df[station_df["operator"] == "BART"].reset_index(drop=True)
 caltrain_station_df = station_df[station_df["operator"] == "Caltrain"].reset_index(
     drop=True
 )
 bart_station_df.to_csv("data/bart_station_nodes.csv", index=False)
-caltrain_station_df.to_csv("data/caltrain_station_nodes.csv", index=False)
\ No newline at end of file
+caltrain_station_df.to_csv("data/caltrain_station_nodes.csv", index=False)
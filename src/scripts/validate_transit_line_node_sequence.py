@@ -1,10 +1,17 @@
+import glob
+import os
+
+import numpy as np
 from numpy import int32
 import pandas as pd
+from scipy.sparse import csr_matrix, diags
+
+from cube_transit_lines import read_transit_lines
 
 
 def create_trn_links(transit_lines):
     """
-    Parse through the transit node sequences, and create transit links from Cube transit line file.
+    Create transit links from the transit node sequences of a Cube transit line file.
 
     Parameter:
         transit_lines: path to a Cube transit line file.
@@ -12,78 +19,137 @@ def create_trn_links(transit_lines):
     Return:
         A pandas dataframe with 3 columns:
         - line_name: name of the transit line
+        - seq: position of the link in the transit line, from 0
         - A: node A ID number
         - B: node B ID number
     """
+    line_df, node_df = read_transit_lines(transit_lines)
+
+    # consecutive nodes of the same line; node is the absolute value to capture non-stop transit nodes
+    line_index = node_df["line_index"].values
+    node = node_df["node"].values
+    same_line = line_index[1:] == line_index[:-1]
+
+    trn_links = pd.DataFrame(
+        {
+            "line_name": line_df["line_name"].values[line_index[1:][same_line]],
+            "seq": node_df["seq"].values[:-1][same_line],
+            "A": node[:-1][same_line].astype(int32),
+            "B": node[1:][same_line].astype(int32),
+        }
+    )
+
+    return trn_links
+
+
+def pack_ab(A, B):
+    """
+    Pack link A, B node ID numbers into one int64 key per link.
+    Same keys as `pack_ab` of notebooks/pipeline/methods.py, which this standalone script does not import.
+
+    Parameters:
+        A, B: arrays of node ID numbers, non-negative and below 2**31.
+
+    Return:
+        an int64 array, A in the high 32 bits and B in the low 32 bits.
+    """
+    return (np.asarray(A, dtype=np.int64) << 32) | np.asarray(B, dtype=np.int64)
+
+
+def build_link_index(network_AB):
+    """
+    Index the links of a network for membership tests and shortest path repairs.
+    Build it once per network version, and reuse it for every transit line file validated against it.
+
+    Parameters:
+        network_AB: A dataframe with network links A, B nodes.
 
-    with open(transit_lines, "r") as f:
-        fline = f.readline()
-
-        # initialize status variables
-        node_info_start = False
-        line_name = ""
-        node_A = 0
-        node_B = 0
-        line_links = {"line_name": [], "A": [], "B": []}
-
-        # initialize an empty df for links info
-        trn_links = pd.DataFrame()
-        print(trn_links)
-
-        while fline:
-
-            # retrieve transit line name
-            if fline.startswith("LINE NAME"):
-                line_name = (
-                    fline.split("=")[1].strip().replace('"', "").replace(",", "")
-                )
-
-            # when reaches the end of each transit line
-            if fline == "\n":
-                # convert line_links to df, and append the df to trn_links
-                line_links_df = pd.DataFrame.from_dict(line_links)
-                trn_links = trn_links.append(line_links_df, ignore_index=True)
-
-                # reset status variables
-                node_info_start = False
-                line_name = ""
-                node_A = 0
-                node_B = 0
-                line_links = {"line_name": [], "A": [], "B": []}
-
-            if node_info_start:
-                node = abs(
-                    int(fline.split(",")[0])
-                )  # use absolute value to capture non-stop transit nodes
-                if node_A == 0 and node_B == 0:  # 1st node of the transit line
-                    node_A = node
-                elif node_B == 0:  # 2nd node of the transit line
-                    node_B = node
-                else:
-                    node_A = node_B
-                    node_B = node
-                # print(f"A: {node_A}, B: {node_B}")
-
-                if node_B != 0:  # if not the 1st node
-                    line_links["line_name"].append(line_name)
-                    line_links["A"].append(node_A)
-                    line_links["B"].append(node_B)
-
-            if fline.startswith(" N="):
-                print(f"start parsing node info for line {line_name}")
-                node_info_start = True
-
-            fline = f.readline()
-
-        # assert dtype
-        dtype_dict = {"line_name": str, "A": int32, "B": int32}
-        trn_links = trn_links.astype(dtype_dict)
-
-        # return trn_links
-        return trn_links
-
-
-def validate_trn_links(network_AB, trn_links):
+    Return:
+        A dictionary with:
+        - keys: sorted unique packed (A, B) keys of the network links, see `pack_ab`
+        - node_id: sorted unique node ID numbers of the network
+        - graph: sparse adjacency matrix of the network links, indexed by position in node_id
+    """
+    A = network_AB["A"].values
+    B = network_AB["B"].values
+
+    node_id = np.unique(np.concatenate([A, B]))
+    A_index = np.searchsorted(node_id, A)
+    B_index = np.searchsorted(node_id, B)
+    graph = csr_matrix(
+        (np.ones(len(A), dtype=np.float64), (A_index, B_index)),
+        shape=(len(node_id), len(node_id)),
+    )
+
+    return {"keys": np.unique(pack_ab(A, B)), "node_id": node_id, "graph": graph}
+
+
+def _is_in_index(link_index, keys):
+    """
+    Vectorized membership test of packed link keys in a link index.
+    """
+    position = np.searchsorted(link_index["keys"], keys)
+    position[position == len(link_index["keys"])] = 0
+    return link_index["keys"][position] == keys
+
+
+def repair_length(link_index, A, B, max_links=10, chunk_size=256):
+    """
+    Number of network links on the shortest path from A to B, to suggest a repair for a missing transit link.
+
+    The paths are searched breadth first, for chunk_size links at a time, by multiplying the sparse frontier
+    of every link by the network adjacency matrix, one network link further at each step.
+
+    Parameters:
+        link_index: a link index from `build_link_index`.
+        A, B: arrays of node ID numbers of the missing links.
+        max_links: paths of more links are not searched.
+        chunk_size: number of links searched at the same time.
+
+    Return:
+        a float array, NaN where A or B is not a network node or B is not reachable within max_links.
+    """
+    A = np.asarray(A)
+    B = np.asarray(B)
+    node_id = link_index["node_id"]
+    graph = link_index["graph"].astype(bool)
+    length = np.full(len(A), np.nan)
+    if len(node_id) == 0:
+        return length
+
+    A_index = np.searchsorted(node_id, A).clip(max=len(node_id) - 1)
+    B_index = np.searchsorted(node_id, B).clip(max=len(node_id) - 1)
+    in_net = (node_id[A_index] == A) & (node_id[B_index] == B)
+
+    for start in range(0, len(A), chunk_size):
+        chunk = np.flatnonzero(in_net[start : start + chunk_size]) + start
+        if len(chunk) == 0:
+            continue
+        rows = np.arange(len(chunk))
+        to_index = B_index[chunk]
+
+        frontier = csr_matrix(
+            (np.ones(len(chunk), dtype=bool), (rows, A_index[chunk])),
+            shape=(len(chunk), len(node_id)),
+        )
+        visited = frontier
+        searching = np.ones(len(chunk), dtype=bool)
+
+        for step in range(1, max_links + 1):
+            # nodes one link further, not visited before, for the links still searching
+            frontier = diags(searching.astype(np.int8), dtype=np.int8) @ (frontier @ graph)
+            frontier = frontier > visited
+            if frontier.nnz == 0:
+                break
+            found = np.asarray(frontier[rows, to_index]).ravel() & searching
+            length[chunk[found]] = step
+            searching &= ~found
+            visited = visited + frontier
+
+    return length
+
+
+def validate_trn_links(network_AB, trn_links, link_index=None):
     """
     Check if transit links is valid (if it exist in network).
 
@@ -91,26 +157,55 @@ def validate_trn_links(network_AB, trn_links):
         network_AB: A dataframe with network links A, B nodes.
         trn_links: A dataframe of transit links A, B nodes.
                   (can be created by the `create_trn_links` function)
+        link_index: the `build_link_index` of network_AB, if already built.
 
     Return:
-        a dataframe of transit links that cannot be found in the network links.
+        a dataframe of transit links that cannot be found in the network links,
+        with `repair_length`, the number of network links on the shortest path from A to B (NaN if none).
     """
+    if link_index is None:
+        link_index = build_link_index(network_AB)
 
-    net = network_AB.copy()
-    net["in_net"] = 1  # indicator variable to flag that the link is in network
-
-    validate_df = pd.merge(trn_links, net, on=["A", "B"], how="left")
+    in_net = _is_in_index(link_index, pack_ab(trn_links["A"].values, trn_links["B"].values))
 
     # filter out transit links that do not exist in network
-    issue = validate_df[validate_df["in_net"].isnull()].drop(columns=["in_net"])
+    issue = trn_links[~in_net].copy()
+    issue["repair_length"] = repair_length(link_index, issue["A"].values, issue["B"].values)
 
     return issue
 
 
+def validate_network_versions(network_AB_files, trn_links):
+    """
+    Check the transit links of one transit line file against several network versions.
+
+    Parameters:
+        network_AB_files: A dictionary of network version name to network links A, B csv file.
+        trn_links: A dataframe of transit links A, B nodes.
+
+    Return:
+        a dataframe of the transit links that cannot be found in each network version,
+        see `validate_trn_links`, with a `network_version` column.
+    """
+    issue_list = []
+    for version, network_AB_file in network_AB_files.items():
+        network_AB = pd.read_csv(network_AB_file, usecols=["A", "B"])
+        issue = validate_trn_links(network_AB, trn_links, build_link_index(network_AB))
+        issue.insert(0, "network_version", version)
+        print(f"{version}: {len(issue)} of {len(trn_links)} transit links not in network")
+        issue_list.append(issue)
+
+    return pd.concat(issue_list, ignore_index=True)
+
+
 if __name__ == "__main__":
-    network_AB = pd.read_csv("data/network_AB_v7.csv")
+    # every network version, e.g. data/network_AB_v7.csv
+    network_AB_files = {
+        os.path.basename(file)[len("network_AB_") : -len(".csv")]: file
+        for file in sorted(glob.glob("data/network_AB_v*.csv"))
+    }
     trn_links = create_trn_links("data/transitLines_ver7.lin")
-    issue = validate_trn_links(network_AB, trn_links)
+    issue = validate_network_versions(network_AB_files, trn_links)
     print(issue.shape)
     print(issue.head(20))
-    issue.to_csv("data/transit_node_seq_issue.csv", index=False)
\ No newline at end of file
+    issue.to_csv("data/transit_node_seq_issue.csv", index=False)